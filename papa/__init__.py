@@ -1,24 +1,39 @@
 import os.path
+import sys
 import socket
 from threading import Lock
 from time import time, sleep
-from subprocess import PIPE, STDOUT
 from collections import namedtuple
-import logging
 import select
-from papa.utils import string_type, recv_with_retry, send_with_retry
-
-try:
-    from subprocess import DEVNULL
-except ImportError:
-    DEVNULL = -3
+from papa import protocol
+from papa.utils import string_type, recv_into_with_retry, send_with_retry
 
 __author__ = 'Scott Maxwell'
-__all__ = ['Papa', 'DEBUG_MODE_NONE', 'DEBUG_MODE_THREAD', 'DEBUG_MODE_PROCESS']
+__all__ = ['Papa', 'Batch', 'BatchResult', 'DEBUG_MODE_NONE', 'DEBUG_MODE_THREAD', 'DEBUG_MODE_PROCESS']
+
+# The client is imported by short-lived scripts, so it does not import
+# subprocess, logging or json until it needs them. These are the values
+# that subprocess uses.
+PIPE = -1
+STDOUT = -2
+DEVNULL = -3
+
+
+class _Log(object):
+    """Imports logging the first time something is logged"""
 
-log = logging.getLogger('papa.client')
+    def __getattr__(self, name):
+        global log
+        import logging
+        log = logging.getLogger('papa.client')
+        return getattr(log, name)
+
+
+log = _Log()
 ProcessOutput = namedtuple('ProcessOutput', 'name timestamp data')
 
+RECV_SIZE = 262144
+
 
 def wrap_trailing_slash(value):
     value = str(value)
@@ -81,7 +96,7 @@ class Watcher(object):
                 if result_type == 'closed':
                     self.exit_code[name] = data
                 else:
-                    data = self.connection.read_bytes(data + 1)[:-1]
+                    data = self.connection.read_bytes(data, 1)
                 result = ProcessOutput(name, float(timestamp), data)
                 reply[result_type].append(result)
             self._need_ack = line == '] '
@@ -125,7 +140,11 @@ class ClientCommandConnection(object):
         self.family = family
         self.location = location
         self.sock = self._attempt_to_connect()
-        self.data = b''
+        # received data is buffer[start:end]
+        self.buffer = bytearray(RECV_SIZE)
+        self.start = self.end = 0
+        self.binary = False
+        self.request_id = 0
 
     def _attempt_to_connect(self):
         # Try to connect to an existing Papa
@@ -139,62 +158,172 @@ class ClientCommandConnection(object):
             sock.close()
             raise
 
-    def send_command(self, command):
-        if isinstance(command, list):
-            command = ' '.join(c.replace(' ', '\ ').replace('\n', '\ ') for c in command if c)
-        command = b(command)
-        send_with_retry(self.sock, command + b'\n')
-
-    def do_command(self, command):
-        self.send_command(command)
+    def negotiate(self):
+        """Read the banner and switch to the binary protocol if the server
+        supports it. The request is sent before the banner arrives so that
+        it does not cost an extra round trip."""
+        send_with_retry(self.sock, b('binary {0}\n'.format(protocol.VERSION)))
+        self.get_prompted_response()
+        try:
+            self.binary = self.get_prompted_response() == str(protocol.VERSION)
+        except utils.Error:
+            self.binary = False
+
+    def _encode_command(self, opcode, args):
+        if self.binary:
+            self.request_id = (self.request_id + 1) & 0xffffffff
+            return protocol.pack_request(self.request_id, opcode, args)
+        command = list(protocol.COMMANDS[opcode]) + list(args)
+        command = ' '.join(c.replace(' ', r'\ ').replace('\n', r'\ ') for c in command if c)
+        return b(command) + b'\n'
+
+    def send_command(self, opcode, args=()):
+        send_with_retry(self.sock, self._encode_command(opcode, args))
+
+    def do_command(self, opcode, args=()):
+        self.send_command(opcode, args)
+        if self.binary:
+            return self.get_binary_response()
         return self.get_full_response()
 
+    def do_commands(self, commands):
+        """Send a list of (opcode, args) pairs in a single write, then read
+        the replies in order. Returns a list of (reply, error) pairs."""
+        first_request_id = self.request_id + 1
+        send_with_retry(self.sock, b''.join(self._encode_command(opcode, args) for opcode, args in commands))
+        replies = []
+        for i in range(len(commands)):
+            if self.binary:
+                data, error = self.read_binary_response((first_request_id + i) & 0xffffffff)
+            else:
+                data, error = self.read_prompted_response()
+            replies.append((data, utils.Error(error) if error is not None else None))
+        return replies
+
+    def read_binary_response(self, expected_request_id, exact=False):
+        """Return the reply and None, or None and the error message"""
+        length, request_id, status = protocol.RESPONSE.unpack(self.read_bytes(protocol.RESPONSE.size, exact=exact))
+        data = protocol.decode(self.read_bytes(length, exact=exact))
+        if request_id != expected_request_id:
+            raise utils.Error('Response to request {0} while waiting for {1}'.format(request_id, expected_request_id))
+        if status != protocol.STATUS_OK:
+            return None, data
+        return data, None
+
+    def get_binary_response(self, exact=False):
+        data, error = self.read_binary_response(self.request_id, exact)
+        if error is not None:
+            raise utils.Error(error)
+        return data
+
+    def _recv(self, size=RECV_SIZE):
+        """Receive up to `size` more bytes straight into the buffer"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start and len(self.buffer) - self.end < size:
+            self.buffer[:self.end - self.start] = self.buffer[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        free = len(self.buffer) - self.end
+        if free < size:
+            self.buffer.extend(bytearray(size - free))
+        view = memoryview(self.buffer)
+        try:
+            received = recv_into_with_retry(self.sock, view[self.end:], size)
+        finally:
+            del view
+        if not received:
+            raise utils.Error('Lost connection')
+        self.end += received
+
+    def _take(self, size, skip=0):
+        """Remove `size` bytes from the buffer and return them, along with
+        `skip` more bytes that are thrown away"""
+        start = self.start
+        self.start += size + skip
+        # slicing the bytearray itself would copy the data twice
+        return memoryview(self.buffer)[start:start + size].tobytes() if size else b''
+
+    def _find(self, sub):
+        """Return the offset of `sub` from the start of the buffered data,
+        receiving more data until it is found"""
+        # _recv may move the data, so keep the scan position relative
+        scanned = 0
+        while True:
+            found = self.buffer.find(sub, self.start + scanned, self.end)
+            if found != -1:
+                return found - self.start
+            scanned = max(0, self.end - self.start - len(sub) + 1)
+            self._recv()
+
+    def _ends_with(self, sub):
+        size = len(sub)
+        return self.end - self.start >= size and self.buffer[self.end - size:self.end] == sub
+
+    def read_prompted_response(self):
+        # like get_full_response, but stops at the first prompt in case
+        # more data follows it
+        data = s(self._take(self._find(b'\n> '), 3))
+        if data.startswith('Error:'):
+            return None, data[7:]
+        return data, None
+
+    def get_prompted_response(self):
+        data, error = self.read_prompted_response()
+        if error is not None:
+            raise utils.Error(error)
+        return data
+
     def get_full_response(self):
-        data = self.data
-        self.data = b''
-        # noinspection PyTypeChecker
-        while not data.endswith(b'\n> '):
-            new_data = recv_with_retry(self.sock)
-            if not new_data:
-                raise utils.Error('Lost connection')
-            data += new_data
+        while not self._ends_with(b'\n> '):
+            self._recv()
 
-        data = s(data[:-3])
+        data = s(self._take(self.end - self.start - 3, 3))
         # noinspection PyTypeChecker
         if data.startswith('Error:'):
             raise utils.Error(data[7:])
         return data
 
     def get_one_line_response(self, alternate_terminator=None):
-        data = self.data
-        while b'\n' not in data:
-            if alternate_terminator and data.endswith(alternate_terminator):
+        scanned = 0
+        while True:
+            found = self.buffer.find(b'\n', self.start + scanned, self.end)
+            if found != -1:
                 break
-            new_data = recv_with_retry(self.sock)
-            if not new_data:
-                raise utils.Error('Lost connection')
-            data += new_data
+            if alternate_terminator and self._ends_with(alternate_terminator):
+                break
+            scanned = self.end - self.start
+            self._recv()
 
-        if data.startswith(b'Error:'):
-            self.data = data
+        if self.buffer.startswith(b'Error:', self.start, self.end):
             return self.get_full_response()
 
-        data, self.data = data.partition(b'\n')[::2]
-        return s(data)
+        if found == -1:
+            return s(self._take(self.end - self.start))
+        return s(self._take(found - self.start, 1))
 
-    def read_bytes(self, size):
-        data = self.data
-        while len(data) < size:
-            new_data = recv_with_retry(self.sock, size - len(data))
-            if not new_data:
+    def fill_line(self):
+        # Receive through the end of the next line but not past it, so that
+        # select() on the socket still sees anything that follows
+        while self.buffer.find(b'\n', self.start, self.end) == -1:
+            peek = self.sock.recv(1024, socket.MSG_PEEK)
+            if not peek:
                 raise utils.Error('Lost connection')
-            data += new_data
-
-        data, self.data = data[:size], data[size:]
-        return data
+            end = peek.find(b'\n')
+            self._recv(len(peek) if end == -1 else end + 1)
+
+    def read_bytes(self, size, skip=0, exact=False):
+        """Return the next `size` bytes and throw away `skip` more. Unless
+        `exact` is set, this reads ahead as much as is available."""
+        needed = size + skip
+        while self.end - self.start < needed:
+            missing = needed - (self.end - self.start)
+            self._recv(missing if exact else max(missing, RECV_SIZE))
+        return self._take(size, skip)
 
     def push_newline(self):
-        self.data = b'\n' + self.data
+        self.buffer[self.start:self.start] = b'\n'
+        self.end += 1
 
     def close(self):
         return self.sock.close()
@@ -236,22 +365,27 @@ class Papa(object):
     # noinspection PyUnusedLocal
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
-        if self._single_connection_mode and self.t and not exc_type:
-            self.t.join()
-            Papa.spawned = False
+        if self._single_connection_mode and self.t:
+            # the server stops as soon as its last connection closes, so
+            # wait for it even after a failure to free up the port
+            self.t.join(1.0 if exc_type else None)
+            if not self.t.is_alive():
+                Papa.spawned = False
 
     def _connect(self, allow_papa_spawn=False):
         try:
             self.connection = ClientCommandConnection(self.family, self.location)
-            self.connection.get_full_response()
+            self.connection.negotiate()
         except Exception:
             try_until = time() + self.connection_timeout
+            if allow_papa_spawn and not Papa.spawned:
+                # returns once the new papa is listening, so the first
+                # attempt below normally succeeds
+                self._spawn_papa_server()
             while time() < try_until:
-                if allow_papa_spawn and not Papa.spawned:
-                    self._spawn_papa_server()
                 try:
                     self.connection = ClientCommandConnection(self.family, self.location)
-                    self.connection.get_full_response()
+                    self.connection.negotiate()
                     break
                 except Exception:
                     sleep(.1)
@@ -263,19 +397,84 @@ class Papa(object):
     def _spawn_papa_server(self):
         with Papa.spawn_lock:
             if not Papa.spawned:
-                if self._debug_mode:
-                    from papa.server import socket_server
-                    from threading import Thread
-                    t = Thread(target=socket_server, args=(self.port_or_path, self._single_connection_mode))
-                    t.daemon = True
-                    t.start()
-                    self.t = t
-                else:
-                    from papa.server import daemonize_server
-                    log.info('Daemonizing Papa')
-                    daemonize_server(self.port_or_path, fix_title=True)
+                ready_read, ready_write = os.pipe()
+                try:
+                    if self._debug_mode:
+                        from papa.server import socket_server
+                        from threading import Thread
+                        t = Thread(target=socket_server, args=(self.port_or_path, self._single_connection_mode),
+                                   kwargs={'ready_fd': ready_write})
+                        t.daemon = True
+                        t.start()
+                        self.t = t
+                        ready_write = None
+                    else:
+                        log.info('Starting Papa')
+                        self._start_papa_process(ready_write)
+                finally:
+                    if ready_write is not None:
+                        os.close(ready_write)
+                self._wait_until_ready(ready_read)
                 Papa.spawned = True
 
+    def _start_papa_process(self, ready_write):
+        """Start papa as a fresh Python process in a session of its own.
+        Unlike forking, this does not copy the memory of the client."""
+        args = [sys.executable, '-m', 'papa.server', '--detached', '--ready-fd', str(ready_write),
+                '--title', 'papa daemon from {0}'.format(os.path.basename(sys.argv[0]))]
+        if isinstance(self.port_or_path, string_type):
+            args.extend(('--unix-socket', self.port_or_path))
+        else:
+            args.extend(('--port', str(self.port_or_path)))
+        # papa runs in / so make sure it finds this copy of the package
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+                                            [path for path in env.get('PYTHONPATH', '').split(os.pathsep) if path])
+        posix_spawn = getattr(os, 'posix_spawn', None)
+        if posix_spawn:
+            os.set_inheritable(ready_write, True)
+            try:
+                posix_spawn(sys.executable, args, env, setsid=True, file_actions=[
+                    (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDWR, 0),
+                    (os.POSIX_SPAWN_DUP2, 0, 1),
+                    (os.POSIX_SPAWN_DUP2, 0, 2),
+                ])
+            finally:
+                os.set_inheritable(ready_write, False)
+        else:
+            from subprocess import Popen
+            if sys.version_info >= (3, 2):
+                # pipes are not inheritable since Python 3.4, so pass it explicitly
+                extra = {'close_fds': True, 'pass_fds': (ready_write,)}
+            else:
+                extra = {'close_fds': False}
+            devnull = open(os.devnull, 'r+b')
+            try:
+                Popen(args, env=env, stdin=devnull, stdout=devnull, stderr=devnull,
+                      preexec_fn=os.setsid, **extra)
+            finally:
+                devnull.close()
+
+    def _wait_until_ready(self, ready_read):
+        try:
+            message = b''
+            try_until = time() + self.connection_timeout
+            while not message.endswith(b'\n'):
+                remaining = try_until - time()
+                if remaining <= 0 or not select.select([ready_read], [], [], remaining)[0]:
+                    break
+                data = os.read(ready_read, 4096)
+                if not data:
+                    break
+                message += data
+        finally:
+            os.close(ready_read)
+        message = message.decode('utf8', 'replace').strip()
+        if message != 'ok':
+            message = 'Papa failed to start - {0}'.format(message[7:] if message.startswith('Error: ') else message or 'it exited')
+            log.error(message)
+            raise utils.Error(message)
+
     def _attempt_to_connect(self):
         # Try to connect to an existing Papa
         sock = socket.socket(self.family, socket.SOCK_STREAM)
@@ -284,15 +483,27 @@ class Papa(object):
         sock.connect(self.location)
         return sock
 
-    def _send_command(self, command):
+    def _send_command(self, opcode, args=()):
+        if not self.connection:
+            self._connect()
+        self.connection.send_command(opcode, args)
+
+    def _do_command(self, opcode, args=(), parse=None):
         if not self.connection:
             self._connect()
-        self.connection.send_command(command)
+        result = self.connection.do_command(opcode, args)
+        return parse(result) if parse else result
 
-    def _do_command(self, command):
+    def _do_commands(self, commands):
         if not self.connection:
             self._connect()
-        return self.connection.do_command(command)
+        return self.connection.do_commands(commands)
+
+    def batch(self):
+        """Queue commands and send them all at once. Use it as a context
+        manager; every command returns a BatchResult that is filled in when
+        the block exits."""
+        return Batch(self)
 
     @staticmethod
     def _make_socket_dict(socket_info):
@@ -306,12 +517,23 @@ class Papa(object):
     def fileno(self):
         return self.connection.sock.fileno() if self.connection else None
 
-    def list_sockets(self, *args):
-        result = self._do_command(['l', 's'] + list(args))
+    @classmethod
+    def _make_socket_list(cls, result):
         if not result:
             return {}
         # noinspection PyTypeChecker
-        return dict(self._make_socket_dict(item) for item in result.split('\n'))
+        return dict(cls._make_socket_dict(item) for item in result.split('\n'))
+
+    @classmethod
+    def _make_socket_args(cls, result):
+        return cls._make_socket_dict(result)[1]
+
+    @staticmethod
+    def _make_true(result):
+        return True
+
+    def list_sockets(self, *args):
+        return self._do_command(protocol.LIST_SOCKETS, args, self._make_socket_list)
 
     def make_socket(self, name, host=None, port=None,
                     family=None, socket_type=None,
@@ -319,7 +541,7 @@ class Papa(object):
                     interface=None, reuseport=None):
         if not name:
             raise utils.Error('Socket requires a name')
-        command = ['m', 's', name]
+        command = [name]
         if family is not None:
             try:
                 family_name = utils.valid_families_by_number[family]
@@ -342,32 +564,118 @@ class Papa(object):
             append_if_not_none(command, host=host, port=port, interface=interface)
             if reuseport:
                 command.append('reuseport=1')
-        return self._make_socket_dict(self._do_command(command))[1]
+        return self._do_command(protocol.MAKE_SOCKET, command, self._make_socket_args)
 
     def remove_sockets(self, *args):
-        self._do_command(['r', 's'] + list(args))
-        return True
+        return self._do_command(protocol.REMOVE_SOCKETS, args, self._make_true)
 
-    def list_values(self, *args):
-        result = self._do_command(['l', 'v'] + list(args))
+    @staticmethod
+    def _make_value_list(result):
         if not result:
             return {}
         # noinspection PyTypeChecker
         return dict(item.partition(' ')[::2] for item in result.split('\n'))
 
-    def set(self, name, value=None):
-        command = ['set', name]
+    @staticmethod
+    def _make_value(result):
+        return result or None  # do it this way so that '' becomes None
+
+    @staticmethod
+    def _make_none(result):
+        return None
+
+    def list_values(self, *args):
+        return self._do_command(protocol.LIST_VALUES, args, self._make_value_list)
+
+    def set(self, name, value=None, ttl=None):
+        command = []
+        append_if_not_none(command, ttl=ttl)
+        command.append(name)
         if value:
             command.append(value)
-        self._do_command(command)
+        return self._do_command(protocol.SET, command, self._make_none)
 
     def get(self, name):
-        result = self._do_command(['get', name])
-        return result or None  # do it this way so that '' becomes None
+        return self._do_command(protocol.GET, [name], self._make_value)
 
     def remove_values(self, *args):
-        self._do_command(['r', 'v'] + list(args))
-        return True
+        return self._do_command(protocol.REMOVE_VALUES, args, self._make_true)
+
+    @staticmethod
+    def _make_flag(result):
+        return result == '1'
+
+    def incr(self, name, amount=1):
+        return self._do_command(protocol.INCR, [name, str(amount)], int)
+
+    def decr(self, name, amount=1):
+        return self._do_command(protocol.DECR, [name, str(amount)], int)
+
+    def cas(self, name, expected, value):
+        """Set the value only if it is currently `expected`. Pass `None` as
+        `expected` to require that the value is not set, or as `value` to
+        clear it. Returns True if the value was set."""
+        if expected is None:
+            if not value:
+                raise utils.Error('cas needs an expected value or a new value')
+            command = ['unset=1', name, value]
+        else:
+            command = [name, expected]
+            if value:
+                command.append(value)
+        return self._do_command(protocol.CAS, command, self._make_flag)
+
+    def setnx(self, name, value, ttl=None):
+        command = []
+        append_if_not_none(command, ttl=ttl)
+        command.extend((name, value))
+        return self._do_command(protocol.SETNX, command, self._make_flag)
+
+    def mget(self, *names):
+        def make_values(result):
+            found = self._make_value_list(result)
+            return dict((name, found.get(name)) for name in names)
+        return self._do_command(protocol.MGET, names, make_values)
+
+    def mset(self, values, ttl=None):
+        cleared = sorted(name for name, value in values.items() if not value)
+        command = ['clear={0}'.format(','.join(cleared))] if cleared else []
+        append_if_not_none(command, ttl=ttl)
+        for name, value in sorted(values.items()):
+            if value:
+                command.extend((name, value))
+        return self._do_command(protocol.MSET, command, self._make_none)
+
+    @staticmethod
+    def _make_name_list(result):
+        return result.split('\n') if result else []
+
+    def renew(self, *names, **options):
+        """Renew the lease of values that have a ttl. Pass `ttl` to change
+        it. Returns the names that were renewed, which leaves out any value
+        that has already expired."""
+        command = ['{0}={1}'.format(key, value) for key, value in sorted(options.items()) if value is not None]
+        command.extend(names)
+        return self._do_command(protocol.RENEW, command, self._make_name_list)
+
+    @staticmethod
+    def _make_changes(result):
+        lines = result.split('\n')
+        changes = {}
+        for line in lines[1:]:
+            name, version, value = (line.split(' ', 2) + [None])[:3]
+            changes[name] = (int(version), value)
+        return int(lines[0]), changes
+
+    def wait(self, *names, **options):
+        """Block until one of the named values changes after the version
+        passed as `since`, or `timeout` seconds pass. Names may end with a
+        wildcard. Returns the current version and a dict of the changed names
+        with their version and value, which is None if the value was
+        removed."""
+        command = ['{0}={1}'.format(key, value) for key, value in sorted(options.items()) if value is not None]
+        command.extend(names)
+        return self._do_command(protocol.WAIT, command, self._make_changes)
 
     @staticmethod
     def _make_process_dict(socket_info):
@@ -389,16 +697,26 @@ class Papa(object):
                 args[key] = value
         return name, args
 
-    def list_processes(self, *args):
-        result = self._do_command(['l', 'p'] + list(args))
+    @classmethod
+    def _make_process_list(cls, result):
         if not result:
             return {}
         # noinspection PyTypeChecker
-        return dict(self._make_process_dict(item) for item in result.split('\n'))
+        return dict(cls._make_process_dict(item) for item in result.split('\n'))
 
-    def make_process(self, name, executable=None, args=None, env=None, working_dir=None, uid=None, gid=None, rlimits=None, stdout=None, stderr=None, bufsize=None, watch_immediately=None):
-        command = ['m', 'p', name]
-        append_if_not_none(command, working_dir=working_dir, uid=uid, gid=gid, bufsize=bufsize)
+    @classmethod
+    def _make_process_args(cls, result):
+        return cls._make_process_dict(result)[1]
+
+    def list_processes(self, *args):
+        return self._do_command(protocol.LIST_PROCESSES, args, self._make_process_list)
+
+    def make_process(self, name, executable=None, args=None, env=None, working_dir=None, uid=None, gid=None, rlimits=None, stdout=None, stderr=None, bufsize=None, watch_immediately=None, zygote=None, count=None, after=None, ready=None):
+        command = [name]
+        append_if_not_none(command, working_dir=working_dir, uid=uid, gid=gid, bufsize=bufsize, count=count)
+        for key, names in (('zygote', zygote), ('after', after)):
+            if names:
+                command.append('{0}={1}'.format(key, names if isinstance(names, string_type) else ','.join(names)))
         if watch_immediately:
             command.append('watch=1')
         if bufsize != 0:
@@ -420,6 +738,9 @@ class Papa(object):
         if rlimits:
             for key, value in rlimits.items():
                 command.append('rlimit.{0}={1}'.format(key.lower(), value))
+        if ready:
+            for key, value in ready.items():
+                command.append('ready.{0}={1}'.format(key, wrap_trailing_slash(value)))
         if executable:
             command.append(executable)
         if args:
@@ -431,22 +752,67 @@ class Papa(object):
                 except TypeError:
                     command.append(str(args))
         if watch_immediately:
-            return self._do_watch(command)
-        return self._make_process_dict(self._do_command(command))[1]
+            return self._do_watch(protocol.MAKE_PROCESS, command)
+        if count:
+            return self._do_command(protocol.MAKE_PROCESS, command, self._make_process_list)
+        return self._do_command(protocol.MAKE_PROCESS, command, self._make_process_args)
 
     def remove_processes(self, *args):
-        self._do_command(['r', 'p'] + list(args))
-        return True
+        return self._do_command(protocol.REMOVE_PROCESSES, args, self._make_true)
+
+    def restart_processes(self, *args, **options):
+        """Replace the named processes with new ones, a batch at a time.
+        The options are batch, floor, signal and drain. Returns the new
+        processes."""
+        command = ['{0}={1}'.format(key, value) for key, value in sorted(options.items()) if value is not None]
+        command.extend(args)
+        return self._do_command(protocol.RESTART_PROCESSES, command, self._make_process_list)
 
     def watch_processes(self, *args):
-        return self._do_watch(['w', 'p'] + list(args))
+        return self._do_watch(protocol.WATCH_PROCESSES, args)
+
+    @staticmethod
+    def _make_apply_result(result):
+        import json
+        return json.loads(result)
+
+    def apply(self, manifest):
+        """Reconcile sockets, values and processes with a manifest in a
+        single request. The manifest is a dict (or a JSON string) with
+        'sockets', 'values', 'processes' and 'prune' keys. Returns a dict
+        of the action taken for each item."""
+        if not isinstance(manifest, string_type):
+            import json
+            manifest = json.dumps(manifest, separators=(',', ':'))
+        return self._do_command(protocol.APPLY, [manifest], self._make_apply_result)
+
+    @staticmethod
+    def _make_exiting(result):
+        return result.startswith('Exiting')
 
     def exit_if_idle(self):
-        return self._do_command('exit-if-idle').startswith('Exiting')
+        return self._do_command(protocol.EXIT_IF_IDLE, (), self._make_exiting)
+
+    def reexec(self):
+        """Replace the papa daemon with a fresh copy that keeps its sockets,
+        values, processes and output. The connection is closed, and the next
+        command connects to the new papa."""
+        result = self._do_command(protocol.REEXEC, (), self._make_reexecuting)
+        self.close()
+        return result
 
-    def _do_watch(self, command):
-        self._send_command(command)
-        self.connection.get_one_line_response()
+    @staticmethod
+    def _make_reexecuting(result):
+        return result.startswith('Re-executing')
+
+    def _do_watch(self, opcode, args):
+        self._send_command(opcode, args)
+        if self.connection.binary:
+            # do not read ahead, so that select() sees the first output
+            self.connection.get_binary_response(exact=True)
+        else:
+            self.connection.fill_line()
+            self.connection.get_one_line_response()
         watcher = Watcher(self)
         self.connection = None
         return watcher
@@ -475,6 +841,89 @@ class Papa(object):
         cls._default_connection_timeout = connection_timeout
 
 
+class BatchResult(object):
+    """The future result of a command queued in a Batch"""
+
+    def __init__(self, parse):
+        self.parse = parse
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def set_reply(self, reply, error):
+        if error is None:
+            try:
+                self.value = self.parse(reply) if self.parse else reply
+            except Exception as e:
+                error = e
+        self.error = error
+        self.done = True
+
+    @property
+    def result(self):
+        if not self.done:
+            raise utils.Error('The batch has not been sent yet')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Batch(Papa):
+    """Queues commands for a Papa connection and sends them in a single
+    write when the block exits, then reads the replies in order.
+
+    Every command method returns a BatchResult. If any command failed, the
+    first error is raised after all of the results have been filled in.
+    Processes cannot be watched in a batch.
+
+    Example:
+        with p.batch() as batch:
+            for i in range(400):
+                batch.set('node.{0}'.format(i), str(i))
+            pid = batch.make_process('worker', sys.executable, args='worker.py')
+        print(pid.result['pid'])
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, papa_object):
+        self.papa_object = papa_object
+        self.connection = None
+        self.t = None
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.send()
+
+    def _do_command(self, opcode, args=(), parse=None):
+        result = BatchResult(parse)
+        self.commands.append((opcode, list(args), result))
+        return result
+
+    def _do_watch(self, opcode, args):
+        raise utils.Error('Processes cannot be watched in a batch')
+
+    def send(self):
+        commands, self.commands = self.commands, []
+        if not commands:
+            return
+        replies = self.papa_object._do_commands([(opcode, args) for opcode, args, _ in commands])
+        first_error = None
+        for (_, _, result), (reply, error) in zip(commands, replies):
+            result.set_reply(reply, error)
+            if first_error is None:
+                first_error = result.error
+        if first_error is not None:
+            raise first_error
+
+    def close(self):
+        pass
+
+
 def set_debug_mode(mode=True, quit_when_connection_closed=False):
     return Papa.set_debug_mode(mode, quit_when_connection_closed)
 
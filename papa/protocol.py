@@ -0,0 +1,125 @@
+import struct
+from papa.utils import PY2
+
+__author__ = 'Scott Maxwell'
+
+# The binary protocol is negotiated by sending "binary 1" on a text
+# connection. Once the server has replied to that command, every request is
+# a REQUEST header followed by `count` arguments, each one a 4 byte length
+# and that many bytes, and every reply is a RESPONSE header followed by
+# `length` bytes of payload. All integers are in network byte order.
+VERSION = 1
+
+REQUEST = struct.Struct('!IIHH')  # length of the arguments, request id, opcode, count
+RESPONSE = struct.Struct('!IIB')  # length of the payload, request id, status
+ARG_LENGTH = struct.Struct('!I')
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+LIST_SOCKETS = 1
+MAKE_SOCKET = 2
+REMOVE_SOCKETS = 3
+LIST_PROCESSES = 4
+MAKE_PROCESS = 5
+REMOVE_PROCESSES = 6
+WATCH_PROCESSES = 7
+LIST_VALUES = 8
+SET = 9
+GET = 10
+REMOVE_VALUES = 11
+QUIT = 12
+EXIT_IF_IDLE = 13
+HELP = 14
+APPLY = 15
+RESTART_PROCESSES = 16
+REEXEC = 17
+INCR = 18
+DECR = 19
+CAS = 20
+SETNX = 21
+MGET = 22
+MSET = 23
+WAIT = 24
+RENEW = 25
+
+# the words of the equivalent text command for each opcode
+COMMANDS = {
+    LIST_SOCKETS: ('list', 'sockets'),
+    MAKE_SOCKET: ('make', 'socket'),
+    REMOVE_SOCKETS: ('remove', 'sockets'),
+    LIST_PROCESSES: ('list', 'processes'),
+    MAKE_PROCESS: ('make', 'process'),
+    REMOVE_PROCESSES: ('remove', 'processes'),
+    WATCH_PROCESSES: ('watch', 'processes'),
+    LIST_VALUES: ('list', 'values'),
+    SET: ('set',),
+    GET: ('get',),
+    REMOVE_VALUES: ('remove', 'values'),
+    QUIT: ('quit',),
+    EXIT_IF_IDLE: ('exit-if-idle',),
+    HELP: ('help',),
+    APPLY: ('apply',),
+    RESTART_PROCESSES: ('restart', 'processes'),
+    REEXEC: ('reexec',),
+    INCR: ('incr',),
+    DECR: ('decr',),
+    CAS: ('cas',),
+    SETNX: ('setnx',),
+    MGET: ('mget',),
+    MSET: ('mset',),
+    WAIT: ('wait',),
+    RENEW: ('renew',),
+}
+
+
+if PY2:
+    def encode(s):
+        # noinspection PyUnresolvedReferences
+        return s.encode('utf8') if isinstance(s, unicode) else str(s)
+
+    def decode(data):
+        # bytes() of a memoryview is its repr under Python 2
+        return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+else:
+    def encode(s):  # NOQA
+        """Encode a string so that decode() gives back exactly the same
+        bytes, even if they were not valid UTF-8"""
+        if isinstance(s, bytes):
+            return s
+        return str(s).encode('utf8', 'surrogateescape')
+
+    def decode(data):  # NOQA
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return bytes(data).decode('utf8', 'surrogateescape')
+
+
+def pack_request(request_id, opcode, args):
+    parts = []
+    for arg in args:
+        arg = encode(arg)
+        parts.append(ARG_LENGTH.pack(len(arg)))
+        parts.append(arg)
+    body = b''.join(parts)
+    return REQUEST.pack(len(body), request_id, opcode, len(args)) + body
+
+
+def unpack_args(data, count):
+    """Split the body of a request into its arguments"""
+    args = []
+    offset = 0
+    for _ in range(count):
+        size = ARG_LENGTH.unpack_from(data, offset)[0]
+        offset += ARG_LENGTH.size
+        if offset + size > len(data):
+            raise ValueError('Argument is longer than the request')
+        args.append(decode(data[offset:offset + size]))
+        offset += size
+    return args
+
+
+def pack_response(request_id, status, payload):
+    payload = encode(payload)
+    return RESPONSE.pack(len(payload), request_id, status) + payload
@@ -1,36 +1,37 @@
 import os
 import sys
+import errno
 import socket
-from threading import Thread, Lock
+from collections import deque
+from itertools import islice
+from threading import Lock
 import logging
-import resource
-import papa
-from papa.utils import Error, cast_bytes, cast_string, recv_with_retry, send_with_retry
-from papa.server import papa_socket, values, proc
+from papa import protocol
+from papa.utils import Error, cast_bytes, cast_string
+from papa.server import papa_socket, values, proc, manifest
+from papa.server.registry import Registry
+from papa.server.loop import EventLoop, Deferred
 import atexit
-try:
-    # noinspection PyPackageRequirements
-    from setproctitle import setproctitle
-except ImportError:
-    setproctitle = None
 
 __author__ = 'Scott Maxwell'
 
-try:
-    from argparse import ArgumentParser
-except ImportError:
-    from optparse import OptionParser
-
-    class ArgumentParser(OptionParser):
-        def add_argument(self, *args, **kwargs):
-            return self.add_option(*args, **kwargs)
-
-        # noinspection PyShadowingNames
-        def parse_args(self, args=None, values=None):
-            return OptionParser.parse_args(self, args, values)[0]
+# Everything a session needs is imported up front. The modules that only
+# the command line, reexec or setting the process title need are imported
+# when they are used.
 
 log = logging.getLogger('papa.server')
 
+RECV_SIZE = 65536
+MAX_LINE_LENGTH = 16777216
+HIGH_WATER_MARK = 4194304
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
 
 class CloseSocket(Exception):
     def __init__(self, final_message=None):
@@ -54,6 +55,42 @@ def exit_if_idle_command(sock, args, instance):
     raise CloseSocket('Exiting papa!\n> ')
 
 
+# noinspection PyUnusedLocal
+def reexec_command(sock, args, instance):
+    """Replace the papa daemon with a fresh copy of itself.
+
+Papa keeps its pid, sockets, values, processes and their output, and the new
+copy loads the papa package that is installed now. Every client session is
+closed, and clients can connect again as soon as the new copy is running.
+"""
+    from papa.server import reexec
+    instance_globals = instance['globals']
+    reexec.check(instance_globals)
+    session = instance['connection']
+    # clients waiting for values are not doing anything, so they can be cut off
+    if any(other.pending and not isinstance(other.pending, values.ValueWait) for other in session.server.sessions if other is not session):
+        raise Error('Wait until the commands of other clients have finished')
+    instance_globals['reexec'] = True
+    session.server.loop.stop()
+    raise CloseSocket('Re-executing papa\n')
+
+
+# noinspection PyUnusedLocal
+def binary_command(sock, args, instance):
+    """Switch this connection to the binary protocol after replying.
+
+Pass the protocol version the client speaks. The reply is the version the
+server will use. Clients use this to avoid escaping and prompt parsing.
+
+Example:
+    binary 1
+"""
+    if args and args[0] != str(protocol.VERSION):
+        raise Error('Unsupported protocol version {0}'.format(args[0]))
+    instance['connection'].upgrade_to_binary = True
+    return str(protocol.VERSION)
+
+
 # noinspection PyUnusedLocal
 def help_command(sock, args, instance):
     """Show help info"""
@@ -72,14 +109,25 @@ def help_command(sock, args, instance):
     remove processes - Stop recording the output of processes by name or PID
     list processes - List processes by name or PID
     watch processes - Start receiving the output of a processes by name or PID
+    restart processes - Replace processes with new ones, a batch at a time
     -----------------------------------------------------
     set - Set a named value
     get - Get a named value
+    incr, decr - Add to or subtract from a named integer value
+    cas - Set a named value if it has the expected value
+    setnx - Set a named value if it is not set yet
+    mget, mset - Get or set several named values at once
+    wait - Wait for named values to change
+    renew - Renew the lease of values that have a ttl
     list values - List values by name
     remove processes - Remove values by name
     -----------------------------------------------------
+    apply - Reconcile sockets, values and processes with a JSON manifest
+    -----------------------------------------------------
     quit - Close the client session
+    binary - Switch the client session to the binary protocol
     exit-if-idle Exit papa if there are no processes, sockets or values
+    reexec - Replace papa with a fresh copy that keeps everything
     help - Type "help <cmd>" for more information
 
 NOTE: All of these commands may be abbreviated. Type at least one character of
@@ -161,6 +209,13 @@ All commands can be abbreviated as much as you like, so the above can also be:
 """
 
 
+restart_doc = """
+Restart processes.
+
+Do 'help restart processes' for details.
+"""
+
+
 top_level_commands = {
     'list': {
         'sockets': papa_socket.sockets_command,
@@ -183,10 +238,25 @@ top_level_commands = {
         'processes': proc.watch_command,
         '__doc__': watch_doc
     },
+    'restart': {
+        'processes': proc.restart_command,
+        '__doc__': restart_doc
+    },
     'set': values.set_command,
     'get': values.get_command,
+    'incr': values.incr_command,
+    'decr': values.decr_command,
+    'cas': values.cas_command,
+    'setnx': values.setnx_command,
+    'mget': values.mget_command,
+    'mset': values.mset_command,
+    'wait': values.wait_command,
+    'renew': values.renew_command,
+    'apply': manifest.apply_command,
     'quit': quit_command,
+    'binary': binary_command,
     'exit-if-idle': exit_if_idle_command,
+    'reexec': reexec_command,
     'help': help_command,
 }
 
@@ -218,107 +288,407 @@ def lookup_command(args, commands=top_level_commands, primary_command=None, allo
 
 
 class ServerCommandConnection(object):
+    """Buffers the data received from a client and splits it into lines"""
+
     def __init__(self, sock):
         self.sock = sock
-        self.data = b''
+        self.data = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        if self.offset:
+            del self.data[:self.offset]
+            self.offset = 0
+        self.data += data
+
+    def read_request(self):
+        """Return the request id, opcode and arguments of the next binary
+        request, or None if it has not been completely received"""
+        available = len(self.data) - self.offset
+        if available < protocol.REQUEST.size:
+            return None
+        length, request_id, opcode, count = protocol.REQUEST.unpack_from(self.data, self.offset)
+        if length > MAX_LINE_LENGTH:
+            raise CloseSocket()
+        end = self.offset + protocol.REQUEST.size + length
+        if len(self.data) < end:
+            return None
+        try:
+            args = protocol.unpack_args(memoryview(self.data)[end - length:end], count)
+        except Exception:
+            raise CloseSocket()
+        self.offset = end
+        return request_id, opcode, args
 
     def readline(self):
-        while not b'\n' in self.data:
-            new_data = recv_with_retry(self.sock)
-            if not new_data:
-                raise socket.error('done')
-            self.data += new_data
-
-        one_line, self.data = self.data.partition(b'\n')[::2]
+        end = self.data.find(b'\n', self.offset)
+        if end == -1:
+            if len(self.data) - self.offset > MAX_LINE_LENGTH:
+                raise CloseSocket('Error: Command is too long\n')
+            return None
+        one_line = bytes(self.data[self.offset:end])
+        self.offset = end + 1
         return cast_string(one_line).strip()
 
 
-def chat_with_a_client(sock, addr, instance_globals, container):
-    connection = ServerCommandConnection(sock)
-    instance = {'globals': instance_globals, 'connection': connection}
-    try:
-        sock.send(b'Papa is home. Type "help" for commands.\n> ')
+def split_command_line(one_line):
+    args = []
+    acc = ''
+    for arg in one_line.split(' '):
+        if arg:
+            if arg[-1] == '\\':
+                acc += arg[:-1] + ' '
+            else:
+                acc += arg
+                args.append(acc.strip())
+                acc = ''
+    if acc:
+        args.append(acc)
+    return args
 
-        while True:
-            one_line = connection.readline()
-            args = []
-            acc = ''
-            if one_line:
-                for arg in one_line.split(' '):
-                    if arg:
-                        if arg[-1] == '\\':
-                            acc += arg[:-1] + ' '
-                        else:
-                            acc += arg
-                            args.append(acc.strip())
-                            acc = ''
-                if acc:
-                    args.append(acc)
-
-                try:
-                    command = lookup_command(args)
-                except Error as e:
-                    reply = 'Error: {0}\n'.format(e)
-                else:
-                    try:
-                        reply = command(sock, args, instance) or '\n'
-                    except CloseSocket as e:
-                        if e.final_message:
-                            send_with_retry(sock, cast_bytes(e.final_message))
-                        break
-                    except papa.utils.Error as e:
-                        reply = 'Error: {0}\n'.format(e)
-                    except Exception as e:
-                        reply = 'Error: {0}\n'.format(e)
 
-                if reply[-1] != '\n':
-                    reply += '\n> '
+class ClientSession(object):
+    """One client connection to the control server.
+
+    All I/O is non-blocking and driven by the server event loop. Outgoing
+    data is queued and flushed as the socket becomes writable, and reading
+    pauses while too much output is waiting so each session uses a bounded
+    amount of memory."""
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.loop = server.loop
+        self.sock = sock
+        self.addr = addr
+        self.fileno = sock.fileno()
+        self.connection = ServerCommandConnection(sock)
+        self.instance = {'globals': server.instance_globals, 'connection': self}
+        self.outgoing = deque()
+        self.outgoing_size = 0
+        self.watch = None
+        self.pending = None
+        self.binary = False
+        self.upgrade_to_binary = False
+        self.request_id = 0
+        self.reading = False
+        self.closing = False
+        self.closed = False
+
+    def start(self):
+        self.sock.setblocking(False)
+        self._resume_reading()
+        self.send(b'Papa is home. Type "help" for commands.\n> ')
+
+    def _resume_reading(self):
+        if not self.reading and not self.closed:
+            self.reading = True
+            self.loop.add_reader(self.fileno, self.on_readable)
+
+    def _pause_reading(self):
+        if self.reading:
+            self.reading = False
+            self.loop.remove_reader(self.fileno)
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.errno in WOULD_BLOCK:
+                return
+            data = None
+        if not data:
+            self.close()
+            return
+        self.connection.feed(data)
+        self.process()
+
+    def process(self):
+        connection = self.connection
+        try:
+            while not self.closing and not self.closed:
+                if self.pending:
+                    # requests are answered in order, so wait for the reply
+                    break
+                if self.outgoing_size > HIGH_WATER_MARK:
+                    self._pause_reading()
+                    break
+                if self.watch:
+                    if not self.watch.waiting_for_ack:
+                        break
+                    one_line = connection.readline()
+                    if one_line is None:
+                        break
+                    final_message = self.watch.acknowledge(one_line)
+                    if final_message is not None:
+                        self.watch = None
+                        # the watcher expects the end of the watch in text
+                        self.reply_text(final_message)
+                    continue
+                if self.binary:
+                    request = connection.read_request()
+                    if request is None:
+                        break
+                    self.handle_request(*request)
+                    continue
+                one_line = connection.readline()
+                if one_line is None:
+                    break
+                self.handle_line(one_line)
+        except CloseSocket as e:
+            self.closing = True
+            if e.final_message:
+                if self.binary:
+                    self.reply(e.final_message)
                 else:
-                    reply += '> '
-                reply = cast_bytes(reply)
+                    self.send(cast_bytes(e.final_message))
             else:
-                reply = b'> '
-            send_with_retry(sock, reply)
-    except socket.error:
-        pass
+                self.flush()
 
-    try:
-        sock.close()
-    except socket.error:
-        pass
+    def handle_line(self, one_line):
+        if not one_line:
+            self.send(b'> ')
+            return
+        args = split_command_line(one_line)
+        try:
+            command = lookup_command(args)
+        except Error as e:
+            self.reply('Error: {0}\n'.format(e))
+        else:
+            self.run_command(command, args)
+
+    def handle_request(self, request_id, opcode, args):
+        self.request_id = request_id
+        try:
+            command = lookup_command(list(protocol.COMMANDS[opcode]))
+        except KeyError:
+            self.reply('Error: Unknown opcode {0}\n'.format(opcode))
+        else:
+            self.run_command(command, args)
+
+    def run_command(self, command, args):
+        try:
+            reply = command(self.sock, args, self.instance) or '\n'
+        except CloseSocket:
+            raise
+        except Exception as e:
+            reply = 'Error: {0}\n'.format(e)
+
+        if isinstance(reply, Deferred):
+            self.pending = reply
+            reply.start(self.loop, self._deferred_done)
+        else:
+            self._send_result(reply)
+
+    def _deferred_done(self, result):
+        self.pending = None
+        if self.closed:
+            return
+        if isinstance(result, Exception):
+            result = 'Error: {0}\n'.format(result)
+        self._send_result(result or '\n')
+        self.process()
+
+    def _send_result(self, reply):
+        if isinstance(reply, proc.WatchSession):
+            if self.binary:
+                # the header is the reply to the request, then the output
+                # follows in the same format as on a text connection
+                self.reply(reply.header)
+                reply.header = None
+            self.watch = reply
+            reply.start(self)
+        else:
+            self.reply(reply)
+
+    def reply(self, reply):
+        if self.binary:
+            status = protocol.STATUS_OK
+            if reply.startswith('Error: '):
+                status = protocol.STATUS_ERROR
+                reply = reply[7:]
+            if reply.endswith('\n> '):
+                reply = reply[:-3]
+            elif reply.endswith('\n'):
+                reply = reply[:-1]
+            self.send(protocol.pack_response(self.request_id, status, reply))
+        else:
+            self.reply_text(reply)
+
+    def reply_text(self, reply):
+        if reply[-1] != '\n':
+            reply += '\n> '
+        else:
+            reply += '> '
+        self.send(protocol.encode(reply))
+        if self.upgrade_to_binary:
+            self.upgrade_to_binary = False
+            self.binary = True
+
+    def send(self, data):
+        if self.closed:
+            return
+        self.outgoing.append(data)
+        self.outgoing_size += len(data)
+        self.flush()
+
+    def send_buffers(self, buffers):
+        """Queue a list of bytes-like objects, such as memoryviews of process
+        output, without joining them"""
+        if self.closed:
+            return
+        self.outgoing.extend(buffers)
+        self.outgoing_size += sum(len(buf) for buf in buffers)
+        self.flush()
+
+    def flush(self):
+        outgoing = self.outgoing
+        sendmsg = getattr(self.sock, 'sendmsg', None)
+        while outgoing:
+            try:
+                if sendmsg and len(outgoing) > 1:
+                    sent = sendmsg(list(islice(outgoing, IOV_MAX)))
+                else:
+                    sent = self.sock.send(outgoing[0])
+            except socket.error as e:
+                if e.errno in WOULD_BLOCK:
+                    break
+                self.close()
+                return
+            self.outgoing_size -= sent
+            while outgoing and sent >= len(outgoing[0]):
+                sent -= len(outgoing.popleft())
+            if sent:
+                # keep a view of the rest, so that nothing is copied
+                outgoing[0] = memoryview(outgoing[0])[sent:]
+                break
+        if outgoing:
+            self.loop.add_writer(self.fileno, self.flush)
+        else:
+            self.loop.remove_writer(self.fileno)
+            if self.closing:
+                self.close()
+            elif not self.reading:
+                self._resume_reading()
+                self.process()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.watch:
+            self.watch.cancel()
+            self.watch = None
+        self.loop.remove_reader(self.fileno)
+        self.loop.remove_writer(self.fileno)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        self.server.session_closed(self)
+
+
+class ControlServer(object):
+    """Accepts client connections and runs every client session on a single
+    event loop."""
+
+    def __init__(self, listen_socket, instance_globals, single_socket_mode=False):
+        self.loop = EventLoop()
+        self.listen_socket = listen_socket
+        self.instance_globals = instance_globals
+        self.single_socket_mode = single_socket_mode
+        self.sessions = set()
+        instance_globals['loop'] = self.loop
+        values.start_expiry(instance_globals)
+        listen_socket.setblocking(False)
+        self.loop.add_reader(listen_socket.fileno(), self.on_accept)
+
+    def on_accept(self):
+        while True:
+            try:
+                sock, addr = self.listen_socket.accept()
+            except socket.error as e:
+                if e.errno not in WOULD_BLOCK:
+                    log.error('Accept failed: %s', e)
+                return
+            log.info('Started client session with %s', addr)
+            self.instance_globals['exit_if_idle'] = False
+            session = ClientSession(self, sock, addr)
+            self.sessions.add(session)
+            session.start()
+
+    def session_closed(self, session):
+        self.sessions.discard(session)
+        log.info('Closed client session with %s', session.addr)
+        if not self.sessions:
+            if self.single_socket_mode:
+                self.loop.stop()
+            elif self.instance_globals['exit_if_idle'] and is_idle(self.instance_globals):
+                log.info('Exiting due to exit_if_idle request')
+                self.loop.stop()
 
-    if container:
-        thread_object = container[0]
-        instance_globals['active_threads'].remove(thread_object)
-        instance_globals['inactive_threads'].append((addr, thread_object))
+    def run(self):
+        try:
+            self.loop.run()
+        finally:
+            for session in list(self.sessions):
+                session.close()
+            self.loop.close()
 
 
 def cleanup(instance_globals):
-    if 'lock' in instance_globals:
+    if 'processes_lock' in instance_globals:
         papa_socket.cleanup(instance_globals)
+        proc.cleanup(instance_globals)
 
 
 def is_idle(instance_globals):
-    with instance_globals['lock']:
-        return not instance_globals['processes']\
-               and not instance_globals['sockets']['by_name']\
-               and not instance_globals['sockets']['by_path']\
-               and not instance_globals['values']
-
-
-def socket_server(port_or_path, single_socket_mode=False):
-    instance_globals = {
-        'processes': {},
-        'sockets': {'by_name': {}, 'by_path': {}},
-        'values': {},
-        'active_threads': [],
-        'inactive_threads': [],
-        'lock': Lock(),
+    with instance_globals['processes_lock']:
+        if instance_globals['processes'] or instance_globals.get('starting'):
+            return False
+    with instance_globals['sockets_lock']:
+        if instance_globals['sockets']['by_name'] or instance_globals['sockets']['by_path']:
+            return False
+    with instance_globals['values_lock']:
+        return not instance_globals['values']
+
+
+def make_instance_globals(daemon=False):
+    return {
+        'processes': Registry(),
+        'sockets': {'by_name': Registry(), 'by_path': {}},
+        'values': Registry(),
+        # every change to a value gets the next version, and 'wait' tells
+        # clients about the changes after the version they last saw
+        'values_version': 0,
+        'value_versions': Registry(),
+        'value_waiters': set(),
+        'value_expiry': values.Expiry(),
+        'starting': {},
+        'zygotes': {},
+        # each registry has its own lock, so that reading a value never waits
+        # on a client that is starting processes or making sockets. Code that
+        # needs more than one takes them in this order.
+        'processes_lock': Lock(),
+        'sockets_lock': Lock(),
+        'values_lock': Lock(),
         'exit_if_idle': False,
+        # papa can only re-execute itself when it has a process of its own
+        'daemon': daemon,
     }
-    def local_cleanup():
-        cleanup(instance_globals)
-    atexit.register(local_cleanup)
+
+
+def report_ready(ready_fd, message):
+    """Tell whoever started papa that it is listening, or why it is not"""
+    if ready_fd is not None:
+        try:
+            os.write(ready_fd, cast_bytes(message))
+            os.close(ready_fd)
+        except OSError:
+            pass
+
+
+def socket_server(port_or_path, single_socket_mode=False, daemon=False, ready_fd=None):
+    instance_globals = make_instance_globals(daemon)
     try:
         if isinstance(port_or_path, str):
             try:
@@ -341,90 +711,168 @@ def socket_server(port_or_path, single_socket_mode=False):
                 raise Error('Bind failed or port {0}: {1}'.format(port_or_path, e))
     except Exception as e:
         log.exception(e)
+        report_ready(ready_fd, 'Error: {0}\n'.format(e))
         sys.exit(1)
 
-    s.listen(5)
+    s.listen(socket.SOMAXCONN)
     log.info('Listening')
-    while True:
-        try:
-            sock, addr = s.accept()
-            log.info('Started client session with %s', addr)
-            container = []
-            instance_globals['exit_if_idle'] = False
-            t = Thread(target=chat_with_a_client, args=(sock, addr, instance_globals, container))
-            container.append(t)
-            instance_globals['active_threads'].append(t)
-            t.daemon = True
-            t.start()
-            s.settimeout(.5)
-        except socket.timeout:
-            pass
-        while instance_globals['inactive_threads']:
-            addr, t = instance_globals['inactive_threads'].pop()
-            t.join()
-            log.info('Closed client session with %s', addr)
-        if not instance_globals['active_threads']:
-            if single_socket_mode:
-                break
-            if instance_globals['exit_if_idle'] and is_idle(instance_globals):
-                log.info('Exiting due to exit_if_idle request')
-                break
-            s.settimeout(None)
+    report_ready(ready_fd, 'ok\n')
+    serve(s, instance_globals, single_socket_mode)
+
+
+def restore_server(state_fd):
+    """Run a papa daemon that has just re-executed itself"""
+    from papa.server import reexec
+    instance_globals = make_instance_globals(daemon=True)
+    try:
+        s = reexec.restore(state_fd, instance_globals)
+    except Exception as e:
+        log.exception(e)
+        sys.exit(1)
+    serve(s, instance_globals)
+
+
+def serve(s, instance_globals, single_socket_mode=False):
+    def local_cleanup():
+        cleanup(instance_globals)
+    atexit.register(local_cleanup)
+    ControlServer(s, instance_globals, single_socket_mode).run()
+    while instance_globals.pop('reexec', False):
+        from papa.server import reexec
+        # only returns if the exec failed, so carry on serving
+        reexec.reexec(s, instance_globals)
+        ControlServer(s, instance_globals, single_socket_mode).run()
     s.close()
     papa_socket.cleanup(instance_globals)
+    proc.cleanup(instance_globals)
     try:
         # noinspection PyUnresolvedReferences
         atexit.unregister(local_cleanup)
     except AttributeError:
-        del instance_globals['lock']
+        del instance_globals['processes_lock']
 
 
-def daemonize_server(port_or_path, fix_title=False):
-    process_id = os.fork()
-    if process_id < 0:
-        raise Error('Unable to fork')
-    elif process_id != 0:
+def _close_range(low, high):
+    """Close every fd from low to high with a single close_range call.
+    Returns False if the system cannot do that."""
+    try:
+        import ctypes
+        close_range = ctypes.CDLL(None, use_errno=True).close_range
+    except (ImportError, OSError, AttributeError):
+        return False
+    close_range.argtypes = (ctypes.c_uint, ctypes.c_uint, ctypes.c_int)
+    return close_range(low, high, 0) == 0
+
+
+def close_inherited_fds(keep=()):
+    """Close every fd above stderr except the ones in keep. RLIMIT_NOFILE
+    can be over a million, so rather than trying every number this uses
+    close_range, or closes only the fds listed in /proc/self/fd."""
+    keep = sorted(set(fd for fd in keep if fd > 2))
+    low = 3
+    for fd in keep + [0xffffffff]:
+        if fd > low and not _close_range(low, fd - 1):
+            break
+        low = fd + 1
+    else:
         return
-
-    # noinspection PyNoneFunctionAssignment,PyArgumentList
-    process_id = os.setsid()
-    if process_id == -1:
-        sys.exit(1)
-
-    for fd in range(3, resource.getrlimit(resource.RLIMIT_NOFILE)[0]):
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
         try:
-            os.close(fd)
-        except OSError:
+            fds = [int(fd) for fd in os.listdir(fd_dir)]
+            break
+        except (OSError, ValueError):
             pass
+    else:
+        import resource
+        fds = range(3, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
 
+def detach(keep_fds=()):
+    """Do what a daemon does once it is in a session of its own"""
+    close_inherited_fds(keep_fds)
     devnull = os.devnull if hasattr(os, 'devnull') else '/dev/null'
     devnull_fd = os.open(devnull, os.O_RDWR)
     for fd in range(3):
         # noinspection PyTypeChecker
         os.dup2(devnull_fd, fd)
+    if devnull_fd > 2:
+        os.close(devnull_fd)
 
     os.umask(0o27)
     os.chdir('/')
-    if fix_title and setproctitle is not None:
-        # noinspection PyCallingNonCallable
-        setproctitle('papa daemon from %s' % os.path.basename(sys.argv[0]))
-    socket_server(port_or_path)
+
+
+def set_title(title):
+    try:
+        # noinspection PyPackageRequirements
+        from setproctitle import setproctitle
+    except ImportError:
+        return
+    setproctitle(title)
+
+
+def argument_parser(*args, **kwargs):
+    try:
+        from argparse import ArgumentParser
+    except ImportError:
+        from optparse import OptionParser
+
+        class ArgumentParser(OptionParser):
+            def add_argument(self, *args, **kwargs):
+                return self.add_option(*args, **kwargs)
+
+            # noinspection PyShadowingNames
+            def parse_args(self, args=None, values=None):
+                return OptionParser.parse_args(self, args, values)[0]
+
+    return ArgumentParser(*args, **kwargs)
+
+
+def daemonize_server(port_or_path, fix_title=False):
+    process_id = os.fork()
+    if process_id < 0:
+        raise Error('Unable to fork')
+    elif process_id != 0:
+        return
+
+    # noinspection PyNoneFunctionAssignment,PyArgumentList
+    process_id = os.setsid()
+    if process_id == -1:
+        sys.exit(1)
+
+    detach()
+    if fix_title:
+        set_title('papa daemon from %s' % os.path.basename(sys.argv[0]))
+    socket_server(port_or_path, daemon=True)
 
 
 def main():
-    parser = ArgumentParser('papa', description='A simple parent process for sockets and other processes')
+    parser = argument_parser('papa', description='A simple parent process for sockets and other processes')
     parser.add_argument('-d', '--debug', action='store_true', help='run in debug mode')
     parser.add_argument('-u', '--unix-socket', help='path to unix socket to bind')
     parser.add_argument('-p', '--port', default=20202, type=int, help='port to bind on localhost (default 20202)')
     parser.add_argument('--daemonize', action='store_true', help='daemonize the papa server')
+    parser.add_argument('--detached', action='store_true', help='finish detaching a server that was started in a new session')
+    parser.add_argument('--ready-fd', type=int, help='write "ok" to this fd once the server is listening')
+    parser.add_argument('--title', help='the process title to show')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO if args.debug else logging.ERROR)
+    if args.title:
+        set_title(args.title)
     if args.daemonize:
         daemonize_server(args.unix_socket or args.port)
     else:
+        if args.detached:
+            detach([] if args.ready_fd is None else [args.ready_fd])
         try:
-            socket_server(args.unix_socket or args.port)
+            socket_server(args.unix_socket or args.port, daemon=True, ready_fd=args.ready_fd)
         except Exception as e:
             log.exception(e)
 
@@ -0,0 +1,5 @@
+from papa.server import main
+
+__author__ = 'Scott Maxwell'
+
+main()
@@ -0,0 +1,305 @@
+import os
+import errno
+import fcntl
+import select
+import logging
+from heapq import heappush, heappop
+from threading import Thread, Lock
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+__author__ = 'Scott Maxwell'
+
+log = logging.getLogger('papa.server')
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+if selectors is not None:
+    class _Selector(object):
+        def __init__(self):
+            self.selector = selectors.DefaultSelector()
+
+        def register(self, fd, events):
+            self.selector.register(fd, events)
+
+        def modify(self, fd, events):
+            self.selector.modify(fd, events)
+
+        def unregister(self, fd):
+            self.selector.unregister(fd)
+
+        def select(self, timeout):
+            return [(key.fd, events) for key, events in self.selector.select(timeout)]
+
+        def close(self):
+            self.selector.close()
+
+else:
+    class _Selector(object):
+        def __init__(self):
+            self.fds = {}
+
+        def register(self, fd, events):
+            self.fds[fd] = events
+
+        modify = register
+
+        def unregister(self, fd):
+            del self.fds[fd]
+
+        def select(self, timeout):
+            readers = [fd for fd, events in self.fds.items() if events & EVENT_READ]
+            writers = [fd for fd, events in self.fds.items() if events & EVENT_WRITE]
+            try:
+                readers, writers = select.select(readers, writers, [], timeout)[:2]
+            except (OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+            ready = dict((fd, EVENT_READ) for fd in readers)
+            for fd in writers:
+                ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+            return list(ready.items())
+
+        def close(self):
+            self.fds = {}
+
+
+class Timer(object):
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Deferred(object):
+    """The reply to a command that has to wait for something, such as a
+    process becoming ready. The command returns a Deferred instead of its
+    reply, and the session stops reading requests until the function,
+    which runs on its own thread, returns the reply or raises an Error."""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def start(self, loop, callback):
+        t = Thread(target=self._run, args=(loop, callback), name='papa-deferred')
+        t.daemon = True
+        t.start()
+
+    def _run(self, loop, callback):
+        try:
+            result = self.function(*self.args)
+        except Exception as e:
+            result = e
+        loop.call_soon_threadsafe(callback, result)
+
+
+class EventLoop(object):
+    """A minimal single-threaded reactor built on the best selector available
+    (epoll, kqueue or poll). Callbacks may be scheduled from other threads
+    with call_soon_threadsafe."""
+
+    def __init__(self):
+        self.selector = _Selector()
+        self.running = False
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._pending = []
+        self._pending_lock = Lock()
+        self._wakeup_pending = False
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            set_nonblocking(fd)
+            # Python 2 pipes are inherited, even by a re-executed papa
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.add_reader(self._wakeup_read, self._drain_wakeup)
+
+    def _update(self, fd):
+        events = (EVENT_READ if fd in self._readers else 0) | (EVENT_WRITE if fd in self._writers else 0)
+        try:
+            if events:
+                try:
+                    self.selector.modify(fd, events)
+                except KeyError:
+                    self.selector.register(fd, events)
+            else:
+                self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        if self._writers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(monotonic() + delay, callback, args)
+        heappush(self._timers, timer)
+        return timer
+
+    def call_soon(self, callback, *args):
+        with self._pending_lock:
+            self._pending.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self._pending_lock:
+            self._pending.append((callback, args))
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except OSError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except OSError:
+            pass
+
+    def _run_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+            self._wakeup_pending = False
+        for callback, args in pending:
+            self._call(callback, args)
+
+    def _run_timers(self):
+        timers = self._timers
+        now = monotonic()
+        while timers and timers[0].when <= now:
+            timer = heappop(timers)
+            if not timer.cancelled:
+                self._call(timer.callback, timer.args)
+
+    @staticmethod
+    def _call(callback, args):
+        try:
+            callback(*args)
+        except Exception as e:
+            log.exception(e)
+
+    def _timeout(self):
+        if self._pending:
+            return 0
+        timers = self._timers
+        while timers and timers[0].cancelled:
+            heappop(timers)
+        if timers:
+            return max(0, timers[0].when - monotonic())
+        return None
+
+    def run_once(self):
+        for fd, events in self.selector.select(self._timeout()):
+            if events & EVENT_READ:
+                callback = self._readers.get(fd)
+                if callback:
+                    self._call(callback, ())
+            if events & EVENT_WRITE:
+                callback = self._writers.get(fd)
+                if callback:
+                    self._call(callback, ())
+        self._run_timers()
+        self._run_pending()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+        self.call_soon_threadsafe(lambda: None)
+
+    def close(self):
+        self.selector.close()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+_reactor = None
+_reactor_thread = None
+_reactor_lock = Lock()
+
+
+def get_reactor():
+    """Return the background loop shared by everything that is not tied to a
+    client session, such as the output pipes of child processes. Its thread
+    is started on first use."""
+    global _reactor
+    if _reactor is None:
+        with _reactor_lock:
+            if _reactor is None:
+                _reactor = EventLoop()
+                _start_reactor_thread()
+    return _reactor
+
+
+def _start_reactor_thread():
+    # called with _reactor_lock held
+    global _reactor_thread
+    t = Thread(target=_reactor.run, name='papa-reactor')
+    t.daemon = True
+    t.start()
+    _reactor_thread = t
+
+
+def stop_reactor():
+    """Stop the background loop and wait for its thread to finish, so that
+    nothing reads the output pipes of child processes any more. The loop
+    keeps its readers and timers, so resume_reactor can carry on with it."""
+    global _reactor_thread
+    with _reactor_lock:
+        thread, _reactor_thread = _reactor_thread, None
+    if thread is not None:
+        _reactor.stop()
+        thread.join()
+
+
+def resume_reactor():
+    """Run the background loop again after stop_reactor"""
+    with _reactor_lock:
+        if _reactor is not None and _reactor_thread is None:
+            _start_reactor_thread()
+
+
+def set_nonblocking(fd):
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
@@ -0,0 +1,209 @@
+import json
+import logging
+from papa import utils, Error
+from papa.utils import wildcard_iter
+from papa.server.papa_socket import PapaSocket
+from papa.server import values as values_module
+from papa.server.loop import Deferred
+from papa.server.proc import Process, convert_rlimits, start_processes, check_for_cycles
+
+__author__ = 'Scott Maxwell'
+
+log = logging.getLogger('papa.server')
+
+PROCESS_OPTIONS = ('working_dir', 'uid', 'gid', 'stdout', 'stderr', 'bufsize')
+
+
+def _make_socket(name, options, instance):
+    if not isinstance(options, dict):
+        raise Error('Socket options must be an object')
+    return PapaSocket(name, instance, **dict((str(key), value) for key, value in options.items()))
+
+
+def _make_process(name, options, instance):
+    if not isinstance(options, dict):
+        raise Error('Process options must be an object')
+    unknown = set(options) - set(PROCESS_OPTIONS) - set(('args', 'env', 'rlimits', 'zygote', 'after', 'ready'))
+    if unknown:
+        raise Error('Unknown process options: {0}'.format(', '.join(sorted(unknown))))
+    args = options.get('args')
+    if not args:
+        raise Error('Process requires args')
+    if isinstance(args, utils.string_type):
+        args = [args]
+    args = [str(arg) for arg in args]
+    env = dict((str(key), str(value)) for key, value in (options.get('env') or {}).items())
+    rlimits = convert_rlimits(options.get('rlimits') or {})
+    kwargs = dict((key, str(options[key])) for key in PROCESS_OPTIONS if options.get(key) is not None)
+    for key in ('zygote', 'after'):
+        names = options.get(key)
+        if names:
+            kwargs[key] = names if isinstance(names, utils.string_type) else ','.join(str(name) for name in names)
+    ready = options.get('ready') or {}
+    if not isinstance(ready, dict):
+        raise Error('Process ready conditions must be an object')
+    ready = dict((str(key), str(value)) for key, value in ready.items())
+    return Process(name, args, env, rlimits, instance, ready=ready, **kwargs)
+
+
+def _apply_sockets(desired, sockets, results):
+    for name, p in desired.items():
+        existing = sockets.get(name)
+        try:
+            if existing is None:
+                action = 'created'
+            elif p == existing:
+                action = 'kept'
+            else:
+                existing.close()
+                action = 'replaced'
+            results[name] = {'action': action, 'info': str(p.start())}
+        except Exception as e:
+            results[name] = {'action': 'error', 'error': str(e)}
+
+
+def _apply_values(desired, instance_globals, results):
+    values = instance_globals['values']
+    for name, value in desired.items():
+        existing = values.get(name)
+        if value is None or value == '':
+            if existing is not None:
+                values_module.store(instance_globals, name, None)
+                results[name] = {'action': 'removed'}
+            continue
+        value = str(value)
+        if existing == value:
+            action = 'kept'
+        else:
+            action = 'created' if existing is None else 'replaced'
+            values_module.store(instance_globals, name, value)
+        results[name] = {'action': action, 'info': value}
+
+
+def _plan_processes(desired, processes, results):
+    """Decide what to do with each process while holding the lock. Returns
+    the processes to start and the action for each one."""
+    planned = []
+    for name, p in desired.items():
+        existing = processes.get(name)
+        try:
+            if existing is None:
+                action = 'created'
+            elif p == existing:
+                action = 'kept'
+            elif not existing.running:
+                # papa never stops a process, but one that has exited can be
+                # replaced by a new definition
+                existing.close_output()
+                processes.pop(name, None)
+                action = 'replaced'
+            else:
+                raise Error('Process for {0} is already running with different options - {1}'.format(name, str(existing)))
+            planned.append((p, action))
+        except Exception as e:
+            results[name] = {'action': 'error', 'error': str(e)}
+    return planned
+
+
+def _start_processes(planned, results):
+    outcomes = start_processes([p for p, _ in planned])
+    for (p, action), outcome in zip(planned, outcomes):
+        if isinstance(outcome, Exception):
+            results[p.name] = {'action': 'error', 'error': str(outcome)}
+        else:
+            results[p.name] = {'action': action, 'info': str(outcome)}
+
+
+def _prune(patterns, manifest, instance_globals, results):
+    with instance_globals['processes_lock']:
+        processes = instance_globals['processes']
+        for name, p in list(wildcard_iter(processes, patterns)):
+            if name not in manifest.get('processes', {}):
+                p.close_output()
+                results['processes'][name] = {'action': 'removed'}
+    with instance_globals['sockets_lock']:
+        sockets = instance_globals['sockets']['by_name']
+        for name, p in list(wildcard_iter(sockets, patterns)):
+            if name not in manifest.get('sockets', {}):
+                p.close()
+                results['sockets'][name] = {'action': 'removed'}
+    with instance_globals['values_lock']:
+        values = instance_globals['values']
+        for name, _ in list(wildcard_iter(values, patterns)):
+            if name not in manifest.get('values', {}):
+                values_module.store(instance_globals, name, None)
+                results['values'][name] = {'action': 'removed'}
+        values_module.changed(instance_globals)
+
+
+# noinspection PyUnusedLocal
+def apply_command(sock, args, instance):
+    """Reconcile sockets, values and processes with a JSON manifest.
+
+The manifest is an object with any of these keys:
+    sockets - an object of socket names and their options, as in 'make socket'
+    values - an object of value names and values. A null or empty value
+             removes the value
+    processes - an object of process names and their options. Use 'args' for
+                the command and its arguments, 'env', 'rlimits' and 'ready'
+                for objects of environment variables, rlimits and ready
+                conditions, and the options of 'make process' for
+                everything else
+    prune - a list of names, including wildcards. Any socket, value or process
+            that matches but is not in the manifest is removed
+
+Sockets and values are each applied while holding their own lock. Processes are
+then spawned outside of any lock, several at a time, each one as soon as the
+processes in its 'after' list are ready. Items that already match are kept.
+Sockets and values with different options are replaced. A process can only be
+replaced once it has exited. The reply is a JSON object with the action taken
+for each item, which is one of created, kept, replaced, removed or error.
+
+Example:
+    apply {"sockets": {"web": {"port": 8080}}, "values": {"web.workers": "4"}, "prune": ["web.*"]}
+"""
+    if not args:
+        raise Error('apply requires a manifest')
+    try:
+        manifest = json.loads(' '.join(args))
+    except ValueError as e:
+        raise Error('Invalid manifest: {0}'.format(e))
+    if not isinstance(manifest, dict):
+        raise Error('The manifest must be an object')
+    unknown = set(manifest) - set(('sockets', 'values', 'processes', 'prune'))
+    if unknown:
+        raise Error('Unknown manifest keys: {0}'.format(', '.join(sorted(unknown))))
+    prune = manifest.get('prune') or []
+    if isinstance(prune, utils.string_type):
+        prune = [prune]
+    if '*' in prune:
+        raise Error('You cannot prune everything')
+
+    # everything that can fail without touching papa's state is done before
+    # taking the lock
+    sockets = dict((name, _make_socket(name, options, instance)) for name, options in (manifest.get('sockets') or {}).items())
+    processes = dict((name, _make_process(name, options, instance)) for name, options in (manifest.get('processes') or {}).items())
+    check_for_cycles(list(processes.values()))
+    values = manifest.get('values') or {}
+
+    # starting the processes can take a while, so do it off the loop
+    return Deferred(_apply, sockets, values, processes, prune, manifest, instance)
+
+
+def _apply(sockets, values, processes, prune, manifest, instance):
+    results = {'sockets': {}, 'values': {}, 'processes': {}}
+    instance_globals = instance['globals']
+    with instance_globals['sockets_lock']:
+        _apply_sockets(sockets, instance_globals['sockets']['by_name'], results['sockets'])
+    with instance_globals['values_lock']:
+        _apply_values(values, instance_globals, results['values'])
+        values_module.changed(instance_globals)
+    with instance_globals['processes_lock']:
+        planned = _plan_processes(processes, instance_globals['processes'], results['processes'])
+    if prune:
+        _prune(prune, manifest, instance_globals, results)
+    # processes are spawned outside of the lock, in dependency order, and
+    # each one counts as started once it is ready
+    _start_processes(planned, results['processes'])
+    log.info('Applied manifest')
+    return json.dumps(results, sort_keys=True)
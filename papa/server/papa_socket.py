@@ -166,6 +166,9 @@ class PapaSocket(object):
     def clone_for_reuseport(self):
         s = socket.socket(self.family, self.socket_type)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # every clone must set SO_REUSEPORT before binding, or it cannot
+        # share the port with the clones already listening
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         if self.interface:
             import IN
             if hasattr(IN, 'SO_BINDTODEVICE'):
@@ -176,7 +179,6 @@ class PapaSocket(object):
         except socket.error as e:
             raise utils.Error('Bind failed on {0}:{1}: {2}'.format(self.host, self.port, e))
 
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.listen(self.backlog)
         try:
             s.set_inheritable(True)
@@ -184,6 +186,33 @@ class PapaSocket(object):
             pass
         return s
 
+    def save(self):
+        """Return the state that a re-executed papa needs to adopt this socket"""
+        return {
+            'name': self.name,
+            'family': utils.valid_families_by_number[self.family],
+            'type': utils.valid_types_by_number[self.socket_type],
+            'backlog': self.backlog,
+            'path': self.path,
+            'umask': self.umask,
+            'host': self.host,
+            'port': self.port,
+            'interface': self.interface,
+            'reuseport': self.reuseport,
+            'fileno': self.socket.fileno() if self.socket else None,
+        }
+
+    @classmethod
+    def restore(cls, state, instance):
+        fileno = state.pop('fileno')
+        p = cls(instance=instance, **state)
+        if fileno is not None:
+            p.socket = adopt_socket(fileno, p.family, p.socket_type)
+        if p.path:
+            p._sockets_by_path[p.path] = p
+        p._sockets_by_name[p.name] = p
+        return p
+
     def close(self):
         if self.socket:
             self.socket.close()
@@ -231,7 +260,7 @@ Examples:
     name = args.pop(0)
     kwargs = extract_name_value_pairs(args)
     p = PapaSocket(name, instance, **kwargs)
-    with instance['globals']['lock']:
+    with instance['globals']['sockets_lock']:
         return str(p.start())
 
 
@@ -245,7 +274,7 @@ Examples:
     remove socket 10
 """
     instance_globals = instance['globals']
-    with instance_globals['lock']:
+    with instance_globals['sockets_lock']:
         for name, p in wildcard_iter(instance_globals['sockets']['by_name'], args, required=True):
             p.close()
 
@@ -260,16 +289,32 @@ Examples:
     list socket uwsgi.*
 """
     instance_globals = instance['globals']
-    with instance_globals['lock']:
-        return '\n'.join(sorted('{0}'.format(s) for _, s in wildcard_iter(instance_globals['sockets']['by_name'], args)))
+    with instance_globals['sockets_lock']:
+        return '\n'.join('{0}'.format(s) for _, s in wildcard_iter(instance_globals['sockets']['by_name'], args))
 
 
 def cleanup(instance_globals):
-    with instance_globals['lock']:
+    with instance_globals['sockets_lock']:
         for p in list(instance_globals['sockets']['by_name'].values()):
             p.close()
 
 
+def adopt_socket(fd, family, socket_type):
+    """Wrap a socket that was inherited as a bare file descriptor, keeping
+    its number.
+
+    Python 2 can only wrap a duplicate, so there the socket gets a new number
+    and the inherited one is closed. Nothing depends on the number, because
+    $(socket.NAME.fileno) is looked up again whenever a process starts, and
+    running processes hold descriptors of their own."""
+    try:
+        return socket.socket(family, socket_type, 0, fd)
+    except TypeError:
+        s = socket.fromfd(fd, family, socket_type)
+        os.close(fd)
+        return s
+
+
 def find_socket(name, instance):
     instance_globals = instance['globals']
     return instance_globals['sockets']['by_name'][name]
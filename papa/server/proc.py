@@ -1,18 +1,25 @@
 import os
+import re
 import sys
-import logging
-import ctypes
+import errno
 import select
+import logging
 import socket
-import fcntl
-from time import time
+import signal
+from copy import copy
+from functools import partial
+from time import time, sleep
 from papa import utils, Error
-from papa.utils import extract_name_value_pairs, wildcard_iter, cast_bytes, \
-    send_with_retry
-from papa.server.papa_socket import find_socket
+from papa.utils import extract_name_value_pairs, wildcard_iter, cast_bytes
+from papa.server.papa_socket import find_socket, unix_socket, adopt_socket
+from papa.server import values
+from papa.server.loop import get_reactor, set_nonblocking, Deferred
+from papa.server import zygote as zygote_main
 from subprocess import Popen, PIPE, STDOUT
-from threading import Thread, Lock
-from collections import deque, namedtuple
+from threading import Lock, Thread, Event, Condition
+from array import array
+from base64 import b64encode, b64decode
+from collections import namedtuple, defaultdict, deque
 
 try:
     import pwd
@@ -24,11 +31,6 @@ try:
 except ImportError:
     grp = None
 
-try:
-    import resource
-except ImportError:
-    resource = None
-
 try:
     # noinspection PyUnresolvedReferences,PyUnboundLocalVariable
     FileNotFoundError
@@ -36,10 +38,53 @@ except NameError as e:
     # noinspection PyShadowingBuiltins
     FileNotFoundError = OSError
 
+# logical positions in an output ring buffer keep growing, so use 64 bits if we can
+try:
+    array('Q')
+    OFFSET_TYPECODE = 'Q'
+except ValueError:
+    OFFSET_TYPECODE = 'L'
+
+try:
+    from subprocess import DEVNULL
+except ImportError:
+    DEVNULL = None
+
+# Popen can start a new session and switch user, group and supplementary
+# groups itself on Python 3.9+, so no Python code has to run in the child
+# and CPython can use vfork or posix_spawn instead of a full fork
+NATIVE_SPAWN = sys.version_info >= (3, 9) and DEVNULL is not None
+
+# Popen can close every fd except the ones a child needs on Python 3.2+
+PASS_FDS = sys.version_info >= (3, 2)
+
+# a zygote passes sockets and pipes to the workers it forks over a unix socket
+ZYGOTE = hasattr(socket, 'CMSG_SPACE') and hasattr(os, 'fork') and DEVNULL is not None
+
+# Linux 5.3+ can notify us through a file descriptor when a process exits
+pidfd_open = getattr(os, 'pidfd_open', None)
+
 __author__ = 'Scott Maxwell'
 
 log = logging.getLogger('papa.server')
 
+PIPE_READ_SIZE = 65536
+
+# the most processes spawned at the same time by a single request
+SPAWN_THREADS = 8
+
+# how long to wait for a process to become ready, unless told otherwise
+READY_TIMEOUT = 30.0
+
+# how much earlier output a ready.output pattern can span
+READY_MATCH_TAIL = 4096
+
+# how long a restart gives an old process to exit before killing it
+DRAIN_TIMEOUT = 30.0
+
+# how long to wait for a killed process to be collected
+KILL_TIMEOUT = 5.0
+
 
 def convert_size_string_to_bytes(s):
     try:
@@ -48,8 +93,33 @@ def convert_size_string_to_bytes(s):
         return int(s[:-1]) * {'g': 1073741824, 'm': 1048576, 'k': 1024}[s[-1].lower()]
 
 
+class OutputCursor(object):
+    """The read position of one watcher in an OutputQueue. While a watcher
+    is sending output, `pinned` is the first sequence number it sent."""
+    __slots__ = ('seq', 'listener', 'pinned')
+
+    def __init__(self, seq, listener):
+        self.seq = seq
+        self.listener = listener
+        self.pinned = None
+
+
 class OutputQueue(object):
-    Item = namedtuple('Item', 'type timestamp data')
+    """The captured output of a process.
+
+    Output is stored once, in a ring buffer of `bufsize` bytes, and every
+    watcher reads it through its own OutputCursor. Each chunk is described
+    by one row of a set of parallel arrays (type, timestamp, offset and
+    length) and numbered with a sequence number, so a chatty process costs
+    no Python objects per chunk. A chunk is only dropped once every open
+    cursor has acknowledged it or newer output needs its space.
+
+    `retrieve` hands out memoryviews of the ring buffer and pins them until
+    the cursor acknowledges them. If new output would overwrite pinned
+    output, the queue moves to a new buffer instead, so the views stay
+    valid until the watcher is done with them."""
+
+    Item = namedtuple('Item', 'type seq timestamp data')
     STDOUT = 0
     STDERR = 1
     CLOSED = -1
@@ -57,51 +127,516 @@ class OutputQueue(object):
     def __init__(self, bufsize=1048576):
         self.lock = Lock()
         self.bufsize = bufsize
-        self.q = deque()
-        self._used = 0
+        self.buffer = None
+        self.view = None
+        # logical position of the next write, which only ever grows
+        self.write_pos = 0
+        self.types = array('b')
+        self.timestamps = array('d')
+        self.offsets = array(OFFSET_TYPECODE)
+        self.lengths = array('l')
+        self.start = 0
+        self.first_seq = 0
+        self.next_seq = 0
+        self.acknowledged = 0
+        self.cursors = set()
         self._closed = False
 
-    def add(self, output_type, data=None):
+    def add(self, output_type, data=None, timestamp=None):
         if not self._closed:
             with self.lock:
-                if not self._closed:
-                    data_tuple = OutputQueue.Item(output_type, time(), data)
-                    if output_type != OutputQueue.CLOSED and data:
-                        if len(data) >= self.bufsize:
-                            self.q.clear()
-                            self._used = len(data)
-                        else:
-                            self._used += len(data)
-                            while self._used > self.bufsize:
-                                first = self.q.popleft()
-                                self._used -= len(first.data)
-                    self.q.append(data_tuple)
-
-    def retrieve(self):
-        if self.q:
-            with self.lock:
-                if self.q:
-                    l = list(self.q)
-                    return l[-1].timestamp, l
-        return 0, None
+                if self._closed:
+                    return
+                if output_type == OutputQueue.CLOSED:
+                    offset = self.write_pos
+                    length = data
+                else:
+                    bufsize = self.bufsize
+                    length = len(data)
+                    if length > bufsize:
+                        data = data[-bufsize:]
+                        length = bufsize
+                    if self.buffer is None:
+                        self.buffer = bytearray(bufsize)
+                        self.view = memoryview(self.buffer)
+                    pos = self.write_pos % bufsize
+                    if pos + length > bufsize:
+                        # never split a chunk, so that it can be handed out as one view
+                        self.write_pos += bufsize - pos
+                        pos = 0
+                    offset = self.write_pos
+                    limit = offset + length - bufsize
+                    if self._overwrites_pinned(limit):
+                        pos = self._reallocate(limit)
+                        offset = self.write_pos
+                    self.write_pos += length
+                    # forget the chunks we are about to overwrite before touching the buffer
+                    self._evict(offset + length - bufsize)
+                    self.buffer[pos:pos + length] = data
+                self.types.append(output_type)
+                self.timestamps.append(timestamp or time())
+                self.offsets.append(offset)
+                self.lengths.append(length)
+                self.next_seq += 1
+                listeners = [cursor.listener for cursor in self.cursors if cursor.listener]
+            for listener in listeners:
+                listener()
+
+    def _overwrites_pinned(self, limit):
+        # output before first_seq is no longer in this buffer, so views of
+        # it belong to an old buffer that nothing will write to again
+        first_seq = self.first_seq
+        pinned = [cursor.pinned for cursor in self.cursors if cursor.pinned is not None and cursor.pinned >= first_seq]
+        if not pinned:
+            return False
+        # the offsets only grow, so only the first pinned chunk needs checking
+        i = self.start + min(pinned) - first_seq
+        return i < len(self.offsets) and self.offsets[i] < limit
+
+    def _reallocate(self, limit):
+        """Drop the output before `limit` and copy the rest to the start of a
+        new buffer, leaving the old one to the views that still use it.
+        Returns the position in the new buffer for the next chunk."""
+        self._evict(limit)
+        bufsize = self.bufsize
+        buffer = bytearray(bufsize)
+        base = (self.write_pos // bufsize + 1) * bufsize
+        pos = 0
+        for i in range(self.start, len(self.offsets)):
+            old = self.offsets[i] % bufsize
+            self.offsets[i] = base + pos
+            if self.types[i] != OutputQueue.CLOSED:
+                length = self.lengths[i]
+                buffer[pos:pos + length] = self.view[old:old + length]
+                pos += length
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.write_pos = base + pos
+        return pos
+
+    def _evict(self, limit):
+        offsets = self.offsets
+        while self.start < len(offsets) and offsets[self.start] < limit:
+            self._drop_first()
+        self._compact()
+
+    def _drop_first(self):
+        self.start += 1
+        self.first_seq += 1
+
+    def _compact(self):
+        start = self.start
+        if start > 64 and start * 2 > len(self.types):
+            for column in (self.types, self.timestamps, self.offsets, self.lengths):
+                del column[:start]
+            self.start = 0
+
+    def _trim(self):
+        if self.cursors:
+            limit = min(cursor.seq for cursor in self.cursors)
+        else:
+            limit = self.acknowledged
+        while self.first_seq < limit and self.start < len(self.types):
+            self._drop_first()
+        self._compact()
 
-    def remove(self, timestamp):
+    def open_cursor(self, listener=None):
+        """Start reading from the oldest output that nobody has acknowledged"""
         with self.lock:
-            q = self.q
-            while q and q[0].timestamp <= timestamp:
-                item = q.popleft()
-                if self._used:
-                    self._used -= len(item.data)
+            cursor = OutputCursor(max(self.acknowledged, self.first_seq), listener)
+            self.cursors.add(cursor)
+            return cursor
+
+    def close_cursor(self, cursor):
+        with self.lock:
+            if cursor in self.cursors:
+                self.cursors.remove(cursor)
+                self._trim()
+
+    def retrieve(self, cursor):
+        """Return the sequence number to acknowledge and all items that the
+        cursor has not acknowledged yet. The items are pinned until the
+        cursor acknowledges them."""
+        with self.lock:
+            first = self.start + max(cursor.seq - self.first_seq, 0)
+            count = len(self.types)
+            if first >= count:
+                return 0, None
+            seq = self.first_seq + first - self.start
+            if cursor.pinned is None:
+                cursor.pinned = seq
+            bufsize = self.bufsize
+            view = self.view
+            items = []
+            for i in range(first, count):
+                output_type = self.types[i]
+                length = self.lengths[i]
+                if output_type == OutputQueue.CLOSED:
+                    data = length
+                else:
+                    pos = self.offsets[i] % bufsize
+                    data = view[pos:pos + length]
+                items.append(OutputQueue.Item(output_type, seq, self.timestamps[i], data))
+                seq += 1
+            return self.next_seq, items
+
+    def advance(self, cursor, seq):
+        """Move a cursor past output it has retrieved without acknowledging
+        it, so the output is still there for anyone who watches later"""
+        with self.lock:
+            cursor.pinned = None
+            if seq > cursor.seq:
+                cursor.seq = seq
+
+    def acknowledge(self, cursor, seq):
+        with self.lock:
+            cursor.pinned = None
+            if seq > cursor.seq:
+                cursor.seq = seq
+                if seq > self.acknowledged:
+                    self.acknowledged = seq
+                self._trim()
 
     def close(self):
         with self.lock:
-            self.bufsize = 0
-            self.q = deque()
-            self._used = 0
+            self.buffer = None
+            self.view = None
+            for column in (self.types, self.timestamps, self.offsets, self.lengths):
+                del column[:]
+            self.start = 0
+            self.first_seq = self.next_seq
             self._closed = True
 
+    def save(self):
+        """Return the stored output as a list of type, timestamp and data,
+        with the data in base64 and the exit code as the data of CLOSED"""
+        with self.lock:
+            items = []
+            for i in range(self.start, len(self.types)):
+                output_type = self.types[i]
+                length = self.lengths[i]
+                if output_type == OutputQueue.CLOSED:
+                    data = length
+                else:
+                    pos = self.offsets[i] % self.bufsize
+                    data = b64encode(self.view[pos:pos + length].tobytes()).decode('ascii')
+                items.append((output_type, self.timestamps[i], data))
+            return items
+
+    @classmethod
+    def restore(cls, bufsize, items):
+        output = cls(bufsize)
+        for output_type, timestamp, data in items:
+            if output_type != OutputQueue.CLOSED:
+                data = b64decode(data.encode('ascii'))
+            output.add(output_type, data, timestamp)
+        return output
+
     def __len__(self):
-        return len(self.q)
+        return len(self.types) - self.start
+
+
+class ZygoteWorker(object):
+    """Stands in for the Popen object of a process forked by a zygote"""
+
+    def __init__(self, pid, stdout, stderr):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self._callback = None
+
+    def when_exited(self, callback):
+        # runs on the reactor thread, like the exit notification
+        if self.returncode is None:
+            self._callback = callback
+        else:
+            callback()
+
+    def set_returncode(self, returncode):
+        self.returncode = returncode
+        callback, self._callback = self._callback, None
+        if callback:
+            callback()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+
+class AdoptedWorker(object):
+    """Stands in for the Popen object of a process that was spawned before
+    papa re-executed itself"""
+
+    def __init__(self, pid, stdout=None, stderr=None):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # not our child, so all we can tell is whether it is gone
+                try:
+                    os.kill(self.pid, 0)
+                except OSError as e:
+                    if e.errno == errno.ESRCH:
+                        self.returncode = -1
+            else:
+                if pid:
+                    self.returncode = zygote_main.exit_code(status)
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            sleep(.01)
+        return self.returncode
+
+
+class Zygote(object):
+    """A warm Python interpreter that has already imported a set of modules
+    and forks workers on request, so a worker does not pay for interpreter
+    startup or for those imports.
+
+    The zygote runs papa/server/zygote.py. Each spawn request carries the
+    pipes for the worker output and the sockets it needs, and the reply is
+    the pid of the worker. The zygote reports worker exits on a pipe that
+    the reactor reads."""
+
+    def __init__(self, key, executable, modules, working_dir, env):
+        self.key = key
+        self.modules = modules
+        self.alive = True
+        self._lock = Lock()
+        self._workers_lock = Lock()
+        self._workers = {}
+        self._early_exits = {}
+        self._partial = b''
+        control, child_control = socket.socketpair()
+        self._exits, exits_write = os.pipe()
+        path = os.path.splitext(zygote_main.__file__)[0] + '.py'
+        try:
+            self._process = Popen([executable, path, str(child_control.fileno()), str(exits_write)] + list(modules),
+                                  cwd=working_dir, env=env, close_fds=True,
+                                  pass_fds=(child_control.fileno(), exits_write),
+                                  stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                                  start_new_session=True)
+        except OSError as e:
+            control.close()
+            os.close(self._exits)
+            raise utils.Error('Could not start zygote - {0}'.format(e))
+        finally:
+            child_control.close()
+            os.close(exits_write)
+        self._control = control
+        control.settimeout(60)
+        try:
+            reply = zygote_main.receive_message(control)[0]
+        except (EOFError, OSError, ValueError) as e:
+            reply = {'error': str(e)}
+        control.settimeout(None)
+        if not reply or 'error' in reply:
+            self.close()
+            os.close(self._exits)
+            raise utils.Error('Zygote failed to start - {0}'.format(reply and reply['error'] or 'it exited'))
+        self.pid = reply['ready']
+        self._reactor = get_reactor()
+        self._reactor.call_soon_threadsafe(self._reactor.add_reader, self._exits, self._read_exits)
+        log.info('Started zygote %d for %s', self.pid, ','.join(modules))
+
+    def spawn(self, args, env, working_dir, out, err, pass_fds, uid, gid, groups, rlimits):
+        fds = []
+        targets = []
+        readers = []
+        try:
+            if out:
+                r, w = os.pipe()
+                readers.append(r)
+                fds.append(w)
+                targets.append(1)
+                if err == 'stdout':
+                    fds.append(w)
+                    targets.append(2)
+            if err and err != 'stdout':
+                r, w = os.pipe()
+                readers.append(r)
+                fds.append(w)
+                targets.append(2)
+            fds.extend(pass_fds)
+            targets.extend(pass_fds)
+            request = {
+                'args': args,
+                'env': env,
+                'cwd': working_dir,
+                'uid': uid,
+                'gid': gid,
+                'groups': groups,
+                'rlimits': sorted(rlimits.items()),
+                'targets': targets,
+            }
+            with self._lock:
+                try:
+                    zygote_main.send_message(self._control, request, fds)
+                    reply = zygote_main.receive_message(self._control)[0]
+                except (EOFError, OSError, ValueError) as e:
+                    reply = None
+                    log.error('Lost zygote %d - %s', self.pid, e)
+                if reply is None:
+                    self.close()
+                    raise utils.Error('The zygote for {0} has exited'.format(','.join(self.modules)))
+        except Exception:
+            for fd in readers:
+                os.close(fd)
+            raise
+        finally:
+            for fd in set(fds) - set(pass_fds):
+                os.close(fd)
+        if 'error' in reply:
+            for fd in readers:
+                os.close(fd)
+            raise utils.Error('Bad command - {0}'.format(reply['error']))
+        pipes = [os.fdopen(fd, 'rb', 0) for fd in readers]
+        worker = ZygoteWorker(reply['pid'], pipes[0] if out else None, pipes[-1] if err and err != 'stdout' else None)
+        with self._workers_lock:
+            returncode = self._early_exits.pop(worker.pid, None)
+            if returncode is None:
+                self._workers[worker.pid] = worker
+            else:
+                worker.returncode = returncode
+        return worker
+
+    def _read_exits(self):
+        # runs on the reactor thread
+        try:
+            data = os.read(self._exits, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = None
+        if not data:
+            self._lost()
+            return
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            pid, returncode = (int(n) for n in line.split())
+            with self._workers_lock:
+                worker = self._workers.pop(pid, None)
+                if worker is None:
+                    # the exit beat the spawn reply to us
+                    self._early_exits[pid] = returncode
+            if worker:
+                worker.set_returncode(returncode)
+
+    def _lost(self):
+        # Without the zygote nobody can tell us the exit codes, so just wait
+        # for the remaining workers to disappear
+        self._reactor.remove_reader(self._exits)
+        os.close(self._exits)
+        self.alive = False
+        self._process.poll()
+        with self._workers_lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            self._poll_orphan(worker, .01)
+
+    def _poll_orphan(self, worker, delay):
+        try:
+            os.kill(worker.pid, 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                worker.set_returncode(-1)
+                return
+        self._reactor.call_later(delay, self._poll_orphan, worker, min(delay * 2, 1.0))
+
+    def save(self):
+        """Return the state that a re-executed papa needs to adopt this
+        zygote, with the pid of every worker that has not exited yet"""
+        with self._workers_lock:
+            return {
+                'key': list(self.key),
+                'pid': self.pid,
+                'control': self._control.fileno(),
+                'exits': self._exits,
+                'workers': sorted(self._workers),
+                'early_exits': sorted(self._early_exits.items()),
+                'partial': self._partial.decode('ascii'),
+            }
+
+    @classmethod
+    def restore(cls, state):
+        self = cls.__new__(cls)
+        executable, modules, working_dir, python_path = state['key']
+        self.key = (executable, tuple(modules), working_dir, python_path)
+        self.modules = self.key[1]
+        self.alive = True
+        self._lock = Lock()
+        self._workers_lock = Lock()
+        self._workers = dict((pid, ZygoteWorker(pid, None, None)) for pid in state['workers'])
+        self._early_exits = dict(state['early_exits'])
+        self._partial = state['partial'].encode('ascii')
+        self._control = adopt_socket(state['control'], socket.AF_UNIX, socket.SOCK_STREAM)
+        self._exits = state['exits']
+        self.pid = state['pid']
+        self._process = AdoptedWorker(self.pid)
+        self._reactor = get_reactor()
+        self._reactor.call_soon_threadsafe(self._reactor.add_reader, self._exits, self._read_exits)
+        return self
+
+    def close(self):
+        """Stop the zygote. Workers it has already forked keep running."""
+        if self.alive:
+            self.alive = False
+            self._control.close()
+            self._process.poll()
+
+
+_zygotes_lock = Lock()
+
+
+def get_zygote(instance, executable, modules, working_dir, env):
+    """Return the running zygote for an executable, modules and working
+    directory, starting it if needed. The modules are imported with nothing
+    but PYTHONPATH in the environment."""
+    zygotes = instance['globals'].setdefault('zygotes', {})
+    python_path = env.get('PYTHONPATH')
+    key = (executable, modules, working_dir, python_path)
+    # processes are spawned outside of the processes lock, so make sure that two
+    # of them do not both start a zygote
+    with _zygotes_lock:
+        zygote = zygotes.get(key)
+        if zygote is None or not zygote.alive:
+            zygote = zygotes[key] = Zygote(key, executable, modules, working_dir,
+                                           {'PYTHONPATH': python_path} if python_path else {})
+    return zygote
+
+
+def parse_socket_references(name, args):
+    """Split any argument with a $(socket.NAME.port) or $(socket.NAME.fileno)
+    reference into a tuple of the text before it, the socket name, the part
+    and the text after it, so that spawning only has to look up the socket"""
+    template = []
+    for arg in args:
+        if '$(socket.' in arg:
+            start = arg.find('$(socket.') + 9
+            end = arg.find(')', start)
+            if end == -1:
+                raise utils.Error('Process for {0} argument starts with "$(socket." but has no closing parenthesis'.format(name))
+            socket_and_part = arg[start:end]
+            socket_name, part = socket_and_part.rpartition('.')[::2]
+            if not part or part not in ('port', 'fileno'):
+                raise utils.Error('You forgot to specify either ".port" or ".fileno" after the name')
+            arg = (arg[:start - 9], socket_name, part, arg[end + 1:])
+        template.append(arg)
+    return template
 
 
 class Process(object):
@@ -133,26 +668,58 @@ class Process(object):
 
     - **rlimits**: a mapping containing rlimit names and values that will
       be set before the command runs.
+
+    - **after**: a comma-separated list of the processes that must have
+      started before this one.
+
+    - **zygote**: a comma-separated list of modules. If given, the first
+      argument must be a Python executable and the process is forked from a
+      zygote running that executable with those modules already imported.
+
+    - **ready**: a mapping of the conditions that must hold before the
+      process counts as started. 'output' is a regular expression to find in
+      its stdout or stderr, 'socket' the name of a socket it must accept a
+      connection on and 'value' the name of a value that must be set.
+      'timeout' is the number of seconds to wait.
     """
     def __init__(self, name, args, env, rlimits, instance,
                  working_dir=None, shell=False, uid=None, gid=None,
-                 stdout=1, stderr=1, bufsize='1m'):
+                 stdout=1, stderr=1, bufsize='1m', zygote=None, after=None,
+                 ready=None):
 
         self.instance = instance
         instance_globals = instance['globals']
         self._processes = instance_globals['processes']
+        # processes that are being spawned outside of the processes lock
+        self._starting = instance_globals.setdefault('starting', {})
 
         self.name = name
         self.args = args
+        self._arg_template = parse_socket_references(name, args)
         self.env = env
         self.rlimits = rlimits
         self.working_dir = working_dir
         self.shell = shell
         self.bufsize = convert_size_string_to_bytes(bufsize)
 
+        if zygote:
+            if not ZYGOTE:
+                raise utils.Error('zygote is not supported on this platform')
+            if shell:
+                raise utils.Error('A zygote process cannot use the shell')
+            self.zygote = tuple(module for module in zygote.split(',') if module)
+        else:
+            self.zygote = None
+
+        self.after = tuple(dependency for dependency in after.split(',') if dependency) if after else ()
+
         self.pid = 0
         self.running = False
         self.started = 0
+        self.spawned = Event()
+        self.exited = Event()
+        # set while a restart is replacing the process
+        self.retiring = False
 
         if self.bufsize:
             self.out = int(stdout)
@@ -160,6 +727,14 @@ class Process(object):
         else:
             self.out = self.err = 0
 
+        self.ready_options = dict(ready or {})
+        self._parse_ready_options()
+        # set once the process has started and met its ready conditions, or
+        # failed to
+        self.ready = Event()
+        self.ready_error = None
+        self._existing = None
+
         if uid:
             if pwd:
                 try:
@@ -200,7 +775,8 @@ class Process(object):
 
         # sockets created before fork, should be let go after.
         self._worker = None
-        self._thread = None
+        self._reactor = None
+        self._pipes = {}
         self._output = None
         self._auto_close = False
 
@@ -216,170 +792,459 @@ class Process(object):
             self.err == other.err and
             self.bufsize == other.bufsize and
             self.uid == other.uid and
-            self.gid == other.gid
+            self.gid == other.gid and
+            self.zygote == other.zygote and
+            self.after == other.after and
+            self.ready_options == other.ready_options
         )
 
+    def replicate(self, name):
+        """Return an unspawned copy of this process with another name"""
+        replica = copy(self)
+        replica.name = name
+        replica.pid = 0
+        replica.running = False
+        replica.started = 0
+        replica.retiring = False
+        replica._worker = None
+        replica._reactor = None
+        replica._pipes = {}
+        replica._output = None
+        replica._auto_close = False
+        replica.spawned = Event()
+        replica.exited = Event()
+        replica.ready = Event()
+        replica.ready_error = None
+        replica._existing = None
+        return replica
+
+    def _parse_ready_options(self):
+        options = self.ready_options
+        unknown = set(options) - set(('output', 'socket', 'value', 'timeout'))
+        if unknown:
+            raise utils.Error('Unknown ready conditions: {0}'.format(', '.join(sorted(unknown))))
+        self.ready_pattern = None
+        if options.get('output'):
+            if not self.out and not self.err:
+                raise utils.Error('ready.output needs the output of the process to be captured')
+            try:
+                self.ready_pattern = re.compile(cast_bytes(options['output']))
+            except re.error as e:
+                raise utils.Error('Bad ready.output pattern - {0}'.format(e))
+        try:
+            self.ready_timeout = float(options.get('timeout', READY_TIMEOUT))
+        except ValueError:
+            raise utils.Error('ready.timeout must be a number of seconds')
+
+    def start(self):
+        """Spawn the process and wait until it is ready"""
+        self.spawn()
+        self.wait_until_ready()
+        return self
+
     def spawn(self):
-        existing = self._processes.get(self.name)
-        if existing:
-            if self == existing:
-                self.pid = existing.pid
-                self.running = existing.running
-                self.started = existing.started
-            else:
+        """Start the process, or adopt the existing process of the same name
+        if it has the same options. Only the bookkeeping is done while
+        holding the processes lock. The socket references are resolved and
+        the fork and exec happen outside of it, so a slow spawn does not hold
+        up any other client."""
+        self._wait_for_dependencies()
+        lock = self.instance['globals']['processes_lock']
+        with lock:
+            existing = self._processes.get(self.name) or self._starting.get(self.name)
+            if existing is None:
+                self._starting[self.name] = self
+        if existing is None:
+            try:
+                fixed_args, pass_fds, managed_sockets = self._resolve_args()
+            except Exception:
+                with lock:
+                    self._finish_starting()
+                raise
+        else:
+            if self != existing:
                 raise utils.Error('Process for {0} has already been created - {1}'.format(self.name, str(existing)))
+            existing.spawned.wait()
+            if existing.pid == 0:
+                raise utils.Error('Process for {0} failed to start'.format(self.name))
+            self.pid = existing.pid
+            self.running = existing.running
+            self.started = existing.started
+            self._existing = existing
+            return self
+
+        self.started = time()
+        try:
+            if self.zygote:
+                worker = self._zygote_spawn(fixed_args, pass_fds)
+            else:
+                worker = self._popen(fixed_args, pass_fds)
+        except Exception:
+            with lock:
+                self._finish_starting()
+            raise
+        finally:
+            # let go of sockets created only for the worker to inherit
+            for sock in managed_sockets:
+                sock.close()
+
+        with lock:
+            self._worker = worker
+            self.pid = worker.pid
+            self._output = OutputQueue(self.bufsize)
+            self.running = True
+            self._processes[self.name] = self
+            self._finish_starting()
+            log.info('Created process %s', self)
+        if not (self.ready_pattern or self.ready_options.get('socket') or self.ready_options.get('value')):
+            self.ready.set()
+        self._reactor = get_reactor()
+        self._reactor.call_soon_threadsafe(self._watch)
+        return self
+
+    def wait_until_ready(self):
+        """Block until every ready condition holds. Raises an Error if the
+        process exits or the timeout expires first, but never stops the
+        process."""
+        if self._existing is not None:
+            self._existing.ready.wait()
+            if self._existing.ready_error:
+                raise utils.Error(self._existing.ready_error)
+            return
+        if self.ready.is_set():
+            return
+        deadline = time() + self.ready_timeout
+        try:
+            if self.ready_pattern:
+                self._wait_for_output(deadline)
+            if self.ready_options.get('socket'):
+                self._wait_for_accept(self.ready_options['socket'], deadline)
+            if self.ready_options.get('value'):
+                if not values.wait_for_value(self.instance, self.ready_options['value'], deadline):
+                    self._not_ready('value {0} was not set'.format(self.ready_options['value']))
+        except Exception as e:
+            self.ready_error = str(e)
+            raise
+        finally:
+            self.ready.set()
+        log.info('Process %s is ready', self.name)
+
+    def _not_ready(self, reason):
+        raise utils.Error('Process for {0} was not ready after {1} seconds - {2}'.format(self.name, self.ready_timeout, reason))
+
+    def _wait_for_output(self, deadline):
+        output = self._output
+        added = Event()
+        cursor = output.open_cursor(added.set)
+        tails = {OutputQueue.STDOUT: b'', OutputQueue.STDERR: b''}
+        try:
+            while True:
+                added.clear()
+                seq, items = output.retrieve(cursor)
+                for item in items or ():
+                    if item.type == OutputQueue.CLOSED:
+                        raise utils.Error('Process for {0} exited with {1} before it was ready'.format(self.name, item.data))
+                    data = tails[item.type] + item.data.tobytes()
+                    if self.ready_pattern.search(data):
+                        return
+                    tails[item.type] = data[-READY_MATCH_TAIL:]
+                if items:
+                    output.advance(cursor, seq)
+                remaining = deadline - time()
+                if remaining <= 0:
+                    self._not_ready('no output matched {0}'.format(self.ready_options['output']))
+                added.wait(remaining)
+        finally:
+            output.close_cursor(cursor)
+
+    def _wait_for_accept(self, name, deadline):
+        # Connect to the socket and wait until nothing is waiting to be
+        # accepted on it, which means the process has accepted our probe
+        try:
+            s = find_socket(name, self.instance)
+        except KeyError:
+            raise utils.Error('Socket {0} not found'.format(name))
+        if s.socket is None or s.socket_type != socket.SOCK_STREAM:
+            raise utils.Error('ready.socket needs a stream socket that is not reuseport')
+        if s.family == unix_socket:
+            address = s.path
         else:
-            managed_sockets = []
-            fixed_args = []
-            self.started = time()
-            for arg in self.args:
-                if '$(socket.' in arg:
-                    start = arg.find('$(socket.') + 9
-                    end = arg.find(')', start)
-                    if end == -1:
-                        raise utils.Error('Process for {0} argument starts with "$(socket." but has no closing parenthesis'.format(self.name))
-                    socket_and_part = arg[start:end]
-                    socket_name, part = socket_and_part.rpartition('.')[::2]
-                    if not part or part not in ('port', 'fileno'):
-                        raise utils.Error('You forgot to specify either ".port" or ".fileno" after the name')
-                    try:
-                        s = find_socket(socket_name, self.instance)
-                    except Exception:
-                        raise utils.Error('Socket {0} not found'.format(socket_name))
-                    if part == 'port':
-                        replacement = s.port
-                    elif s.reuseport:
-                        sock = s.clone_for_reuseport()
-                        managed_sockets.append(sock)
-                        replacement = sock.fileno()
-                    else:
-                        replacement = s.socket.fileno()
-                    arg = '{0}{1}{2}'.format(arg[:start - 9], replacement, arg[end + 1:])
-                fixed_args.append(arg)
-
-            if not fixed_args:
-                raise utils.Error('No command')
-
-            def preexec():
-                streams = [sys.stdin]
-                if not self.out:
-                    streams.append(sys.stdout)
-                if not self.err:
-                    streams.append(sys.stderr)
-                for stream in streams:
-                    if hasattr(stream, 'fileno'):
-                        try:
-                            stream.flush()
-                            devnull = os.open(os.devnull, os.O_RDWR)
-                            # noinspection PyTypeChecker
-                            os.dup2(devnull, stream.fileno())
-                            # noinspection PyTypeChecker
-                            os.close(devnull)
-                        except IOError:
-                            # some streams, like stdin - might be already closed.
-                            pass
-
-                # noinspection PyArgumentList
-                os.setsid()
-
-                if resource:
-                    for limit, value in self.rlimits.items():
-                        resource.setrlimit(limit, (value, value))
-
-                if self.gid:
-                    try:
-                        # noinspection PyTypeChecker
-                        os.setgid(self.gid)
-                    except OverflowError:
-                        if not ctypes:
-                            raise
-                        # versions of python < 2.6.2 don't manage unsigned int for
-                        # groups like on osx or fedora
-                        os.setgid(-ctypes.c_int(-self.gid).value)
-
-                    if self.username is not None:
+            address = ({'0.0.0.0': '127.0.0.1', '::': '::1'}.get(s._host, s._host), s.port)
+        probe = socket.socket(s.family, socket.SOCK_STREAM)
+        try:
+            probe.settimeout(max(deadline - time(), .01))
+            try:
+                probe.connect(address)
+            except socket.error as e:
+                self._not_ready('could not connect to socket {0} - {1}'.format(name, e))
+            # poll rather than select, which fails on fds above FD_SETSIZE
+            backlog = select.poll()
+            backlog.register(s.socket, select.POLLIN)
+            # poll can only wait for the backlog to fill, not to drain, so wait
+            # on the probe instead. The process can only send on it or close
+            # it once it has been accepted.
+            accepted = select.poll()
+            accepted.register(probe, select.POLLIN)
+            delay = .005
+            while True:
+                events = backlog.poll(0)
+                if not events:
+                    break
+                if events[0][1] != select.POLLIN:
+                    raise utils.Error('Socket {0} was closed before {1} was ready'.format(name, self.name))
+                if not self.running:
+                    raise utils.Error('Process for {0} exited before it was ready'.format(self.name))
+                remaining = deadline - time()
+                if remaining <= 0:
+                    self._not_ready('nothing accepted a connection on socket {0}'.format(name))
+                accepted.poll(min(delay, remaining) * 1000)
+                delay = min(delay * 2, .1)
+        finally:
+            probe.close()
+
+    def _finish_starting(self):
+        # called with the processes lock held
+        self._starting.pop(self.name, None)
+        self.spawned.set()
+
+    def _wait_for_dependencies(self):
+        for name in self.after:
+            with self.instance['globals']['processes_lock']:
+                dependency = self._processes.get(name) or self._starting.get(name)
+            if dependency is None:
+                raise utils.Error('Process for {0} depends on {1}, which does not exist'.format(self.name, name))
+            dependency.spawned.wait()
+            if not dependency.pid:
+                raise utils.Error('Process for {0} depends on {1}, which failed to start'.format(self.name, name))
+            dependency.ready.wait()
+            if dependency.ready_error:
+                raise utils.Error('Process for {0} depends on {1}, which is not ready'.format(self.name, name))
+
+    def _resolve_args(self):
+        """Substitute the socket references. Returns the arguments, the fds
+        to pass and any sockets cloned for this process."""
+        managed_sockets = []
+        pass_fds = set()
+        fixed_args = []
+        # the sockets lock keeps the sockets open until they are cloned
+        with self.instance['globals']['sockets_lock']:
+            try:
+                for arg in self._arg_template:
+                    if isinstance(arg, tuple):
+                        before, socket_name, part, after = arg
                         try:
-                            # noinspection PyTypeChecker
-                            os.initgroups(self.username, self.gid)
-                        except (OSError, AttributeError):
-                            # not support on Mac or 2.6
-                            pass
+                            s = find_socket(socket_name, self.instance)
+                        except Exception:
+                            raise utils.Error('Socket {0} not found'.format(socket_name))
+                        if part == 'port':
+                            replacement = s.port
+                        elif s.reuseport:
+                            # every process gets its own clone, so the kernel
+                            # balances connections between them
+                            sock = s.clone_for_reuseport()
+                            managed_sockets.append(sock)
+                            replacement = sock.fileno()
+                            pass_fds.add(replacement)
+                        else:
+                            replacement = s.socket.fileno()
+                            pass_fds.add(replacement)
+                        arg = '{0}{1}{2}'.format(before, replacement, after)
+                    fixed_args.append(arg)
+                if not fixed_args:
+                    raise utils.Error('No command')
+            except Exception:
+                for sock in managed_sockets:
+                    sock.close()
+                raise
+        return fixed_args, sorted(pass_fds), managed_sockets
+
+    def _popen(self, fixed_args, pass_fds):
+        extra = {}
+        if PASS_FDS:
+            # only the sockets named in the arguments are inherited, not
+            # client connections, other pipes or unrelated sockets
+            extra['close_fds'] = True
+            extra['pass_fds'] = pass_fds
+        else:
+            extra['close_fds'] = False
+        if NATIVE_SPAWN and not self.rlimits:
+            # there is no native way to set rlimits in the child
+            extra.update(self._native_spawn_options())
+        else:
+            extra['preexec_fn'] = self._preexec
+
+        if self.out:
+            extra['stdout'] = PIPE
 
-                if self.uid:
+        if self.err:
+            if self.err == 'stdout':
+                extra['stderr'] = STDOUT
+            else:
+                extra['stderr'] = PIPE
+
+        try:
+            return Popen(fixed_args, shell=self.shell,
+                         cwd=self.working_dir, env=self.env, bufsize=-1,
+                         **extra)
+        except FileNotFoundError as file_not_found_exception:
+            if not os.path.exists(fixed_args[0]):
+                raise utils.Error('Bad command - {0}'.format(file_not_found_exception))
+            if self.working_dir and not os.path.isdir(self.working_dir):
+                raise utils.Error('Bad working_dir - {0}'.format(file_not_found_exception))
+            raise
+
+    def _zygote_spawn(self, fixed_args, pass_fds):
+        if len(fixed_args) < 2:
+            raise utils.Error('A zygote process needs a Python executable and arguments')
+        if self.working_dir and not os.path.isdir(self.working_dir):
+            raise utils.Error('Bad working_dir - {0}'.format(self.working_dir))
+        zygote = get_zygote(self.instance, fixed_args[0], self.zygote, self.working_dir, self.env)
+        groups = None
+        if self.gid and self.username is not None and hasattr(os, 'getgrouplist'):
+            groups = os.getgrouplist(self.username, self.gid)
+        return zygote.spawn(fixed_args[1:], self.env, self.working_dir, self.out, self.err,
+                            pass_fds, self.uid, self.gid, groups, self.rlimits)
+
+    def _native_spawn_options(self):
+        """The Popen arguments that do what _preexec does"""
+        options = {'start_new_session': True, 'stdin': DEVNULL}
+        if not self.out:
+            options['stdout'] = DEVNULL
+        if not self.err:
+            options['stderr'] = DEVNULL
+        # only root can set the supplementary groups. Like initgroups in
+        # _preexec, leave them alone otherwise, and skip ids that papa has
+        # already.
+        root = os.geteuid() == 0
+        if self.gid and (root or self.gid != os.getegid()):
+            options['group'] = self.gid
+        if self.gid and root and self.username is not None and hasattr(os, 'getgrouplist'):
+            options['extra_groups'] = os.getgrouplist(self.username, self.gid)
+        if self.uid and (root or self.uid != os.geteuid()):
+            options['user'] = self.uid
+        return options
+
+    def _preexec(self):
+        # runs in the child when the spawn cannot be done natively
+        streams = [sys.stdin]
+        if not self.out:
+            streams.append(sys.stdout)
+        if not self.err:
+            streams.append(sys.stderr)
+        for stream in streams:
+            if hasattr(stream, 'fileno'):
+                try:
+                    stream.flush()
+                    devnull = os.open(os.devnull, os.O_RDWR)
                     # noinspection PyTypeChecker
-                    os.setuid(self.uid)
+                    os.dup2(devnull, stream.fileno())
+                    # noinspection PyTypeChecker
+                    os.close(devnull)
+                except IOError:
+                    # some streams, like stdin - might be already closed.
+                    pass
 
-            extra = {}
-            if self.out:
-                extra['stdout'] = PIPE
+        # noinspection PyArgumentList
+        os.setsid()
 
-            if self.err:
-                if self.err == 'stdout':
-                    extra['stderr'] = STDOUT
-                else:
-                    extra['stderr'] = PIPE
+        if self.rlimits:
+            # convert_rlimits has already imported it, so this is only a lookup
+            import resource
+            for limit, value in self.rlimits.items():
+                resource.setrlimit(limit, (value, value))
 
+        if self.gid:
             try:
-                self._worker = Popen(fixed_args, preexec_fn=preexec,
-                                     close_fds=False, shell=self.shell,
-                                     cwd=self.working_dir, env=self.env, bufsize=-1,
-                                     **extra)
-            except FileNotFoundError as file_not_found_exception:
-                if not os.path.exists(fixed_args[0]):
-                    raise utils.Error('Bad command - {0}'.format(file_not_found_exception))
-                if self.working_dir and not os.path.isdir(self.working_dir):
-                    raise utils.Error('Bad working_dir - {0}'.format(file_not_found_exception))
-                raise
-            # let go of sockets created only for self.worker to inherit
-            for sock in managed_sockets:
-                sock.close()
-            self._processes[self.name] = self
-            self.pid = self._worker.pid
-            self._output = OutputQueue(self.bufsize)
-            log.info('Created process %s', self)
-
-            self.running = True
-            self._thread = Thread(target=self._watch)
-            self._thread.daemon = True
-            self._thread.start()
+                # noinspection PyTypeChecker
+                os.setgid(self.gid)
+            except OverflowError:
+                # versions of python < 2.6.2 don't manage unsigned int for
+                # groups like on osx or fedora, so pass it as a signed int
+                os.setgid(self.gid - (1 << 32) if self.gid >= 1 << 31 else self.gid)
+
+            if self.username is not None:
+                try:
+                    # noinspection PyTypeChecker
+                    os.initgroups(self.username, self.gid)
+                except (OSError, AttributeError):
+                    # not support on Mac or 2.6
+                    pass
 
-        return self
+        if self.uid:
+            # noinspection PyTypeChecker
+            os.setuid(self.uid)
 
     def _watch(self):
-        pipes = []
-        stdout = self._worker.stdout
-        stderr = self._worker.stderr
-        output = self._output
-        if self.out:
-            pipes.append(stdout)
-        if self.err and self.err != 'stdout':
-            pipes.append(stderr)
-        if pipes:
-            for pipe in pipes:
-                fd = pipe.fileno()
-                fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-                fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-            data = True
-            while data and not self._auto_close:
-                out = select.select(pipes, [], [])[0]
-                for p in out:
-                    data = p.read()
-                    if data:
-                        output.add(OutputQueue.STDOUT if p == stdout else OutputQueue.STDERR, data)
-
-        if stdout:
-            stdout.close()
-        if stderr:
-            stderr.close()
+        # runs on the reactor thread
+        reactor = self._reactor
+        pipes = self._pipes
+        # a process adopted after papa re-executed itself may have closed
+        # some of its output already
+        if self.out and self._worker.stdout is not None:
+            pipes[self._worker.stdout.fileno()] = (self._worker.stdout, OutputQueue.STDOUT)
+        if self.err and self.err != 'stdout' and self._worker.stderr is not None:
+            pipes[self._worker.stderr.fileno()] = (self._worker.stderr, OutputQueue.STDERR)
+        for fd in pipes:
+            set_nonblocking(fd)
+            reactor.add_reader(fd, partial(self._read_pipe, fd))
+        if not pipes:
+            self._wait()
+
+    def _read_pipe(self, fd):
+        pipe, output_type = self._pipes[fd]
+        try:
+            data = os.read(fd, PIPE_READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = None
+        if data and not self._auto_close:
+            self._output.add(output_type, data)
+            return
+        self._reactor.remove_reader(fd)
+        pipe.close()
+        del self._pipes[fd]
+        if not self._pipes:
+            self._wait()
+
+    def _wait(self):
+        # all output is closed, so the process should be exiting
+        if isinstance(self._worker, ZygoteWorker):
+            # only the zygote can collect the exit code
+            self._worker.when_exited(self._exited)
+            return
+        if pidfd_open:
+            try:
+                pidfd = pidfd_open(self.pid)
+            except OSError:
+                pass
+            else:
+                self._reactor.add_reader(pidfd, partial(self._pidfd_ready, pidfd))
+                return
+        self._poll_exit(.001)
+
+    def _pidfd_ready(self, pidfd):
+        self._reactor.remove_reader(pidfd)
+        os.close(pidfd)
+        self._exited()
+
+    def _poll_exit(self, delay):
+        if self._worker.poll() is None:
+            self._reactor.call_later(delay, self._poll_exit, min(delay * 2, 1.0))
+        else:
+            self._exited()
+
+    def _exited(self):
         out = self._worker.wait()
         self.running = False
         if self._auto_close:
             instance_globals = self.instance['globals']
-            with instance_globals['lock']:
+            with instance_globals['processes_lock']:
                 log.info('Removed process %s', self)
-                instance_globals['processes'].pop(self.name, None)
+                self._forget()
         else:
-            output.add(OutputQueue.CLOSED, out)
+            self._output.add(OutputQueue.CLOSED, out)
+        self.exited.set()
 
     def __str__(self):
         result = ['{0} pid={1} running={2} started={3}'.format(self.name, self.pid, self.running, self.started)]
@@ -389,24 +1254,235 @@ class Process(object):
             result.append('gid={0}'.format(self.gid))
         if self.shell:
             result.append('shell=True')
+        if self.zygote:
+            result.append('zygote={0}'.format(','.join(self.zygote)))
+        if self.after:
+            result.append('after={0}'.format(','.join(self.after)))
         # if self.env:
         #     result.extend('env.{0}={1}'.format(key, value) for key, value in self.env.items())
         if self.args:
             result.append('args={0}'.format(' '.join(self.args)))
         return ' '.join(result)
 
-    def watch(self):
+    def save(self):
+        """Return the state that a re-executed papa needs to adopt this
+        process, including the output pipes and the output nobody has
+        acknowledged yet"""
+        pipes = dict((output_type, fd) for fd, (pipe, output_type) in self._pipes.items())
+        return {
+            'name': self.name,
+            'args': self.args,
+            'env': self.env,
+            'rlimits': sorted(self.rlimits.items()),
+            'working_dir': self.working_dir,
+            'shell': self.shell,
+            'uid': self.uid,
+            'gid': self.gid,
+            'stdout': self.out,
+            'stderr': self.err,
+            'bufsize': self.bufsize,
+            'zygote': ','.join(self.zygote) if self.zygote else None,
+            'after': ','.join(self.after),
+            'ready': self.ready_options,
+            'ready_error': self.ready_error,
+            'pid': self.pid,
+            'running': self.running,
+            'started': self.started,
+            'auto_close': self._auto_close,
+            'forked_by_zygote': isinstance(self._worker, ZygoteWorker),
+            # never poll here, or the new papa could not collect the exit code
+            'returncode': self._worker.returncode if self.running else None,
+            'stdout_fd': pipes.get(OutputQueue.STDOUT),
+            'stderr_fd': pipes.get(OutputQueue.STDERR),
+            'output': [] if self._auto_close else self._output.save(),
+        }
+
+    @classmethod
+    def restore(cls, state, instance):
+        """Adopt a process that was spawned before papa re-executed itself"""
+        p = cls(state['name'], state['args'], state['env'], dict(state['rlimits']), instance,
+                working_dir=state['working_dir'], shell=state['shell'], uid=state['uid'], gid=state['gid'],
+                stdout=state['stdout'], stderr=state['stderr'], bufsize=state['bufsize'],
+                zygote=state['zygote'], after=state['after'], ready=state['ready'])
+        p.pid = state['pid']
+        p.running = state['running']
+        p.started = state['started']
+        p.ready_error = state['ready_error']
+        p._output = OutputQueue.restore(p.bufsize, state['output'])
+        if state['auto_close']:
+            p._auto_close = True
+            p._output.close()
+        p.spawned.set()
+        p.ready.set()
+        p._processes[p.name] = p
+        if not p.running:
+            p.exited.set()
+            return p
+
+        pipes = [os.fdopen(fd, 'rb', 0) if fd is not None else None for fd in (state['stdout_fd'], state['stderr_fd'])]
+        worker = None
+        if state['forked_by_zygote'] and state['returncode'] is None:
+            for zygote in instance['globals']['zygotes'].values():
+                worker = zygote._workers.get(p.pid)
+                if worker:
+                    break
+        if worker is None:
+            worker = AdoptedWorker(p.pid)
+            worker.returncode = state['returncode']
+        worker.stdout, worker.stderr = pipes
+        p._worker = worker
+        p._reactor = get_reactor()
+        p._reactor.call_soon_threadsafe(p._watch)
+        return p
+
+    def open_output_cursor(self, listener=None):
+        return self._output.open_cursor(listener)
+
+    def close_output_cursor(self, cursor):
+        self._output.close_cursor(cursor)
+
+    def watch(self, cursor):
         # noinspection PyTypeChecker
-        return self._output.retrieve()
+        return self._output.retrieve(cursor)
 
-    def remove_output(self, timestamp):
-        self._output.remove(timestamp)
+    def remove_output(self, cursor, seq):
+        self._output.acknowledge(cursor, seq)
 
     def close_output(self):
         self._output.close()
         self._auto_close = True
         if not self.running:
-            self.instance['globals']['processes'].pop(self.name, None)
+            self._forget()
+
+    def _forget(self):
+        # called with the processes lock held. A restart can reuse the name
+        # while this process is still draining.
+        processes = self.instance['globals']['processes']
+        if processes.get(self.name) is self:
+            del processes[self.name]
+
+
+def start_processes(processes):
+    """Spawn a group of processes in dependency order. Every process starts
+    as soon as the processes of the group it comes `after` are ready, and up
+    to SPAWN_THREADS spawns run at the same time, so the whole group takes as
+    long as its slowest chain of dependencies. Returns a list with the ready
+    process or the exception for each one, in the same order."""
+    names = dict((p.name, p) for p in processes)
+    check_for_cycles(processes)
+    waiting = dict((p.name, set(name for name in p.after if name in names)) for p in processes)
+    dependents = defaultdict(list)
+    for p in processes:
+        for name in waiting[p.name]:
+            dependents[name].append(p)
+    ready = deque(p for p in processes if not waiting[p.name])
+    outcomes = {}
+    condition = Condition()
+
+    def finish(p, outcome):
+        # called with the condition held
+        outcomes[p.name] = outcome
+        for dependent in dependents[p.name]:
+            if dependent.name in outcomes:
+                continue
+            if isinstance(outcome, Exception):
+                finish(dependent, utils.Error('Process for {0} depends on {1}, which failed to start'.format(dependent.name, p.name)))
+            else:
+                waiting[dependent.name].discard(p.name)
+                if not waiting[dependent.name]:
+                    ready.append(dependent)
+        condition.notify_all()
+
+    def run():
+        while True:
+            with condition:
+                while not ready and len(outcomes) < len(processes):
+                    condition.wait()
+                if not ready:
+                    return
+                p = ready.popleft()
+            try:
+                outcome = p.spawn()
+            except Exception as e:
+                outcome = e
+            if outcome is p and not p.ready.is_set():
+                # waiting for it to become ready does not need a spawn slot
+                Thread(target=await_ready, args=(p,)).start()
+                continue
+            with condition:
+                finish(p, outcome)
+
+    def await_ready(p):
+        try:
+            p.wait_until_ready()
+            outcome = p
+        except Exception as e:
+            outcome = e
+        with condition:
+            finish(p, outcome)
+
+    threads = [Thread(target=run) for _ in range(min(SPAWN_THREADS, len(processes)) - 1)]
+    for thread in threads:
+        thread.start()
+    run()
+    for thread in threads:
+        thread.join()
+    return [outcomes[p.name] for p in processes]
+
+
+def check_for_cycles(processes):
+    """Raise an Error if the processes of a group depend on each other"""
+    names = dict((p.name, p) for p in processes)
+    visiting = set()
+    done = set()
+
+    def visit(p, path):
+        if p.name in done:
+            return
+        if p.name in visiting:
+            raise utils.Error('Processes depend on each other: {0}'.format(' -> '.join(path + [p.name])))
+        visiting.add(p.name)
+        for name in p.after:
+            if name in names:
+                visit(names[name], path + [p.name])
+        visiting.remove(p.name)
+        done.add(p.name)
+
+    for p in processes:
+        visit(p, [])
+
+
+def spawn_all(processes):
+    """Start a group of processes and return them in the same order. If any
+    of them fails, the first error is raised once all have finished."""
+    results = start_processes(processes)
+    for p, result in zip(processes, results):
+        if isinstance(result, Exception):
+            raise utils.Error('{0}: {1}'.format(p.name, result))
+    return results
+
+
+def cleanup(instance_globals):
+    with instance_globals['processes_lock']:
+        for zygote in list(instance_globals.get('zygotes', {}).values()):
+            zygote.close()
+
+
+def convert_rlimits(rlimits):
+    """Convert a dict of rlimit names like 'nofile' and values to a dict keyed
+    by the resource module constants"""
+    converted = {}
+    if not rlimits:
+        return converted
+    import resource
+    for key, value in rlimits.items():
+        try:
+            converted[getattr(resource, 'RLIMIT_%s' % key.upper())] = int(value)
+        except AttributeError:
+            raise utils.Error('Unknown rlimit "%s"' % key)
+        except ValueError:
+            raise utils.Error('The rlimit value for "%s" must be an integer, not "%s"' % (key, value))
+    return converted
 
 
 # noinspection PyUnusedLocal
@@ -421,44 +1497,228 @@ Process options are:
     gid - the group name or group ID to use when starting the process
     working_dir - must be an absolute path if specified
     output - size of each output buffer (default is 1m)
+    after - a comma-separated list of processes that must have started
+            before this one. If one of them is still starting, papa waits
+            for it
+    count - create this many replicas, named NAME.0 to NAME.<count - 1>, in a
+            single request. Each replica gets its own clone of a reuseport
+            socket
+    zygote - a comma-separated list of Python modules. The process is forked
+             from a warm interpreter that has already imported them, so the
+             command must be a Python executable followed by a script, -m
+             module or -c code
 
 You can also specify environment variables by prefixing the name with 'env.' and
 rlimits by prefixing the name with 'rlimit.'
 
+Sockets are passed with $(socket.NAME.fileno) or $(socket.NAME.port) in the
+args. The process only inherits the file descriptors of the sockets whose
+fileno appears in its args; every other descriptor is closed.
+
+The reply can wait until the process is ready. Conditions are:
+    ready.output - a regular expression to find in the stdout or stderr
+    ready.socket - the name of a socket that the process must accept a
+                   connection on. Papa connects to check
+    ready.value - the name of a value that must be set
+    ready.timeout - seconds to wait (default is 30). If a condition does not
+                    hold in time, you get an error but the process keeps running
+
 Examples:
-    make process sf uid=1001 gid=2000 working_dir=/sf/bin/ output=1m /sf/bin/uwsgi --ini uwsgi-live.ini --socket fd://27 --stats 127.0.0.1:8090
+    make process sf uid=1001 gid=2000 working_dir=/sf/bin/ output=1m /sf/bin/uwsgi --ini uwsgi-live.ini --socket fd://$(socket.sf.fileno) --stats 127.0.0.1:8090
     make process nginx /usr/local/nginx/sbin/nginx
+    make process web count=4 /usr/bin/python3 web.py --fd $(socket.web.fileno)
+    make process web ready.socket=web ready.timeout=10 /usr/bin/python3 web.py --fd $(socket.web.fileno)
+    make process worker.1 zygote=myapp,myapp.tasks /usr/bin/python3 -m myapp.worker
 """
     if not args:
         raise Error('Process requires a name')
     name = args.pop(0)
     env = {}
     rlimits = {}
+    ready = {}
     kwargs = {}
     for key, value in extract_name_value_pairs(args).items():
         if key.startswith('env.'):
             env[key[4:]] = value
         elif key.startswith('rlimit.'):
-            key = key[7:]
-            try:
-                rlimits[getattr(resource, 'RLIMIT_%s' % key.upper())] = int(value)
-            except AttributeError:
-                raise utils.Error('Unknown rlimit "%s"' % key)
-            except ValueError:
-                raise utils.Error('The rlimit value for "%s" must be an integer, not "%s"' % (key, value))
+            rlimits[key[7:]] = value
+        elif key.startswith('ready.'):
+            ready[key[6:]] = value
         else:
             kwargs[key] = value
+    rlimits = convert_rlimits(rlimits)
     watch = int(kwargs.pop('watch', 0))
-    p = Process(name, args, env, rlimits, instance, **kwargs)
-    with instance['globals']['lock']:
-        result = p.spawn()
+    count = int(kwargs.pop('count', 0))
+    p = Process(name, args, env, rlimits, instance, ready=ready, **kwargs)
+    # spawning and waiting for the process to be ready happen off the loop,
+    # so other clients are not held up
+    return Deferred(_make_processes, p, count, watch, instance)
+
+
+def _make_processes(p, count, watch, instance):
+    if count:
+        results = spawn_all([p.replicate('{0}.{1}'.format(p.name, i)) for i in range(count)])
+        if watch:
+            return WatchSession(dict((result.name, {'p': result, 't': 0, 'closed': False}) for result in results), instance, 'Watching {0}\n'.format(count))
+        return '\n'.join(str(result) for result in results)
+
+    result = p.start()
     if watch:
-        send_with_retry(sock, cast_bytes('{0}\n'.format(result)))
-        return _do_watch(sock, {name: {'p': result, 't': 0, 'closed': False}}, instance)
+        return WatchSession({p.name: {'p': result, 't': 0, 'closed': False}}, instance, '{0}\n'.format(result))
 
     return str(result)
 
 
+# noinspection PyUnusedLocal
+def restart_command(sock, args, instance):
+    """Replace running processes with new ones that have the same options.
+
+You can specify name=value pairs for the restart options, followed by the names
+of the processes to restart. Wildcards are allowed.
+
+Restart options are:
+    batch - how many processes to replace at a time (default is 1)
+    floor - the fewest processes that must be running at any time (default is
+            the number running when the restart begins)
+    signal - the signal that asks an old process to finish (default is TERM)
+    drain - seconds an old process has to exit before it is killed (default
+            is 30)
+
+Each batch of new processes must be ready before the old processes they
+replace are signalled. While it drains, an old process is renamed
+NAME.retired.PID and its output is no longer recorded. If a new process fails
+to start, the old one keeps its name and keeps running. Give the processes a
+reuseport socket so that both generations can accept connections at once.
+
+Examples:
+    restart processes web.*
+    restart processes batch=2 drain=10 web.*
+"""
+    options = extract_name_value_pairs(args)
+    unknown = set(options) - set(('batch', 'floor', 'signal', 'drain'))
+    if unknown:
+        raise Error('Unknown restart options: {0}'.format(', '.join(sorted(unknown))))
+    if not args:
+        raise Error('Restart requires the names of the processes')
+    try:
+        batch = int(options.get('batch', 1))
+        floor = int(options['floor']) if 'floor' in options else None
+        drain = float(options.get('drain', DRAIN_TIMEOUT))
+    except ValueError:
+        raise Error('batch and floor must be integers and drain must be a number of seconds')
+    if batch < 1:
+        raise Error('batch must be at least 1')
+    sig = convert_signal(options.get('signal', 'TERM'))
+    # the restart waits for processes to start and exit, so it runs off the loop
+    return Deferred(_restart, args, batch, floor, sig, drain, instance)
+
+
+def convert_signal(name):
+    """Convert a signal name like 'TERM' or 'SIGHUP', or a number, to the
+    signal number"""
+    try:
+        return int(name)
+    except ValueError:
+        pass
+    name = name.upper()
+    number = getattr(signal, name if name.startswith('SIG') else 'SIG' + name, None)
+    if not isinstance(number, int):
+        raise Error('Unknown signal "{0}"'.format(name))
+    return number
+
+
+def _restart(patterns, batch, floor, sig, drain, instance):
+    instance_globals = instance['globals']
+    with instance_globals['processes_lock']:
+        old = [p for _, p in wildcard_iter(instance_globals['processes'], patterns, True)]
+        if not old:
+            raise Error('Nothing to restart')
+        for p in old:
+            if p.retiring:
+                raise Error('Process for {0} is already being restarted'.format(p.name))
+        running = sum(1 for p in old if p.running)
+        if floor is None:
+            floor = running
+        elif floor > running:
+            raise Error('Only {0} of the processes are running, which is below the floor of {1}'.format(running, floor))
+        for p in old:
+            p.retiring = True
+    new = []
+    errors = []
+    try:
+        for start in range(0, len(old), batch):
+            _restart_batch(old[start:start + batch], old[start + batch:], new, errors, floor, sig, drain, instance)
+            if errors:
+                break
+    finally:
+        with instance_globals['processes_lock']:
+            for p in old:
+                p.retiring = False
+    if errors:
+        raise Error('\n'.join(errors))
+    return '\n'.join(str(p) for p in new)
+
+
+def _restart_batch(group, waiting, new, errors, floor, sig, drain, instance):
+    """Start the replacements for a group of processes, then drain the old
+    processes that were replaced, as long as at least floor processes are
+    left running"""
+    lock = instance['globals']['processes_lock']
+    processes = instance['globals']['processes']
+    names = [p.name for p in group]
+    with lock:
+        for p in group:
+            p._forget()
+            p.name = '{0}.retired.{1}'.format(p.name, p.pid)
+            processes[p.name] = p
+    replacements = [p.replicate(name) for p, name in zip(group, names)]
+    replaced = []
+    for p, name, replacement, outcome in zip(group, names, replacements, start_processes(replacements)):
+        if not isinstance(outcome, Exception):
+            new.append(replacement)
+            replaced.append(p)
+            continue
+        errors.append('{0}: {1}'.format(name, outcome))
+        with lock:
+            if replacement.running:
+                # it started but never became ready
+                replacement.close_output()
+                _signal(replacement, sig)
+            p._forget()
+            p.name = name
+            processes[name] = p
+
+    with lock:
+        running = sum(1 for p in new + group + waiting if p.running)
+        allowed = max(running - floor, 0)
+        draining = []
+        for p in replaced:
+            if p.running and len(draining) >= allowed:
+                errors.append('{0} was not stopped, because fewer than {1} processes would be running'.format(p.name, floor))
+                continue
+            if p.running:
+                draining.append(p)
+            p.close_output()
+            _signal(p, sig)
+    deadline = time() + drain
+    for p in draining:
+        if not p.exited.wait(max(deadline - time(), 0)):
+            log.warning('Killing process %s, which did not exit within %s seconds', p, drain)
+            _signal(p, signal.SIGKILL)
+            if not p.exited.wait(KILL_TIMEOUT):
+                errors.append('{0} did not exit'.format(p.name))
+
+
+def _signal(p, sig):
+    if not p.running:
+        return
+    try:
+        os.kill(p.pid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
 # noinspection PyUnusedLocal
 def processes_command(sock, args, instance):
     """List active processes.
@@ -469,8 +1729,8 @@ Examples:
     list processes nginx.*
 """
     instance_globals = instance['globals']
-    with instance_globals['lock']:
-        return '\n'.join(sorted('{0}'.format(proc) for _, proc in wildcard_iter(instance_globals['processes'], args)))
+    with instance_globals['processes_lock']:
+        return '\n'.join('{0}'.format(proc) for _, proc in wildcard_iter(instance_globals['processes'], args))
 
 
 # noinspection PyUnusedLocal
@@ -485,7 +1745,7 @@ Examples:
 """
     """Close the process output channels and automatically remove the process when done"""
     instance_globals = instance['globals']
-    with instance_globals['lock']:
+    with instance_globals['processes_lock']:
         for name, p in wildcard_iter(instance_globals['processes'], args, required=True):
             p.close_output()
 
@@ -494,86 +1754,112 @@ def watch_command(sock, args, instance):
     """Watch a process"""
     instance_globals = instance['globals']
     all_processes = instance_globals['processes']
-    with instance_globals['lock']:
+    with instance_globals['processes_lock']:
         procs = dict((name, {'p': proc, 't': 0, 'closed': False}) for name, proc in wildcard_iter(all_processes, args, True))
     if not procs:
         raise utils.Error('Nothing to watch')
-    send_with_retry(sock, cast_bytes('Watching {0}\n'.format(len(procs))))
-    return _do_watch(sock, procs, instance)
-
-
-if hasattr(select, 'poll'):
-    class Poller(object):
-        def __init__(self, sock):
-            self.p = select.poll()
-            self.p.register(sock.fileno(), select.POLLHUP)
+    return WatchSession(procs, instance, 'Watching {0}\n'.format(len(procs)))
 
-        def poll(self, timeout):
-            return self.p.poll(timeout * 1000)
 
-else:
-    class Poller(object):
-        def __init__(self, sock):
-            self.sock = sock
-
-        def poll(self, timeout):
-            if not select.select([self.sock], [], [], timeout)[0]:
-                self.sock.setblocking(0)
-                try:
-                    b = self.sock.recv(1)
-                    if not b:
-                        return True
-                except socket.error:
-                    pass
-                self.sock.setblocking(1)
+class WatchSession(object):
+    """Streams the output of a set of processes to a client session.
 
+    The session reads each process through its own cursor and sends a batch
+    whenever output is available, then waits for the client to acknowledge
+    it before advancing the cursors. An acknowledgement of 'q' stops the
+    watch. The output queues wake the session up as soon as something is
+    added, so an idle watch costs nothing. Several sessions may watch the
+    same process and each receives all of its output."""
 
-def _do_watch(sock, procs, instance):
-    instance_globals = instance['globals']
-    all_processes = instance_globals['processes']
-    connection = instance['connection']
-    poller = Poller(sock)
-    delay = .1
-    while True:
+    def __init__(self, procs, instance, header):
+        self.procs = procs
+        self.instance = instance
+        self.header = header
+        self.client = None
+        self.loop = None
+        self.waiting_for_ack = False
+        self.notified = False
+
+    def start(self, client):
+        self.client = client
+        self.loop = client.loop
+        if self.header:
+            client.send(cast_bytes(self.header))
+        for proc in self.procs.values():
+            proc['cursor'] = proc['p'].open_output_cursor(self._output_added)
+        self._check()
+
+    def cancel(self):
+        for proc in self.procs.values():
+            cursor = proc.pop('cursor', None)
+            if cursor:
+                proc['p'].close_output_cursor(cursor)
+        self.client = None
+
+    def _output_added(self):
+        # called by whichever thread added the output
+        if not self.notified:
+            self.notified = True
+            self.loop.call_soon_threadsafe(self._wake_up)
+
+    def _wake_up(self):
+        self.notified = False
+        if self.client and not self.waiting_for_ack:
+            self._check()
+
+    def _collect(self):
+        # The output is sent straight from the process buffers, which stay
+        # pinned until the client acknowledges the batch. Only the headers
+        # are new objects.
         data = []
-        for name, proc in procs.items():
-            t, l = proc['p'].watch()
+        pending = b''
+        for name, proc in self.procs.items():
+            t, l = proc['p'].watch(proc['cursor'])
             if l:
                 for item in l:
                     if item.type == OutputQueue.CLOSED:
-                        data.append(cast_bytes('closed:{0}:{1}:{2}'.format(name, item.timestamp, item.data)))
+                        pending += cast_bytes('closed:{0}:{1}:{2}\n'.format(name, item.timestamp, item.data))
                         proc['closed'] = True
                     else:
-                        data.append(cast_bytes('{0}:{1}:{2}:{3}'.format('out' if item.type == OutputQueue.STDOUT else 'err', name, item.timestamp, len(item.data))))
+                        data.append(pending + cast_bytes('{0}:{1}:{2}:{3}\n'.format('out' if item.type == OutputQueue.STDOUT else 'err', name, item.timestamp, len(item.data))))
                         data.append(item.data)
+                        pending = b'\n'
                 proc['t'] = t
+        if data or pending:
+            data.append(pending + b'] ')
+            return data
+
+    def _check(self):
+        data = self._collect()
         if data:
-            delay = .05
-            data.append(b'] ')
-            out = b'\n'.join(data)
-            send_with_retry(sock, out)
-
-            one_line = connection.readline().lower()
-            closed = []
-            for name, proc in procs.items():
-                t = proc['t']
-                if t:
-                    proc['p'].remove_output(t)
-                    if proc['closed']:
-                        closed.append(name)
-            if closed:
-                with instance_globals['lock']:
-                    for name in closed:
-                        closed_proc = procs.pop(name, None)
-                        if closed_proc and 'p' in closed_proc:
-                            log.info('Removed process %s', closed_proc['p'])
-                        all_processes.pop(name, None)
-            if not procs:
-                return 'Nothing left to watch'
-            if one_line == 'q':
-                return 'Stopped watching'
-        else:
-            if poller.poll(delay):
-                return 'Client closed connection'
-            if delay < 1.0:
-                delay += .05
+            self.waiting_for_ack = True
+            self.client.send_buffers(data)
+
+    def acknowledge(self, one_line):
+        """Handle the client reply to a batch. Returns the final message if the
+        watch is over, otherwise None."""
+        self.waiting_for_ack = False
+        instance_globals = self.instance['globals']
+        all_processes = instance_globals['processes']
+        procs = self.procs
+        closed = []
+        for name, proc in procs.items():
+            t = proc['t']
+            if t:
+                proc['p'].remove_output(proc['cursor'], t)
+                if proc['closed']:
+                    closed.append(name)
+        if closed:
+            with instance_globals['processes_lock']:
+                for name in closed:
+                    closed_proc = procs.pop(name, None)
+                    if closed_proc and 'p' in closed_proc:
+                        closed_proc['p'].close_output_cursor(closed_proc.pop('cursor', None))
+                        log.info('Removed process %s', closed_proc['p'])
+                    all_processes.pop(name, None)
+        if not procs:
+            return 'Nothing left to watch'
+        if one_line.lower() == 'q':
+            self.cancel()
+            return 'Stopped watching'
+        self._check()
@@ -0,0 +1,159 @@
+"""Replace a running papa daemon with a fresh copy of itself.
+
+The state of papa is written to an unlinked temporary file as JSON, every
+socket and pipe that the new papa needs is made inheritable, and papa execs
+Python with RESTORE_CODE. Because exec keeps the pid, the children of papa
+stay its children and the new papa can still collect their exit codes.
+Output that arrives during the exec waits in the pipes.
+"""
+import os
+import sys
+import json
+import fcntl
+import socket
+import logging
+import tempfile
+import papa
+from papa import Error
+from papa.server import proc, values
+from papa.server.loop import stop_reactor, resume_reactor
+from papa.server.papa_socket import PapaSocket, adopt_socket
+try:
+    # noinspection PyPackageRequirements
+    from setproctitle import setproctitle, getproctitle
+except ImportError:
+    setproctitle = getproctitle = None
+
+__author__ = 'Scott Maxwell'
+
+log = logging.getLogger('papa.server')
+
+STATE_VERSION = 1
+
+# run by the new papa with the number of the state file, followed by the
+# directory that holds the papa package of the old one, so that it finds the
+# same package. The rest of sys.path comes from the environment again.
+RESTORE_CODE = 'import sys; sys.path.insert(1, sys.argv[2]); from papa.server import restore_server; restore_server(int(sys.argv[1]))'
+
+
+def get_inheritable(fd):
+    if hasattr(os, 'get_inheritable'):
+        return os.get_inheritable(fd)
+    return not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC
+
+
+def set_inheritable(fd, inheritable=True):
+    if hasattr(os, 'set_inheritable'):
+        os.set_inheritable(fd, inheritable)
+    else:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        if inheritable:
+            flags &= ~fcntl.FD_CLOEXEC
+        else:
+            flags |= fcntl.FD_CLOEXEC
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+def check(instance_globals):
+    """Raise an Error if papa cannot re-execute itself right now"""
+    if not instance_globals.get('daemon'):
+        raise Error('Only a papa daemon can re-execute itself')
+    if not sys.executable or not os.access(sys.executable, os.X_OK):
+        raise Error('Cannot find the Python executable to re-execute')
+    with instance_globals['processes_lock']:
+        if instance_globals['starting']:
+            raise Error('Wait until no processes are starting')
+
+
+def save(listen_socket, instance_globals):
+    """Return the state of papa and the file descriptors it refers to"""
+    sockets = [s.save() for s in instance_globals['sockets']['by_name'].values()]
+    zygotes = [z.save() for z in instance_globals['zygotes'].values() if z.alive]
+    processes = [p.save() for p in instance_globals['processes'].values()]
+    root = logging.getLogger()
+    state = {
+        'version': STATE_VERSION,
+        'listen': {'fileno': listen_socket.fileno(), 'family': listen_socket.family},
+        'sockets': sockets,
+        'values': dict(instance_globals['values']),
+        'values_version': instance_globals['values_version'],
+        'value_versions': dict(instance_globals['value_versions']),
+        'value_leases': dict(instance_globals['value_expiry'].leases),
+        'zygotes': zygotes,
+        'processes': processes,
+        'log_level': root.level if root.handlers else None,
+        'title': getproctitle() if getproctitle else None,
+    }
+    fds = [listen_socket.fileno()]
+    fds.extend(s['fileno'] for s in sockets if s['fileno'] is not None)
+    for z in zygotes:
+        fds.extend((z['control'], z['exits']))
+    for p in processes:
+        fds.extend(fd for fd in (p['stdout_fd'], p['stderr_fd']) if fd is not None)
+    return state, fds
+
+
+def reexec(listen_socket, instance_globals):
+    """Exec a new papa that restores the current state. Only returns if the
+    exec fails, after putting everything back the way it was."""
+    # once the reactor has stopped, output stays in the pipes until the new
+    # papa reads it
+    stop_reactor()
+    with instance_globals['processes_lock'], instance_globals['sockets_lock'], instance_globals['values_lock']:
+        state, fds = save(listen_socket, instance_globals)
+    state_file = tempfile.TemporaryFile()
+    state_file.write(json.dumps(state).encode('utf8'))
+    state_file.flush()
+    state_file.seek(0)
+    inherited = [fd for fd in fds if get_inheritable(fd)]
+    for fd in fds + [state_file.fileno()]:
+        set_inheritable(fd)
+    log.info('Re-executing papa')
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(papa.__file__)))
+    try:
+        os.execv(sys.executable, [sys.executable, '-c', RESTORE_CODE, str(state_file.fileno()), package_dir])
+    except OSError as e:
+        log.error('Could not re-execute papa - %s', e)
+    state_file.close()
+    for fd in set(fds) - set(inherited):
+        set_inheritable(fd, False)
+    resume_reactor()
+
+
+def restore(state_fd, instance_globals):
+    """Rebuild the state saved by reexec. Returns the listening socket."""
+    with os.fdopen(state_fd, 'rb') as state_file:
+        state = json.loads(state_file.read().decode('utf8'))
+    if state['version'] != STATE_VERSION:
+        raise Error('Cannot restore papa state version {0}'.format(state['version']))
+    if state['log_level'] is not None:
+        logging.basicConfig(level=state['log_level'])
+    if state['title'] and setproctitle:
+        setproctitle(state['title'])
+
+    instance = {'globals': instance_globals}
+    listen = state['listen']
+    listen_socket = adopt_socket(listen['fileno'], listen['family'], socket.SOCK_STREAM)
+    set_inheritable(listen_socket.fileno(), False)
+    instance_globals['values'].update(state['values'])
+    instance_globals['values_version'] = state['values_version']
+    instance_globals['value_versions'].update(state['value_versions'])
+    for name, (deadline, ttl) in state['value_leases'].items():
+        values.lease(instance_globals, name, ttl, deadline)
+    for socket_state in state['sockets']:
+        # managed sockets stay inheritable, so that processes can use them
+        PapaSocket.restore(socket_state, instance)
+    for zygote_state in state['zygotes']:
+        for fd in (zygote_state['control'], zygote_state['exits']):
+            set_inheritable(fd, False)
+        zygote = proc.Zygote.restore(zygote_state)
+        instance_globals['zygotes'][zygote.key] = zygote
+    for process_state in state['processes']:
+        for fd in (process_state['stdout_fd'], process_state['stderr_fd']):
+            if fd is not None:
+                set_inheritable(fd, False)
+        proc.Process.restore(process_state, instance)
+    log.info('Restored %d sockets, %d values and %d processes', len(state['sockets']), len(state['values']), len(state['processes']))
+    return listen_socket
@@ -0,0 +1,62 @@
+from bisect import bisect_left, insort
+
+__author__ = 'Scott Maxwell'
+
+
+class Registry(dict):
+    """A dict that also keeps its names in a sorted list, so that
+    wildcard_iter can find every name with a prefix by bisecting rather than
+    scanning, and hands them back in order."""
+
+    def __init__(self, *args, **kwargs):
+        super(Registry, self).__init__(*args, **kwargs)
+        self.names = sorted(dict.keys(self))
+
+    def __setitem__(self, name, value):
+        if name not in self:
+            insort(self.names, name)
+        dict.__setitem__(self, name, value)
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name)
+        self._forget(name)
+
+    def _forget(self, name):
+        del self.names[bisect_left(self.names, name)]
+
+    def pop(self, name, *default):
+        if name in self:
+            value = dict.pop(self, name)
+            self._forget(name)
+            return value
+        return dict.pop(self, name, *default)
+
+    def popitem(self):
+        name, value = dict.popitem(self)
+        self._forget(name)
+        return name, value
+
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return dict.__getitem__(self, name)
+
+    def update(self, *args, **kwargs):
+        for name, value in dict(*args, **kwargs).items():
+            self[name] = value
+
+    def clear(self):
+        dict.clear(self)
+        del self.names[:]
+
+    def copy(self):
+        return Registry(self)
+
+    def with_prefix(self, prefix):
+        """Return the names that start with prefix, in order"""
+        names = self.names
+        start = end = bisect_left(names, prefix)
+        count = len(names)
+        while end < count and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
@@ -1,34 +1,283 @@
-from papa.utils import wildcard_iter, Error
+from time import time
+from math import ceil
+from heapq import heappush, heappop
+from threading import Condition
+from papa.utils import extract_name_value_pairs, wildcard_iter, Error
+from papa.server.loop import Deferred
 
 __author__ = 'Scott Maxwell'
 
+# how long a wait blocks if it is not given a timeout
+WAIT_TIMEOUT = 30.0
+
+# values with a ttl expire up to this many seconds late
+EXPIRY_RESOLUTION = .1
+
+
+class Expiry(object):
+    """A timer wheel for the values that have a ttl.
+
+    Each deadline is rounded up to a bucket of EXPIRY_RESOLUTION seconds, and
+    a bucket is a set of names, so setting, renewing and expiring a value are
+    O(1). Only the bucket numbers are kept in a heap, so that papa knows when
+    to wake up next."""
+
+    def __init__(self):
+        # the deadline and ttl of each value that has a ttl
+        self.leases = {}
+        self.buckets = {}
+        self.heap = []
+        # the deadline that the loop timer is set for, and the timer
+        self.scheduled = None
+        self.timer = None
+
+    @staticmethod
+    def _bucket(deadline):
+        return int(ceil(deadline / EXPIRY_RESOLUTION))
+
+    def add(self, name, ttl, deadline=None):
+        self.discard(name)
+        if deadline is None:
+            deadline = time() + ttl
+        self.leases[name] = (deadline, ttl)
+        bucket = self._bucket(deadline)
+        names = self.buckets.get(bucket)
+        if names is None:
+            names = self.buckets[bucket] = set()
+            heappush(self.heap, bucket)
+        names.add(name)
+        return deadline
+
+    def discard(self, name):
+        lease = self.leases.pop(name, None)
+        if lease:
+            self.buckets[self._bucket(lease[0])].discard(name)
+
+    def due(self, now):
+        """Forget the names whose deadline has passed and return them"""
+        expired = []
+        heap = self.heap
+        while heap and heap[0] * EXPIRY_RESOLUTION <= now:
+            for name in self.buckets.pop(heappop(heap)):
+                del self.leases[name]
+                expired.append(name)
+        return expired
+
+    def next_deadline(self):
+        return self.heap[0] * EXPIRY_RESOLUTION if self.heap else None
+
+
+def store(instance_globals, name, value, ttl=None):
+    """Set a value, or clear it if value is empty, and give it the next
+    version. The version of a removed value is kept, so that waiters can be
+    told about the removal. A value set without a ttl never expires. Call
+    with the values lock held."""
+    values = instance_globals['values']
+    if value:
+        values[name] = value
+        if ttl:
+            lease(instance_globals, name, ttl)
+        else:
+            instance_globals['value_expiry'].discard(name)
+    elif name in values:
+        del values[name]
+        instance_globals['value_expiry'].discard(name)
+    else:
+        return
+    instance_globals['values_version'] += 1
+    instance_globals['value_versions'][name] = instance_globals['values_version']
+
+
+def _store_keeping_lease(instance_globals, name, value):
+    # incr, decr and cas change a value without changing when it expires
+    current = instance_globals['value_expiry'].leases.get(name)
+    store(instance_globals, name, value)
+    if current and value:
+        lease(instance_globals, name, current[1], current[0])
+
+
+def lease(instance_globals, name, ttl, deadline=None):
+    """Make a value expire after ttl seconds. Call with the values lock held."""
+    expiry = instance_globals['value_expiry']
+    deadline = expiry.add(name, ttl, deadline)
+    loop = instance_globals.get('loop')
+    if loop and (expiry.scheduled is None or deadline < expiry.scheduled):
+        expiry.scheduled = deadline
+        loop.call_soon_threadsafe(_set_expiry_timer, instance_globals, deadline)
+
+
+def expire(instance_globals):
+    """Remove the values whose ttl has run out. Call with the values lock held."""
+    names = instance_globals['value_expiry'].due(time())
+    for name in names:
+        store(instance_globals, name, None)
+    if names:
+        changed(instance_globals)
+
+
+def start_expiry(instance_globals):
+    """Set the loop timer for values that were given a ttl before the loop
+    existed"""
+    with instance_globals['values_lock']:
+        expiry = instance_globals['value_expiry']
+        expiry.scheduled = expiry.next_deadline()
+        if expiry.scheduled is not None:
+            instance_globals['loop'].call_soon_threadsafe(_set_expiry_timer, instance_globals, expiry.scheduled)
+
+
+def _set_expiry_timer(instance_globals, deadline):
+    # runs on the loop, which is the only thread that touches the timer
+    expiry = instance_globals['value_expiry']
+    if expiry.timer:
+        expiry.timer.cancel()
+    expiry.timer = instance_globals['loop'].call_later(max(deadline - time(), 0), _expire_on_timer, instance_globals)
+
+
+def _expire_on_timer(instance_globals):
+    expiry = instance_globals['value_expiry']
+    expiry.timer = None
+    with instance_globals['values_lock']:
+        expire(instance_globals)
+        deadline = expiry.scheduled = expiry.next_deadline()
+    if deadline is not None:
+        _set_expiry_timer(instance_globals, deadline)
+
+
+def _ttl(options, allowed=('ttl',)):
+    unknown = set(options) - set(allowed)
+    if unknown:
+        raise Error('Unknown value options: {0}'.format(', '.join(sorted(unknown))))
+    if 'ttl' not in options:
+        return None
+    try:
+        ttl = float(options['ttl'])
+    except ValueError:
+        ttl = 0
+    if ttl <= 0:
+        raise Error('ttl must be a positive number of seconds')
+    return ttl
+
+
+def changed(instance_globals):
+    """Wake up everything waiting for a value. Call with the values lock held."""
+    condition = instance_globals.get('values_changed')
+    if condition:
+        condition.notify_all()
+    for waiter in list(instance_globals['value_waiters']):
+        waiter.check()
+
+
+class ValueWait(Deferred):
+    """The reply to a 'wait' command. Rather than tying up a thread, it waits
+    on the event loop: changed() answers it as soon as a value it is
+    watching changes, and a timer answers it when the timeout expires."""
+
+    def __init__(self, patterns, since, timeout, instance_globals):
+        super(ValueWait, self).__init__(None)
+        self.patterns = patterns
+        self.since = since
+        self.timeout = timeout
+        self.instance_globals = instance_globals
+        self.loop = self.callback = self.timer = None
+
+    def start(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        instance_globals = self.instance_globals
+        with instance_globals['values_lock']:
+            expire(instance_globals)
+            if self.since > instance_globals['values_version']:
+                # papa has been restarted since the client got its version
+                self.since = 0
+            reply = self._changes()
+            if reply is None:
+                instance_globals['value_waiters'].add(self)
+        if reply is None:
+            self.timer = loop.call_later(self.timeout, self._expire)
+        else:
+            loop.call_soon(callback, reply)
+
+    def check(self):
+        # called with the values lock held, from any thread
+        reply = self._changes()
+        if reply is not None:
+            self.instance_globals['value_waiters'].discard(self)
+            self.loop.call_soon_threadsafe(self._done, reply)
+
+    def _done(self, reply):
+        self.timer.cancel()
+        self.callback(reply)
+
+    def _expire(self):
+        instance_globals = self.instance_globals
+        with instance_globals['values_lock']:
+            if self not in instance_globals['value_waiters']:
+                return
+            instance_globals['value_waiters'].discard(self)
+            reply = self._reply([])
+        self.callback(reply)
+
+    def _changes(self):
+        values = self.instance_globals['values']
+        changes = [(name, version) for name, version in wildcard_iter(self.instance_globals['value_versions'], self.patterns)
+                   if version > self.since and (self.since or name in values)]
+        return self._reply(changes) if changes else None
+
+    def _reply(self, changes):
+        values = self.instance_globals['values']
+        lines = [str(self.instance_globals['values_version'])]
+        for name, version in changes:
+            if name in values:
+                lines.append('{0} {1} {2}'.format(name, version, values[name]))
+            else:
+                lines.append('{0} {1}'.format(name, version))
+        return '\n'.join(lines)
+
+
+def wait_for_value(instance, name, deadline):
+    """Block until the named value is set. Returns False if it is still not
+    set at the deadline."""
+    instance_globals = instance['globals']
+    values = instance_globals['values']
+    with instance_globals['values_lock']:
+        condition = instance_globals.get('values_changed')
+        if condition is None:
+            condition = instance_globals['values_changed'] = Condition(instance_globals['values_lock'])
+        while name not in values:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            condition.wait(remaining)
+        return True
+
 
 # noinspection PyUnusedLocal
 def values_command(sock, args, instance):
     """Return all values stored in Papa"""
     instance_globals = instance['globals']
-    with instance_globals['lock']:
-        return '\n'.join(sorted('{0} {1}'.format(key, value) for key, value in wildcard_iter(instance_globals['values'], args)))
+    with instance_globals['values_lock']:
+        expire(instance_globals)
+        return '\n'.join('{0} {1}'.format(key, value) for key, value in wildcard_iter(instance_globals['values'], args))
 
 
 # noinspection PyUnusedLocal
 def set_command(sock, args, instance):
-    """Set or clear a named value. Pass no value to clear.
+    """Set or clear a named value. Pass no value to clear. Pass ttl to have the
+value removed after that many seconds, unless its lease is renewed first.
 
 Examples:
     set count 5
     set count
+    set ttl=10 worker.1.heartbeat alive
 """
+    ttl = _ttl(extract_name_value_pairs(args))
     instance_globals = instance['globals']
-    values = instance_globals['values']
-    with instance_globals['lock']:
+    with instance_globals['values_lock']:
         if not args or args == ['*']:
             raise Error('Value requires a name')
         name = args.pop(0)
-        if args:
-            values[name] = ' '.join(args)
-        else:
-            values.pop(name, None)
+        store(instance_globals, name, ' '.join(args), ttl)
+        changed(instance_globals)
 
 
 # noinspection PyUnusedLocal
@@ -43,9 +292,10 @@ Examples:
         raise Error('You cannot remove all variables')
     instance_globals = instance['globals']
     values = instance_globals['values']
-    with instance_globals['lock']:
-        for name, _ in wildcard_iter(values, args):
-            del values[name]
+    with instance_globals['values_lock']:
+        for name, _ in list(wildcard_iter(values, args)):
+            store(instance_globals, name, None)
+        changed(instance_globals)
 
 
 # noinspection PyUnusedLocal
@@ -58,5 +308,209 @@ Example:
     if not args:
         raise Error('Value requires a name')
     instance_globals = instance['globals']
-    with instance_globals['lock']:
+    with instance_globals['values_lock']:
+        expire(instance_globals)
         return instance_globals['values'].get(args[0])
+
+
+def _add(args, instance, sign):
+    if not args or args == ['*']:
+        raise Error('Value requires a name')
+    name = args[0]
+    try:
+        amount = int(args[1]) if len(args) > 1 else 1
+    except ValueError:
+        raise Error('The amount must be an integer')
+    instance_globals = instance['globals']
+    values = instance_globals['values']
+    with instance_globals['values_lock']:
+        expire(instance_globals)
+        try:
+            result = str(int(values.get(name, 0)) + sign * amount)
+        except ValueError:
+            raise Error('Value {0} is not an integer'.format(name))
+        _store_keeping_lease(instance_globals, name, result)
+        changed(instance_globals)
+    return result
+
+
+# noinspection PyUnusedLocal
+def incr_command(sock, args, instance):
+    """Add to a named integer value and return the result. A value that is
+not set counts as 0. The amount defaults to 1.
+
+Examples:
+    incr requests
+    incr requests 10
+"""
+    return _add(args, instance, 1)
+
+
+# noinspection PyUnusedLocal
+def decr_command(sock, args, instance):
+    """Subtract from a named integer value and return the result. A value that
+is not set counts as 0. The amount defaults to 1.
+
+Examples:
+    decr slots
+    decr slots 2
+"""
+    return _add(args, instance, -1)
+
+
+# noinspection PyUnusedLocal
+def cas_command(sock, args, instance):
+    """Set a named value only if it currently has the expected value. Returns 1
+if the value was set and 0 if not. Leave out the new value to clear it. To set a
+value only if it is not set at all, pass unset=1 instead of an expected value.
+
+Examples:
+    cas leader worker.1 worker.2
+    cas leader worker.2
+    cas unset=1 leader worker.1
+"""
+    options = extract_name_value_pairs(args)
+    unknown = set(options) - set(('unset',))
+    if unknown:
+        raise Error('Unknown cas options: {0}'.format(', '.join(sorted(unknown))))
+    unset = bool(options.get('unset'))
+    if unset:
+        if len(args) != 2 or args[0] == '*':
+            raise Error('cas unset=1 requires a name and the new value')
+    elif len(args) not in (2, 3) or args[0] == '*':
+        raise Error('cas requires a name, the expected value and the new value')
+    name = args.pop(0)
+    expected = None if unset else args.pop(0)
+    value = args[0] if args else None
+    instance_globals = instance['globals']
+    values = instance_globals['values']
+    with instance_globals['values_lock']:
+        expire(instance_globals)
+        if values.get(name) != expected:
+            return '0'
+        _store_keeping_lease(instance_globals, name, value)
+        changed(instance_globals)
+    return '1'
+
+
+# noinspection PyUnusedLocal
+def setnx_command(sock, args, instance):
+    """Set a named value only if it is not set yet. Returns 1 if the value was
+set and 0 if not. With a ttl, this makes a lock that is released if its holder
+stops renewing it.
+
+Examples:
+    setnx leader worker.1
+    setnx ttl=15 leader worker.1
+"""
+    ttl = _ttl(extract_name_value_pairs(args))
+    if len(args) < 2 or args[0] == '*':
+        raise Error('setnx requires a name and a value')
+    name = args.pop(0)
+    instance_globals = instance['globals']
+    values = instance_globals['values']
+    with instance_globals['values_lock']:
+        expire(instance_globals)
+        if name in values:
+            return '0'
+        store(instance_globals, name, ' '.join(args), ttl)
+        changed(instance_globals)
+    return '1'
+
+
+# noinspection PyUnusedLocal
+def mget_command(sock, args, instance):
+    """Get several named values at once. Unlike 'list values', the names are
+not wildcards. Values that are not set are left out.
+
+Example:
+    mget deploy.generation deploy.config
+"""
+    if not args:
+        raise Error('Value requires a name')
+    instance_globals = instance['globals']
+    values = instance_globals['values']
+    with instance_globals['values_lock']:
+        expire(instance_globals)
+        return '\n'.join('{0} {1}'.format(name, values[name]) for name in args if name in values)
+
+
+# noinspection PyUnusedLocal
+def mset_command(sock, args, instance):
+    """Set or clear several named values at once. Pass names and values in
+pairs, and the names to clear, separated by commas, as clear. A ttl applies to
+every value that is set.
+
+Examples:
+    mset deploy.generation 5 deploy.config blue
+    mset clear=deploy.old,deploy.draining deploy.generation 6
+"""
+    options = extract_name_value_pairs(args)
+    ttl = _ttl(options, ('clear', 'ttl'))
+    cleared = [name for name in options.get('clear', '').split(',') if name]
+    if len(args) % 2 or not (args or cleared):
+        raise Error('mset requires pairs of names and values')
+    pairs = list(zip(args[::2], args[1::2]))
+    if any(name == '*' for name, _ in pairs) or '*' in cleared:
+        raise Error('Value requires a name')
+    instance_globals = instance['globals']
+    with instance_globals['values_lock']:
+        for name in cleared:
+            store(instance_globals, name, None)
+        for name, value in pairs:
+            store(instance_globals, name, value, ttl)
+        changed(instance_globals)
+
+
+# noinspection PyUnusedLocal
+def wait_command(sock, args, instance):
+    """Wait until a named value, or any value matching a wildcard, changes
+after the version given as since. The reply is the current version, followed by
+a line for each value that changed with its name, version and value. A value
+that was removed has no value. If nothing changes before the timeout, only the
+current version is returned. With since=0, the default, every matching value is
+returned at once.
+
+Examples:
+    wait deploy.generation
+    wait since=12 timeout=60 config.*
+"""
+    options = extract_name_value_pairs(args)
+    unknown = set(options) - set(('since', 'timeout'))
+    if unknown:
+        raise Error('Unknown wait options: {0}'.format(', '.join(sorted(unknown))))
+    if not args:
+        raise Error('Value requires a name')
+    try:
+        since = int(options.get('since', 0))
+        timeout = float(options.get('timeout', WAIT_TIMEOUT))
+    except ValueError:
+        raise Error('since must be a version and timeout a number of seconds')
+    return ValueWait(args, since, timeout, instance['globals'])
+
+
+# noinspection PyUnusedLocal
+def renew_command(sock, args, instance):
+    """Renew the lease of values that have a ttl, so that they do not expire
+yet. Pass ttl to change the ttl, or to give a value that has none a ttl. Returns
+the names that were renewed. A value that has already expired is not renewed,
+and renewing a value does not change its version.
+
+Examples:
+    renew worker.1.heartbeat
+    renew ttl=30 worker.*
+"""
+    ttl = _ttl(extract_name_value_pairs(args))
+    if not args:
+        raise Error('Value requires a name')
+    instance_globals = instance['globals']
+    leases = instance_globals['value_expiry'].leases
+    with instance_globals['values_lock']:
+        expire(instance_globals)
+        renewed = []
+        for name, _ in wildcard_iter(instance_globals['values'], args):
+            current = leases.get(name)
+            if ttl or current:
+                lease(instance_globals, name, ttl or current[1])
+                renewed.append(name)
+        return '\n'.join(renewed)
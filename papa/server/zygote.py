@@ -0,0 +1,279 @@
+"""A warm Python interpreter that forks workers for papa.
+
+papa starts this file with the Python executable of a zygote process, the
+numbers of its control socket and exit pipe, and the modules to import:
+
+    python zygote.py CONTROL_FD EXITS_FD module ...
+
+Once the modules are imported it sends a ready message and then forks a
+worker for each spawn request on the control socket. A request carries the
+file descriptors the worker should get as ancillary data, and the worker
+moves each one to the matching number in 'targets'. The exit status of every
+worker is written to the exit pipe as a line of "pid returncode".
+
+This file is run by path, so it must not import anything from papa. papa
+imports it for send_message and receive_message, so the modules that only the
+zygote and its workers need are imported where they are used.
+"""
+import os
+import sys
+import json
+import errno
+import fcntl
+import select
+import signal
+import socket
+import struct
+from array import array
+
+__author__ = 'Scott Maxwell'
+
+HEADER = struct.Struct('!I')
+
+# the most file descriptors Linux passes in a single message
+MAX_FDS = 253
+
+
+def send_message(sock, message, fds=()):
+    data = json.dumps(message).encode('utf8')
+    data = HEADER.pack(len(data)) + data
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array('i', fds))] if fds else []
+    sent = sock.sendmsg([data], ancillary)
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def receive_message(sock):
+    """Return a message and the file descriptors sent with it, or None if
+    the other end has closed the socket"""
+    data, ancillary, flags, address = sock.recvmsg(65536, socket.CMSG_SPACE(MAX_FDS * 4))
+    if not data:
+        return None, []
+    fds = array('i')
+    for level, kind, cdata in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    while len(data) < HEADER.size or len(data) < HEADER.size + HEADER.unpack_from(data)[0]:
+        more = sock.recv(65536)
+        if not more:
+            raise EOFError('Connection closed in the middle of a message')
+        data += more
+    size = HEADER.unpack_from(data)[0]
+    return json.loads(data[HEADER.size:HEADER.size + size].decode('utf8')), list(fds)
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _close_all_but(keep):
+    try:
+        max_fd = os.sysconf('SC_OPEN_MAX')
+    except (AttributeError, ValueError):
+        max_fd = 65536
+    low = 0
+    for fd in sorted(keep) + [max_fd]:
+        # closerange(0, 0) closes every fd on some Pythons
+        if fd > low:
+            os.closerange(low, fd)
+        low = fd + 1
+
+
+def _set_up_worker(request, fds, status, floor):
+    """Turn the forked child into the worker described by the request"""
+    os.setsid()
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    # move everything above the target numbers first, so that putting one
+    # fd in place cannot clobber another one that has not been moved yet
+    targets = request['targets']
+    moved = [fcntl.fcntl(fd, fcntl.F_DUPFD, floor) for fd in fds]
+    for fd, target in zip(moved, targets):
+        os.dup2(fd, target)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        if fd not in targets:
+            os.dup2(devnull, fd)
+    _close_all_but(set(targets) | set((0, 1, 2, status)))
+
+    if request['rlimits']:
+        import resource
+        for limit, value in request['rlimits']:
+            resource.setrlimit(limit, (value, value))
+    if request['gid'] is not None:
+        os.setgid(request['gid'])
+        if request['groups'] is not None:
+            try:
+                os.setgroups(request['groups'])
+            except OSError:
+                # only root can set the supplementary groups
+                pass
+    if request['uid'] is not None:
+        os.setuid(request['uid'])
+    if request['cwd']:
+        os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+
+
+def _run(args):
+    """Run the arguments the way the python command line would"""
+    import runpy
+    if args[0] == '-c':
+        if len(args) < 2:
+            raise ValueError('-c requires an argument')
+        sys.argv = ['-c'] + args[2:]
+        sys.path[0] = ''
+        main = sys.modules['__main__'] = type(sys)('__main__')
+        exec(compile(args[1], '<string>', 'exec'), main.__dict__)
+    elif args[0] == '-m':
+        if len(args) < 2:
+            raise ValueError('-m requires an argument')
+        sys.argv = [args[1]] + args[2:]
+        sys.path[0] = os.getcwd()
+        runpy.run_module(args[1], run_name='__main__', alter_sys=True)
+    elif args[0].startswith('-'):
+        raise ValueError('Unsupported python option {0}'.format(args[0]))
+    else:
+        sys.argv = list(args)
+        sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+        runpy.run_path(args[0], run_name='__main__')
+
+
+def _worker_main(request, fds, status):
+    # the status pipe must survive the fds being put in place
+    floor = max(request['targets'] + [2]) + 1
+    status = fcntl.fcntl(status, fcntl.F_DUPFD, floor)
+    try:
+        _set_up_worker(request, fds, status, floor)
+    except BaseException as e:
+        os.write(status, str(e).encode('utf8', 'replace') or b'Failed')
+        os._exit(255)
+    os.close(status)
+
+    try:
+        _run(request['args'])
+        code = 0
+    except SystemExit as e:
+        code = e.code
+        if code is None:
+            code = 0
+        elif not isinstance(code, int):
+            sys.stderr.write('{0}\n'.format(code))
+            code = 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    try:
+        import atexit
+        getattr(atexit, '_run_exitfuncs', lambda: None)()
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+    os._exit(code)
+
+
+def spawn(control, request, fds):
+    """Fork a worker and return its pid once it is set up"""
+    if not request.get('args'):
+        raise ValueError('No command')
+    read_status, write_status = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if not pid:
+        # the worker must not close the zygote's end of the control socket
+        control.detach()
+        os.close(read_status)
+        _worker_main(request, fds, write_status)
+    os.close(write_status)
+    try:
+        message = b''
+        while True:
+            data = os.read(read_status, 4096)
+            if not data:
+                break
+            message += data
+    finally:
+        os.close(read_status)
+    if message:
+        raise ValueError(message.decode('utf8', 'replace'))
+    return pid
+
+
+def reap(workers, exits):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.ECHILD:
+                return
+            raise
+        if not pid:
+            return
+        if pid in workers:
+            workers.remove(pid)
+            os.write(exits, '{0} {1}\n'.format(pid, exit_code(status)).encode('ascii'))
+
+
+def serve(control, exits):
+    wake_read, wake_write = os.pipe()
+    for fd in (wake_read, wake_write):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wake_write)
+    # a handler is needed for the signal to be written to the wakeup fd
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    workers = set()
+    while True:
+        readable = select.select([control, wake_read], [], [])[0]
+        if wake_read in readable:
+            try:
+                while os.read(wake_read, 4096):
+                    pass
+            except OSError:
+                pass
+        reap(workers, exits)
+        if control in readable:
+            request, fds = receive_message(control)
+            if request is None:
+                return
+            try:
+                pid = spawn(control, request, fds)
+            except Exception as e:
+                send_message(control, {'error': str(e)})
+            else:
+                workers.add(pid)
+                send_message(control, {'pid': pid})
+            finally:
+                for fd in fds:
+                    os.close(fd)
+
+
+def main(argv):
+    from importlib import import_module
+    control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, 0, int(argv[1]))
+    exits = int(argv[2])
+    # imports are relative to the working directory, not to this file
+    sys.path[0] = os.getcwd()
+    for module in argv[3:]:
+        try:
+            import_module(module)
+        except BaseException as e:
+            send_message(control, {'error': 'Could not import {0} - {1}'.format(module, e)})
+            return 1
+    send_message(control, {'ready': os.getpid()})
+    serve(control, exits)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
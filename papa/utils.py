@@ -4,20 +4,38 @@ import select
 
 __author__ = 'Scott Maxwell'
 
-valid_families = dict((name[3:].lower(), getattr(socket, name))
-                      for name in dir(socket)
-                      if name.startswith('AF_') and getattr(socket, name))
-valid_families_by_number = dict((value, name)
-                                for name, value in valid_families.items())
-valid_types = dict((name[5:].lower(), getattr(socket, name))
-                   for name in dir(socket)
-                   if name.startswith('SOCK_'))
-valid_types_by_number = dict((value, name)
-                             for name, value in valid_types.items())
-
 PY2 = sys.version_info[0] < 3
 
 
+def _socket_tables():
+    valid_families = dict((name[3:].lower(), getattr(socket, name))
+                          for name in dir(socket)
+                          if name.startswith('AF_') and getattr(socket, name))
+    valid_types = dict((name[5:].lower(), getattr(socket, name))
+                       for name in dir(socket)
+                       if name.startswith('SOCK_'))
+    return {
+        'valid_families': valid_families,
+        'valid_families_by_number': dict((value, name) for name, value in valid_families.items()),
+        'valid_types': valid_types,
+        'valid_types_by_number': dict((value, name) for name, value in valid_types.items()),
+    }
+
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # build the socket family and type tables on first use, since most
+        # clients never need them
+        if name.startswith('valid_'):
+            tables = _socket_tables()
+            globals().update(tables)
+            if name in tables:
+                return tables[name]
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+else:
+    globals().update(_socket_tables())
+
+
 class Error(RuntimeError):
     pass
 
@@ -78,23 +96,30 @@ def extract_name_value_pairs(args):
 
 
 def wildcard_iter(d, matches, required=False):
+    """Yield the (name, value) pairs whose names match. A match ending in *
+    matches every name with that prefix. If d keeps a sorted index of its
+    names, like the server registries do, prefixes are looked up in it and
+    the pairs come out in name order."""
+    with_prefix = getattr(d, 'with_prefix', None)
     if not matches or matches == '*':
-        matched = set(d.keys())
+        matched = list(d.names) if with_prefix else list(d.keys())
     else:
-        matched = set()
+        matched = []
         for match in matches:
             if match and match[-1] == '*':
                 match = match[:-1]
-                if not match:
-                    matched = set(d.keys())
+                if with_prefix:
+                    matched.extend(with_prefix(match))
                 else:
-                    for name in d.keys():
-                        if name.startswith(match):
-                            matched.add(name)
+                    matched.extend(name for name in d.keys() if name.startswith(match))
             elif match in d:
-                matched.add(match)
+                matched.append(match)
             elif required:
                 raise Error('{0} not found'.format(match))
+        if len(matches) > 1:
+            matched = set(matched)
+            if with_prefix:
+                matched = sorted(matched)
     for name in matched:
         yield name, d[name]
 
@@ -110,7 +135,20 @@ def recv_with_retry(sock, size=1024):
                 raise
 
 
+def recv_into_with_retry(sock, buffer, size=0):
+    while True:
+        try:
+            return sock.recv_into(buffer, size)
+        except socket.error as e:
+            if e.errno == 35:
+                select.select([sock], [], [])
+            else:
+                raise
+
+
 def send_with_retry(sock, data):
+    # slicing a memoryview after a partial send does not copy the rest
+    data = memoryview(data)
     while data:
         try:
             sent = sock.send(data)
@@ -3,14 +3,17 @@ import os
 import sys
 import os.path
 import socket
-from time import sleep
+from time import sleep, time
 try:
     # noinspection PyPackageRequirements
     import unittest2 as unittest
 except ImportError:
     import unittest
 import select
+import subprocess
+import threading
 import papa
+from papa import protocol
 from papa.server.papa_socket import unix_socket
 from papa.utils import cast_bytes
 from tempfile import gettempdir
@@ -156,6 +159,153 @@ class SocketTest(unittest.TestCase):
             self.assertEqual(['inet.0', 'inet.1', 'other'], sorted(reply.keys()))
 
 
+class OutputQueueTest(unittest.TestCase):
+    def test_buffer_size_is_enforced(self):
+        from papa.server.proc import OutputQueue
+        q = OutputQueue(100)
+        cursor = q.open_cursor()
+        for i in range(10000):
+            q.add(OutputQueue.STDOUT, cast_bytes('line {0:05}\n'.format(i)))
+        seq, items = q.retrieve(cursor)
+        self.assertEqual(10000, seq)
+        self.assertLessEqual(sum(len(item.data) for item in items), 100)
+        self.assertEqual(b'line 09999\n', items[-1].data.tobytes())
+        self.assertEqual(list(range(10000 - len(items), 10000)), [item.seq for item in items])
+        view = items[-1].data
+        for i in range(20):
+            q.add(OutputQueue.STDERR, b'x' * 50)
+        self.assertEqual(b'line 09999\n', view.tobytes())
+        q.acknowledge(cursor, q.retrieve(cursor)[0])
+        self.assertEqual(0, len(q))
+
+    def test_pinned_output_is_only_moved_once(self):
+        from papa.server.proc import OutputQueue
+        q = OutputQueue(100)
+        reallocations = []
+        reallocate = q._reallocate
+        q._reallocate = lambda limit: reallocations.append(limit) or reallocate(limit)
+        cursor = q.open_cursor()
+        q.add(OutputQueue.STDOUT, b'pinned\n')
+        view = q.retrieve(cursor)[1][0].data
+        for i in range(1000):
+            q.add(OutputQueue.STDOUT, cast_bytes('line {0:05}\n'.format(i)))
+        # once the pinned chunk has moved out, the new buffer is free to wrap
+        self.assertEqual(1, len(reallocations))
+        self.assertEqual(b'pinned\n', view.tobytes())
+        seq, items = q.retrieve(cursor)
+        self.assertEqual(b'line 00999\n', items[-1].data.tobytes())
+        q.acknowledge(cursor, seq)
+
+
+class RegistryTest(unittest.TestCase):
+    def test_prefix_lookup_is_sorted(self):
+        from papa.server.registry import Registry
+        from papa.utils import wildcard_iter
+        r = Registry()
+        for i in range(999, -1, -1):
+            r['worker.{0:03}'.format(i)] = i
+        r['web'] = 'w'
+        r['worker'] = 'x'
+        r['workers.pool'] = 'y'
+        del r['worker.500']
+        self.assertEqual('y', r.pop('workers.pool'))
+        self.assertEqual(None, r.pop('workers.pool', None))
+        r.setdefault('web.1', 'w1')
+        self.assertEqual(sorted(r), r.names)
+
+        names = [name for name, _ in wildcard_iter(r, ['worker.*'])]
+        self.assertEqual(['worker.{0:03}'.format(i) for i in range(1000) if i != 500], names)
+        self.assertEqual(['web', 'web.1', 'worker', 'worker.000'], [name for name, _ in wildcard_iter(r, ['worker.000', 'web*', 'worker'])])
+        self.assertEqual(sorted(r), [name for name, _ in wildcard_iter(r, '*')])
+        self.assertEqual([], r.with_prefix('zz'))
+        self.assertRaises(papa.Error, list, wildcard_iter(r, ['worker.500'], True))
+
+        r.clear()
+        r.update({'b': 2, 'a': 1})
+        self.assertEqual(['a', 'b'], r.names)
+
+
+class ImportTest(unittest.TestCase):
+    @staticmethod
+    def modules_loaded_by(module):
+        code = '\n'.join((
+            'import sys, socket, select, threading, struct',
+            'before = set(sys.modules)',
+            'import {0}'.format(module),
+            'sys.stdout.write(" ".join(sorted(set(sys.modules) - before)))',
+        ))
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(here))
+        return subprocess.check_output([sys.executable, '-c', code], env=env).decode('utf-8').split()
+
+    def test_client_imports(self):
+        # papa is imported by short-lived scripts, so the client must not
+        # pull in the server, subprocess, logging or json
+        self.assertEqual(['papa', 'papa.protocol', 'papa.utils'], self.modules_loaded_by('papa'))
+
+    def test_server_imports(self):
+        # what only spawning a process needs waits until a process is spawned
+        modules = self.modules_loaded_by('papa.server')
+        self.assertIn('papa.server.proc', modules)
+        self.assertNotIn('resource', modules)
+        self.assertNotIn('argparse', modules)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        papa.set_debug_mode(quit_when_connection_closed=True)
+
+    def test_start_daemon_process(self):
+        self.start_daemon_process()
+
+    def test_start_daemon_process_with_popen(self):
+        # Python 3.4 to 3.7 have no posix_spawn, and their pipes are not inherited
+        posix_spawn = getattr(os, 'posix_spawn', None)
+        if posix_spawn:
+            del os.posix_spawn
+        try:
+            self.start_daemon_process()
+        finally:
+            if posix_spawn:
+                os.posix_spawn = posix_spawn
+
+    def start_daemon_process(self):
+        path = os.path.join(gettempdir(), 'papa.daemon.{0}.sock'.format(os.getpid()))
+        papa.set_debug_mode(False)
+        try:
+            t = time()
+            with papa.Papa(path) as p:
+                self.assertLess(time() - t, 5)
+                # the daemon is a new process in its own session, not a fork
+                # of this one
+                p.make_process('daemon.session', sys.executable, args=('-c', 'import os, sys; sys.stdout.write(str(os.getsid(os.getppid())))'))
+                with p.watch_processes('daemon.session') as w:
+                    out = b''
+                    while w:
+                        reply = w.read()
+                        if reply:
+                            out += b''.join(line.data for line in reply[0])
+                self.assertNotEqual(os.getsid(0), int(out))
+                self.assertTrue(p.exit_if_idle())
+        finally:
+            papa.Papa.spawned = False
+            papa.set_debug_mode(quit_when_connection_closed=True)
+
+    def test_many_concurrent_clients(self):
+        with papa.Papa() as p:
+            thread_count = threading.active_count()
+            clients = [papa.Papa() for _ in range(100)]
+            try:
+                for i, client in enumerate(clients):
+                    client.set('client.{0}'.format(i), str(i))
+                self.assertLessEqual(threading.active_count(), thread_count)
+                self.assertEqual(100, len(p.list_values('client.*')))
+                self.assertEqual('42', clients[7].get('client.42'))
+            finally:
+                for client in clients:
+                    client.close()
+            p.remove_values('client.*')
+
+
 class ValueTest(unittest.TestCase):
     def setUp(self):
         papa.set_debug_mode(quit_when_connection_closed=True)
@@ -193,11 +343,199 @@ class ValueTest(unittest.TestCase):
             p.remove_values('aack*')
             self.assertDictEqual({'bar': 'aack'}, p.list_values())
 
+    def test_value_with_spaces_and_newlines(self):
+        with papa.Papa() as p:
+            self.assertTrue(p.connection.binary)
+            value = ' leading  and\ntrailing\\ '
+            p.set('spaces', value)
+            self.assertEqual(value, p.get('spaces'))
+            p.remove_values('spaces')
+
+    def test_text_protocol(self):
+        with papa.Papa() as p:
+            p.set('aack', 'bar')
+            connection = papa.ClientCommandConnection(p.family, p.location)
+            try:
+                connection.get_full_response()
+                self.assertEqual('bar', connection.do_command(protocol.GET, ['aack']))
+                self.assertRaises(papa.Error, connection.do_command, protocol.REMOVE_VALUES)
+            finally:
+                connection.close()
+            p.remove_values('aack')
+
+    def test_batch(self):
+        with papa.Papa() as p:
+            with p.batch() as batch:
+                for i in range(100):
+                    batch.set('batch.{0}'.format(i), str(i))
+                value = batch.get('batch.42')
+                values = batch.list_values('batch.*')
+                self.assertRaises(papa.Error, getattr, value, 'result')
+            self.assertEqual('42', value.result)
+            self.assertEqual(100, len(values.result))
+
+            batch = p.batch()
+            missing = batch.get('batch.missing')
+            bad = batch.remove_values()
+            removed = batch.remove_values('batch.*')
+            self.assertRaises(papa.Error, batch.send)
+            self.assertEqual(None, missing.result)
+            self.assertRaises(papa.Error, getattr, bad, 'result')
+            self.assertTrue(removed.result)
+            self.assertDictEqual({}, p.list_values('batch.*'))
+
+    def test_pipelined_text_commands(self):
+        with papa.Papa() as p:
+            connection = papa.ClientCommandConnection(p.family, p.location)
+            try:
+                connection.get_full_response()
+                replies = connection.do_commands([(protocol.SET, ['aack', 'bar']), (protocol.GET, ['aack']), (protocol.REMOVE_VALUES, []), (protocol.REMOVE_VALUES, ['aack'])])
+                self.assertEqual([('', None), ('bar', None)], replies[:2])
+                self.assertIsInstance(replies[2][1], papa.Error)
+                self.assertEqual(('', None), replies[3])
+            finally:
+                connection.close()
+
     def test_wildcard_clear(self):
         with papa.Papa() as p:
             self.assertRaises(papa.Error, p.remove_values)
             self.assertRaises(papa.Error, p.remove_values, '*')
 
+    def test_atomic_operations(self):
+        with papa.Papa() as p:
+            self.assertEqual(1, p.incr('atomic.count'))
+            self.assertEqual(11, p.incr('atomic.count', 10))
+            self.assertEqual(9, p.decr('atomic.count', 2))
+            self.assertEqual('9', p.get('atomic.count'))
+
+            def count():
+                with papa.Papa() as p2:
+                    for _ in range(50):
+                        p2.incr('atomic.count')
+
+            threads = [threading.Thread(target=count) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual('109', p.get('atomic.count'))
+
+            p.set('atomic.name', 'aack')
+            self.assertRaises(papa.Error, p.incr, 'atomic.name')
+
+            self.assertTrue(p.setnx('atomic.leader', 'one'))
+            self.assertFalse(p.setnx('atomic.leader', 'two'))
+            self.assertFalse(p.cas('atomic.leader', 'two', 'three'))
+            self.assertTrue(p.cas('atomic.leader', 'one', 'two'))
+            self.assertTrue(p.cas('atomic.leader', 'two', None))
+            self.assertTrue(p.cas('atomic.leader', None, 'four'))
+            self.assertEqual('four', p.get('atomic.leader'))
+
+            p.mset({'atomic.a': 'one two', 'atomic.b': '2', 'atomic.name': None})
+            self.assertDictEqual({'atomic.a': 'one two', 'atomic.b': '2', 'atomic.name': None, 'atomic.*': None},
+                                 p.mget('atomic.a', 'atomic.b', 'atomic.name', 'atomic.*'))
+
+            connection = papa.ClientCommandConnection(p.family, p.location)
+            try:
+                connection.get_full_response()
+                self.assertEqual('1', connection.do_command(protocol.CAS, ['unset=1', 'atomic.text', 'one']))
+                self.assertEqual('0', connection.do_command(protocol.CAS, ['unset=1', 'atomic.text', 'two']))
+                self.assertEqual('1', connection.do_command(protocol.CAS, ['atomic.text', 'one']))
+                connection.do_command(protocol.MSET, ['clear=atomic.a,atomic.b', 'atomic.c', '3'])
+            finally:
+                connection.close()
+            self.assertDictEqual({'atomic.count': '109', 'atomic.c': '3', 'atomic.leader': 'four'}, p.list_values('atomic.*'))
+            p.remove_values('atomic.*')
+
+    def test_wait_for_changes(self):
+        with papa.Papa() as p:
+            p.set('config.color', 'blue')
+            p.set('other', 'x')
+            version, changes = p.wait('config.*')
+            self.assertDictEqual({'config.color': (version - 1, 'blue')}, changes)
+
+            t = time()
+            self.assertEqual((version, {}), p.wait('config.*', since=version, timeout=.2))
+            self.assertGreater(time() - t, .15)
+
+            def change():
+                sleep(.2)
+                with papa.Papa() as p2:
+                    p2.set('other', 'y')
+                    p2.mset({'config.color': 'green', 'config.size': 'large'})
+
+            t = time()
+            threading.Thread(target=change).start()
+            new_version, changes = p.wait('config.*', since=version, timeout=10)
+            self.assertLess(time() - t, 5)
+            self.assertDictEqual({'config.color': (new_version - 1, 'green'), 'config.size': (new_version, 'large')}, changes)
+
+            p.remove_values('config.size')
+            version, changes = p.wait('config.size', 'config.color', since=new_version)
+            self.assertDictEqual({'config.size': (version, None)}, changes)
+            # a version from before papa was restarted gets every value
+            self.assertDictEqual({'config.color': (new_version - 1, 'green')}, p.wait('config.*', since=version + 100)[1])
+            p.remove_values('config.*', 'other')
+
+    def test_ttl_and_renew(self):
+        with papa.Papa() as p:
+            p.set('ttl.heartbeat', 'alive', ttl=.3)
+            p.set('ttl.forever', 'here')
+            self.assertTrue(p.setnx('ttl.lock', 'me', ttl=.3))
+            self.assertEqual(['ttl.heartbeat', 'ttl.lock'], p.renew('ttl.*'))
+            version, _ = p.wait('ttl.*')
+
+            sleep(.2)
+            self.assertEqual(['ttl.heartbeat'], p.renew('ttl.heartbeat', ttl=5))
+            # the lock expires without anyone asking, and waiters hear of it
+            version, changes = p.wait('ttl.*', since=version, timeout=5)
+            self.assertDictEqual({'ttl.lock': (version, None)}, changes)
+            self.assertDictEqual({'ttl.heartbeat': 'alive', 'ttl.forever': 'here'}, p.list_values('ttl.*'))
+            self.assertEqual([], p.renew('ttl.lock'))
+            self.assertTrue(p.setnx('ttl.lock', 'you'))
+
+            # setting a value again without a ttl keeps it for good
+            p.set('ttl.heartbeat', 'alive')
+            self.assertEqual([], p.renew('ttl.heartbeat'))
+            self.assertRaises(papa.Error, p.set, 'ttl.bad', 'x', ttl=0)
+            p.remove_values('ttl.*')
+
+    def test_expiry_wheel(self):
+        from papa.server.values import Expiry, EXPIRY_RESOLUTION
+        expiry = Expiry()
+        for i in range(1000):
+            expiry.add('key.{0}'.format(i), 10, 1000.0 + i % 10)
+        expiry.add('key.5', 10, 2000.0)
+        expiry.discard('key.6')
+        self.assertEqual(11, len(expiry.heap))
+        due = expiry.due(1004.5)
+        self.assertEqual(500, len(due))
+        self.assertNotIn('key.5', due)
+        # never early, and at most one bucket late
+        self.assertTrue(1005.0 <= expiry.next_deadline() <= 1005.0 + EXPIRY_RESOLUTION * 1.01)
+        self.assertEqual(498, len(expiry.due(1100.0)))
+        self.assertEqual(['key.5'], expiry.due(2000.0))
+        self.assertEqual(({}, [], {}), (expiry.leases, expiry.heap, expiry.buckets))
+
+    def test_values_do_not_wait_for_other_registries(self):
+        from papa.server import make_instance_globals, values
+        instance = {'globals': make_instance_globals()}
+        instance_globals = instance['globals']
+        result = []
+
+        def health_check():
+            values.set_command(None, ['health', 'ok'], instance)
+            result.append(values.get_command(None, ['health'], instance))
+            result.append(values.values_command(None, [], instance))
+
+        # a client that is spawning processes or making sockets holds
+        # these locks
+        with instance_globals['processes_lock'], instance_globals['sockets_lock']:
+            t = threading.Thread(target=health_check)
+            t.start()
+            t.join(5)
+            self.assertEqual(['ok', 'health ok'], result)
+
 
 class ProcessTest(unittest.TestCase):
     def setUp(self):
@@ -595,6 +933,261 @@ class ProcessTest(unittest.TestCase):
 
             self.assertEqual('t1', p.get('p1'))
 
+    def test_thread_count_does_not_grow_with_processes(self):
+        with papa.Papa() as p:
+            p.set('warm', 'up')
+            thread_count = threading.active_count()
+            for i in range(20):
+                p.make_process('write3.{0}'.format(i), sys.executable, args='executables/write_three_lines.py', working_dir=here, env=os.environ)
+            self.assertLessEqual(threading.active_count(), thread_count + 1)
+            with p.watch_processes('write3.*') as w:
+                out, err, close = self.gather_output(w)
+            self.assertEqual(20, len(close))
+            self.assertEqual(20, len(err))
+            self.assertDictEqual({}, p.list_processes())
+
+    def test_watch_is_notified_immediately(self):
+        with papa.Papa() as p:
+            p.make_process('slow', sys.executable, args=('-c', 'import sys, time; time.sleep(1.5); sys.stdout.write("late"); sys.stdout.flush(); time.sleep(.2)'))
+            with p.watch_processes('slow') as w:
+                out, err, close = w.read()
+                received = time()
+                self.assertEqual(b'late', out[0].data)
+                self.assertLess(received - out[0].timestamp, .1)
+                self.gather_output(w)
+
+    def test_parallel_watchers_each_get_all_output(self):
+        with papa.Papa() as p1, papa.Papa() as p2:
+            p1.make_process('write3', sys.executable, args='executables/write_three_lines.py', working_dir=here, uid=os.environ['LOGNAME'], env=os.environ)
+            with p1.watch_processes('write3') as w1, p2.watch_processes('write3') as w2:
+                out1, err1, close1 = self.gather_output(w1)
+                out2, err2, close2 = self.gather_output(w2)
+            self.assertEqual(3, len(out1))
+            self.assertEqual(b''.join(item.data for item in out1), b''.join(item.data for item in out2))
+            self.assertEqual(b''.join(item.data for item in err1), b''.join(item.data for item in err2))
+            self.assertEqual(1, len(close1))
+            self.assertEqual(1, len(close2))
+
+    def test_process_runs_in_new_session_without_stdin(self):
+        with papa.Papa() as p:
+            p.make_process('session', sys.executable, args=('-c', 'import os, sys; sys.stdout.write("{0} {1}".format(os.getsid(0) == os.getpid(), repr(sys.stdin.read())))'))
+            with p.watch_processes('session') as w:
+                out, err, close = self.gather_output(w)
+            self.assertEqual(b"True ''", out[0].data)
+            self.assertEqual(0, close[0].data)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'requires /proc')
+    def test_process_only_inherits_its_sockets(self):
+        with papa.Papa() as p:
+            fileno = p.make_socket('inherited')['fileno']
+            p.make_process('fds', sys.executable, args=('-c', 'import os, sys; sys.stdout.write(" ".join(sorted(os.listdir("/proc/self/fd"), key=int)))', '$(socket.inherited.fileno)'))
+            with p.watch_processes('fds') as w:
+                out, err, close = self.gather_output(w)
+            fds = set(int(fd) for fd in out[0].data.split())
+            # the extra one is the fd of the directory being listed
+            self.assertEqual(5, len(fds))
+            self.assertTrue(set((0, 1, 2, fileno)) < fds)
+            p.remove_sockets('inherited')
+
+    def test_zygote_process(self):
+        with papa.Papa() as p:
+            port = p.make_socket('zygote.socket')['port']
+            code = 'import os, socket, sys; ' \
+                   's = socket.fromfd(int(sys.argv[1]), socket.AF_INET, socket.SOCK_STREAM); ' \
+                   'sys.stdout.write(" ".join(map(str, ["xml.dom.minidom" in sys.modules, os.environ["WORKER"], os.getsid(0) == os.getpid(), s.getsockname()[1], os.getppid()]))); ' \
+                   'sys.stderr.write("oops"); sys.exit(3)'
+            parents = set()
+            for worker in ('1', '2'):
+                name = 'zygote.worker.' + worker
+                reply = p.make_process(name, sys.executable, args=('-c', code, '$(socket.zygote.socket.fileno)'), env={'WORKER': worker}, zygote='xml.dom.minidom')
+                self.assertEqual('xml.dom.minidom', reply['zygote'])
+                with p.watch_processes(name) as w:
+                    out, err, close = self.gather_output(w)
+                imported, env, leader, sock_port, parent = out[0].data.decode('utf-8').split()
+                self.assertEqual('True', imported)
+                self.assertEqual(worker, env)
+                self.assertEqual('True', leader)
+                self.assertEqual(str(port), sock_port)
+                self.assertEqual(b'oops', err[0].data)
+                self.assertEqual(3, close[0].data)
+                parents.add(parent)
+            # both workers were forked by the same zygote
+            self.assertEqual(1, len(parents))
+            p.remove_sockets('zygote.socket')
+
+    def test_process_replicas(self):
+        with papa.Papa() as p:
+            port = p.make_socket('replica.socket', reuseport=True)['port']
+            code = 'import socket, sys; s = socket.fromfd(int(sys.argv[1]), socket.AF_INET, socket.SOCK_STREAM); sys.stdout.write(str(s.getsockname()[1]))'
+            reply = p.make_process('replica', sys.executable, args=('-c', code, '$(socket.replica.socket.fileno)'), count=3)
+            self.assertEqual(['replica.0', 'replica.1', 'replica.2'], sorted(reply))
+            self.assertEqual(3, len(set(info['pid'] for info in reply.values())))
+            with p.watch_processes('replica.*') as w:
+                out, err, close = self.gather_output(w)
+            self.assertEqual(['replica.0', 'replica.1', 'replica.2'], sorted(line.name for line in out))
+            self.assertEqual(set([str(port)]), set(line.data.decode('utf-8') for line in out))
+            self.assertEqual([0, 0, 0], [line.data for line in close])
+            p.remove_sockets('replica.socket')
+
+    def test_dependency_ordered_startup(self):
+        with papa.Papa() as p:
+            def process(*after):
+                return {'args': [sys.executable, '-c', 'pass'], 'after': list(after)}
+            reply = p.apply({'processes': {'db': process(), 'cache': process(), 'app': process('db', 'cache'), 'web': process('app')}})
+            self.assertEqual(set(['created']), set(result['action'] for result in reply['processes'].values()))
+            started = dict((name, info['started']) for name, info in p.list_processes().items())
+            self.assertLessEqual(max(started['db'], started['cache']), started['app'])
+            self.assertLessEqual(started['app'], started['web'])
+
+            self.assertRaises(papa.Error, p.apply, {'processes': {'a': process('b'), 'b': process('a')}})
+            self.assertRaises(papa.Error, p.make_process, 'orphan', sys.executable, args=('-c', 'pass'), after='missing')
+            p.make_process('late', sys.executable, args=('-c', 'pass'), after='web')
+            p.remove_processes('*')
+
+    def test_ready_conditions(self):
+        with papa.Papa() as p:
+            t = time()
+            reply = p.make_process('ready.output', sys.executable, args=('-c', 'import sys, time; time.sleep(.3); sys.stderr.write("Listening on 8080\\n"); sys.stderr.flush(); time.sleep(5)'), ready={'output': 'Listening on \\d+'})
+            self.assertTrue(reply['running'])
+            self.assertGreaterEqual(time() - t, .3)
+
+            p.make_socket('ready.socket')
+            code = 'import socket, sys, time; time.sleep(.3); s = socket.fromfd(int(sys.argv[1]), socket.AF_INET, socket.SOCK_STREAM); s.accept(); time.sleep(5)'
+            t = time()
+            p.make_process('ready.accept', sys.executable, args=('-c', code, '$(socket.ready.socket.fileno)'), ready={'socket': 'ready.socket'})
+            self.assertGreaterEqual(time() - t, .3)
+
+            def set_flag():
+                with papa.Papa() as other:
+                    other.set('ready.flag', 'go')
+            setter = threading.Timer(.3, set_flag)
+            setter.start()
+            t = time()
+            p.make_process('ready.value', sys.executable, args=('-c', 'import time; time.sleep(5)'), ready={'value': 'ready.flag'})
+            self.assertGreaterEqual(time() - t, .3)
+            setter.join()
+
+            self.assertRaises(papa.Error, p.make_process, 'ready.never', sys.executable, args=('-c', 'pass'), ready={'output': 'never', 'timeout': 5})
+            self.assertRaises(papa.Error, p.make_process, 'ready.slow', sys.executable, args=('-c', 'import time; time.sleep(5)'), ready={'value': 'ready.missing', 'timeout': .2})
+            p.remove_processes('ready.*')
+            p.remove_sockets('ready.socket')
+            p.remove_values('ready.*')
+
+    def test_rolling_restart(self):
+        with papa.Papa() as p:
+            p.make_socket('rolling.socket', reuseport=True)
+            code = 'import socket, sys, time; s = socket.fromfd(int(sys.argv[1]), socket.AF_INET, socket.SOCK_STREAM); sys.stdout.write("up\\n"); sys.stdout.flush(); time.sleep(30)'
+            old = p.make_process('rolling', sys.executable, args=('-c', code, '$(socket.rolling.socket.fileno)'), count=2, ready={'output': 'up'})
+            t = time()
+            new = p.restart_processes('rolling.*', drain=.5, signal='TERM')
+            self.assertLess(time() - t, 10)
+            self.assertEqual(['rolling.0', 'rolling.1'], sorted(new))
+            self.assertFalse(set(info['pid'] for info in old.values()) & set(info['pid'] for info in new.values()))
+            self.assertEqual(sorted(new), sorted(p.list_processes('rolling.*')))
+            self.assertTrue(all(info['running'] for info in p.list_processes('rolling.*').values()))
+
+            self.assertRaises(papa.Error, p.restart_processes, 'rolling.*', floor=5)
+            self.assertEqual(['rolling.0', 'rolling.1'], sorted(p.list_processes('rolling.*')))
+            self.assertRaises(papa.Error, p.restart_processes, 'rolling.*', signal='NOPE')
+            p.remove_processes('rolling.*')
+            p.remove_sockets('rolling.socket')
+
+    def test_reexec(self):
+        path = os.path.join(gettempdir(), 'papa.reexec.{0}.sock'.format(os.getpid()))
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(here))
+        server = subprocess.Popen([sys.executable, '-c', 'from papa.server import main; main()', '-u', path], env=env)
+        try:
+            deadline = time() + 10
+            while True:
+                s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    s.connect(path)
+                    break
+                except socket.error:
+                    self.assertLess(time(), deadline)
+                    sleep(.05)
+                finally:
+                    s.close()
+            with papa.Papa(path) as p:
+                before = p.make_socket('reexec.socket')
+                p.set('reexec.value', 'kept')
+                p.set('reexec.lease', 'short', ttl=30)
+                code = 'import sys, time; print("before"); sys.stdout.flush(); time.sleep(1); print("after")'
+                process = p.make_process('reexec.process', sys.executable, args=('-c', code), ready={'output': 'before'})
+                self.assertTrue(p.reexec())
+
+                self.assertEqual(before, p.list_sockets('reexec.socket')['reexec.socket'])
+                self.assertEqual('kept', p.get('reexec.value'))
+                self.assertEqual(['reexec.lease'], p.renew('reexec.*'))
+                self.assertEqual(process['pid'], p.list_processes('reexec.process')['reexec.process']['pid'])
+                with p.watch_processes('reexec.process') as w:
+                    out, err, close = self.gather_output(w)
+                self.assertEqual(b'before\nafter\n', b''.join(line.data for line in out))
+                self.assertEqual([0], [line.data for line in close])
+                self.assertIsNone(server.poll())
+        finally:
+            server.terminate()
+            server.wait()
+
+    def test_reexec_failure_carries_on(self):
+        from papa.server import reexec, make_instance_globals
+        from papa.server.loop import get_reactor
+        reactor = get_reactor()
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.bind(('127.0.0.1', 0))
+        listen_socket.listen(1)
+        execv = os.execv
+
+        def fail(*args):
+            raise OSError(2, 'No such file or directory')
+        os.execv = fail
+        try:
+            reexec.reexec(listen_socket, make_instance_globals(daemon=True))
+            self.assertFalse(reexec.get_inheritable(listen_socket.fileno()))
+        finally:
+            os.execv = execv
+            listen_socket.close()
+        self.assertIs(reactor, get_reactor())
+        ran = threading.Event()
+        reactor.call_soon_threadsafe(ran.set)
+        self.assertTrue(ran.wait(5))
+
+    def test_apply_manifest(self):
+        with papa.Papa() as p:
+            manifest = {
+                'sockets': {'app.web': {}},
+                'values': {'app.workers': 4, 'app.name': 'two words'},
+                'processes': {'app.worker': {'args': [sys.executable, '-c', 'import sys; sys.stdout.write("$(socket.app.web.port)")'], 'bufsize': 0}},
+                'prune': ['app.*'],
+            }
+            reply = p.apply(manifest)
+            self.assertEqual('created', reply['sockets']['app.web']['action'])
+            self.assertEqual('created', reply['values']['app.workers']['action'])
+            self.assertEqual('created', reply['processes']['app.worker']['action'])
+            self.assertEqual('4', p.get('app.workers'))
+            self.assertEqual('two words', p.get('app.name'))
+            port = p.list_sockets('app.web')['app.web']['port']
+
+            reply = p.apply(manifest)
+            self.assertEqual('kept', reply['sockets']['app.web']['action'])
+            self.assertEqual('kept', reply['values']['app.name']['action'])
+            self.assertEqual(port, p.list_sockets('app.web')['app.web']['port'])
+
+            del manifest['processes']
+            manifest['values'] = {'app.workers': 8}
+            reply = p.apply(manifest)
+            self.assertEqual('replaced', reply['values']['app.workers']['action'])
+            self.assertEqual('removed', reply['values']['app.name']['action'])
+            self.assertEqual('removed', reply['processes']['app.worker']['action'])
+            self.assertDictEqual({'app.workers': '8'}, p.list_values('app.*'))
+
+            reply = p.apply({'prune': ['app.*']})
+            self.assertEqual('removed', reply['sockets']['app.web']['action'])
+            self.assertDictEqual({}, p.list_sockets())
+            self.assertDictEqual({}, p.list_values())
+            self.assertRaises(papa.Error, p.apply, {'prune': ['*']})
+            self.assertRaises(papa.Error, p.apply, '{not json')
+
     def test_process_with_small_buffer(self):
         with papa.Papa() as p:
             self.assertDictEqual({}, p.list_processes())